@@ -0,0 +1,35 @@
+"""Offloaded and compressed job result content
+
+Revision ID: 3b8d2f6c1a47
+Revises: 9495a3b32dc2
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3b8d2f6c1a47'
+down_revision = '9495a3b32dc2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('job_result') as batch_op:
+        batch_op.add_column(sa.Column('content_ref', sa.String(length=500),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('content_size', sa.Integer(),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('content_encoding',
+                                      sa.String(length=50), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('job_result') as batch_op:
+        batch_op.drop_column('content_encoding')
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('content_size')
+        batch_op.drop_column('content_ref')
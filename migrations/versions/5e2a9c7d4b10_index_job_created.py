@@ -0,0 +1,22 @@
+"""Index on job creation date, used in cursor pagination
+
+Revision ID: 5e2a9c7d4b10
+Revises: 3b8d2f6c1a47
+Create Date: 2026-10-18 11:03:12.118734
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5e2a9c7d4b10'
+down_revision = '3b8d2f6c1a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_job_created'), 'job', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_job_created'), table_name='job')
@@ -0,0 +1,148 @@
+"""Content-addressed storage of workflow definitions and source code
+
+Revision ID: 8f3c1d2e6b57
+Revises: 5e2a9c7d4b10
+Create Date: 2026-10-18 14:21:47.305118
+
+"""
+import datetime
+import hashlib
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8f3c1d2e6b57'
+down_revision = '5e2a9c7d4b10'
+branch_labels = None
+depends_on = None
+
+# Number of jobs read (and updated) at a time, each batch is committed
+# (instead of a single long transaction locking the job table)
+BATCH_SIZE = 500
+
+CONTENT_COLUMNS = ['workflow_definition', 'source_code']
+
+content_blob = sa.table(
+    'content_blob',
+    sa.column('hash', sa.String), sa.column('size', sa.Integer),
+    sa.column('encoding', sa.String), sa.column('content', sa.LargeBinary),
+    sa.column('created', sa.DateTime))
+job = sa.table(
+    'job', sa.column('id', sa.Integer),
+    *[sa.column(name, sa.Text) for name in CONTENT_COLUMNS],
+    *[sa.column(f'{name}_hash', sa.String) for name in CONTENT_COLUMNS])
+
+
+def _in_batches(conn, columns, condition):
+    """ Yields job rows (id and columns) matching the condition, in batches
+    ordered by id """
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([job.c.id] + columns).where(
+                sa.and_(condition, job.c.id > last_id)).order_by(
+                job.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _move_contents(conn):
+    """ Moves contents to content_blob, storing each distinct content once.
+    Blobs of a batch are committed before the jobs referencing them. """
+    columns = [job.c[name] for name in CONTENT_COLUMNS]
+    update = job.update().where(job.c.id == sa.bindparam('job_id')).values(
+        {**{name: None for name in CONTENT_COLUMNS},
+         **{f'{name}_hash': sa.bindparam(f'{name}_new_hash')
+            for name in CONTENT_COLUMNS}})
+    for rows in _in_batches(conn, columns,
+                            sa.or_(*[c.isnot(None) for c in columns])):
+        blobs = {}
+        params = []
+        for row in rows:
+            param = {'job_id': row[0]}
+            for name, value in zip(CONTENT_COLUMNS, row[1:]):
+                content_hash = None
+                if value is not None:
+                    data = value.encode('utf8')
+                    content_hash = hashlib.sha256(data).hexdigest()
+                    blobs[content_hash] = data
+                param[f'{name}_new_hash'] = content_hash
+            params.append(param)
+
+        existing = {content_hash for (content_hash,) in conn.execute(
+            sa.select([content_blob.c.hash]).where(
+                content_blob.c.hash.in_(list(blobs))))}
+        now = datetime.datetime.utcnow()
+        new_blobs = [{'hash': content_hash, 'size': len(data),
+                      'encoding': 'zlib', 'content': zlib.compress(data),
+                      'created': now}
+                     for content_hash, data in blobs.items()
+                     if content_hash not in existing]
+        if new_blobs:
+            conn.execute(content_blob.insert(), new_blobs)
+        conn.execute(update, params)
+
+
+def _restore_contents(conn):
+    """ Copies contents back to job """
+    hash_columns = [job.c[f'{name}_hash'] for name in CONTENT_COLUMNS]
+    update = job.update().where(job.c.id == sa.bindparam('job_id')).values(
+        {name: sa.bindparam(f'{name}_value') for name in CONTENT_COLUMNS})
+    for rows in _in_batches(conn, hash_columns,
+                            sa.or_(*[c.isnot(None) for c in hash_columns])):
+        hashes = {h for row in rows for h in row[1:] if h is not None}
+        contents = {
+            content_hash: (zlib.decompress(content) if encoding == 'zlib'
+                           else content).decode('utf8')
+            for content_hash, encoding, content in conn.execute(
+                sa.select([content_blob.c.hash, content_blob.c.encoding,
+                           content_blob.c.content]).where(
+                    content_blob.c.hash.in_(list(hashes))))}
+        conn.execute(update, [
+            {'job_id': row[0],
+             **{f'{name}_value': contents.get(content_hash)
+                for name, content_hash in zip(CONTENT_COLUMNS, row[1:])}}
+            for row in rows])
+
+
+def upgrade():
+    op.create_table(
+        'content_blob',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('encoding', sa.String(length=50), nullable=True),
+        sa.Column('content', sa.LargeBinary(length=4294000000),
+                  nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('hash'))
+    with op.batch_alter_table('job') as batch_op:
+        for name in CONTENT_COLUMNS:
+            batch_op.add_column(sa.Column(f'{name}_hash',
+                                          sa.String(length=64),
+                                          nullable=True))
+            batch_op.create_index(f'ix_job_{name}_hash', [f'{name}_hash'],
+                                  unique=False)
+            batch_op.create_foreign_key(
+                f'fk_job_{name}_hash', 'content_blob', [f'{name}_hash'],
+                ['hash'])
+
+    with op.get_context().autocommit_block():
+        _move_contents(op.get_bind())
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        _restore_contents(op.get_bind())
+
+    with op.batch_alter_table('job') as batch_op:
+        for name in CONTENT_COLUMNS:
+            batch_op.drop_constraint(f'fk_job_{name}_hash',
+                                     type_='foreignkey')
+            batch_op.drop_index(f'ix_job_{name}_hash')
+            batch_op.drop_column(f'{name}_hash')
+    op.drop_table('content_blob')
+
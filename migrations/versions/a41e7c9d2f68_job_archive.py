@@ -0,0 +1,46 @@
+"""Archive of old jobs
+
+Revision ID: a41e7c9d2f68
+Revises: 8f3c1d2e6b57
+Create Date: 2026-10-18 15:02:11.571203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a41e7c9d2f68'
+down_revision = '8f3c1d2e6b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'job_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('archived', sa.DateTime(), nullable=False),
+        sa.Column('status', sa.Enum(
+            'COMPLETED', 'ERROR', 'INTERRUPTED', 'PENDING', 'RUNNING',
+            'WAITING', 'CANCELED', 'WAITING_INTERVENTION',
+            name='StatusExecutionEnumType'), nullable=False),
+        sa.Column('workflow_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('encoding', sa.String(length=50), nullable=True),
+        sa.Column('content', sa.LargeBinary(length=4294000000),
+                  nullable=True),
+        sa.Column('content_ref', sa.String(length=500), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_job_archive_workflow_id'), 'job_archive',
+                    ['workflow_id'], unique=False)
+    op.create_index(op.f('ix_job_archive_user_id'), 'job_archive',
+                    ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_job_archive_user_id'), table_name='job_archive')
+    op.drop_index(op.f('ix_job_archive_workflow_id'),
+                  table_name='job_archive')
+    op.drop_table('job_archive')
@@ -0,0 +1,23 @@
+"""Index on job workflow and creation date, used to find the latest job
+
+Revision ID: c72b5e8a1d39
+Revises: a41e7c9d2f68
+Create Date: 2026-10-18 16:12:40.228614
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c72b5e8a1d39'
+down_revision = 'a41e7c9d2f68'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_job_workflow_id_created', 'job',
+                    ['workflow_id', 'created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_workflow_id_created', table_name='job')
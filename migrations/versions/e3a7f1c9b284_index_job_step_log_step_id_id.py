@@ -0,0 +1,23 @@
+"""Index on job step log step and id, used to poll new logs of a job
+
+Revision ID: e3a7f1c9b284
+Revises: c72b5e8a1d39
+Create Date: 2026-10-18 17:05:12.518904
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7f1c9b284'
+down_revision = 'c72b5e8a1d39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_job_step_log_step_id_id', 'job_step_log',
+                    ['step_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_step_log_step_id_id', table_name='job_step_log')
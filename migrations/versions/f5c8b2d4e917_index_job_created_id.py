@@ -0,0 +1,23 @@
+"""Index on job creation and id, used by keyset pagination of jobs
+
+Revision ID: f5c8b2d4e917
+Revises: e3a7f1c9b284
+Create Date: 2026-10-18 18:21:37.204115
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f5c8b2d4e917'
+down_revision = 'e3a7f1c9b284'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_job_created_id', 'job', ['created', 'id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_created_id', table_name='job')
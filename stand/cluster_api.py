@@ -19,6 +19,7 @@ from stand.schema import (
     partial_schema_factory,
     translate_validation,
 )
+from stand.services.query_service import apply_projection
 from stand.services.redis_service import connect_redis_store
 
 log = logging.getLogger(__name__)
@@ -58,6 +59,9 @@ class ClusterListApi(Resource):
         else:
             clusters = Cluster.query
 
+        clusters = apply_projection(
+            clusters, Cluster, ClusterListResponseSchema, only)
+
         q = request.args.get("query")
         if q:
             clusters = clusters.filter(Cluster.name.like("%" + q + "%"))
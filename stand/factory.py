@@ -1,4 +1,3 @@
-import datetime
 import sys
 from marshmallow import ValidationError
 from werkzeug.exceptions import HTTPException
@@ -7,6 +6,7 @@ import logging
 import logging.config
 
 import os
+import time
 import socketio
 from babel import negotiate_locale
 from flask import Flask, g, request
@@ -16,7 +16,6 @@ from flask_cors import CORS
 from flask_migrate import Migrate
 from flask_restful import Api
 from mockredis import MockRedis
-from sqlalchemy import and_
 from stand.cluster_api import ClusterDetailApi, PerformanceModelEstimationApi
 from stand.cluster_api import ClusterListApi
 from stand.pipeline_run_api import (PipelineRunDetailApi, PipelineRunListApi,
@@ -25,21 +24,38 @@ from stand.pipeline_run_api import (PipelineRunDetailApi, PipelineRunListApi,
                                     PipelineRunSummaryApi,
                                     ChangePipelineRunStepApi)
 from stand.room_api import RoomApi
-from stand.job_api import (JobListApi, JobDetailApi,
+from stand.job_api import (JobListApi, JobBulkApi, JobDetailApi,
     JobStopActionApi, JobLockActionApi, JobUnlockActionApi,
     UpdateJobStatusActionApi, UpdateJobStepStatusActionApi,
     JobSampleActionApi, JobSourceCodeApi, LatestJobDetailApi,
+    JobResultContentApi, JobLogListApi,
     PerformanceModelEstimationResultApi,
     DataSourceInitializationApi, WorkflowStartActionApi, WorkflowSourceCodeApi,
     WorkflowSourceCodeResultApi)
 
 from stand.gateway_api import MetricListApi
-from stand.models import db, Job, JobStep, JobStepLog, StatusExecution as EXEC, \
-    JobResult
+from stand.metrics_api import MetricsApi
+from stand.models import db
 from stand.schema import translate_validation
 from stand.services import ServiceException
-from stand.services.pipeline_run_service import update_pipeline_run
+from stand.services.emit_service import (EMIT_BYTES, EMIT_EVENTS,
+                                         EMIT_REDIS_SECONDS, EMIT_SECONDS,
+                                         FINAL_STATES, EmitService,
+                                         PERSISTENT_EVENTS)
+from stand.services.event_coalescer import TaskEventCoalescer
+from stand.services.event_stream_service import (get_event_stream_config,
+                                                 publish_event)
+from stand.services.job_metadata_cache import configure_job_metadata_cache
+from stand.services.log_buffer import JobStepLogBuffer
+from stand.services.rate_limiter import (DROP as RATE_LIMIT_DROP,
+                                         SEND as RATE_LIMIT_SEND,
+                                         RoomRateLimiter,
+                                         get_rate_limit_config)
 from stand.services.redis_service import connect_redis_store
+from stand.services.room_cache_service import (REPLAY_EVENT,
+                                               cache_room_messages,
+                                               forget_room_cache,
+                                               get_room_cache_config)
 
 SEED_QUEUE_NAME = 'seed'
 SEED_METRIC_JOB_NAME = 'seed.jobs.metric_probe_updater'
@@ -161,9 +177,13 @@ def create_app(settings_override=None, log_level=logging.DEBUG, config_file=''):
     mappings = {
         '/room': RoomApi,
         '/jobs': JobListApi,
+        '/jobs/bulk': JobBulkApi,
         '/jobs/latest': LatestJobDetailApi,
         '/jobs/<int:job_id>': JobDetailApi,
         '/jobs/<int:job_id>/source-code': JobSourceCodeApi,
+        '/jobs/<int:job_id>/logs': JobLogListApi,
+        '/jobs/<int:job_id>/results/<int:result_id>/content':
+            JobResultContentApi,
         '/jobs/<int:job_id>/stop': JobStopActionApi,
         '/jobs/<int:job_id>/lock': JobLockActionApi,
         '/jobs/<int:job_id>/unlock': JobUnlockActionApi,
@@ -183,6 +203,7 @@ def create_app(settings_override=None, log_level=logging.DEBUG, config_file=''):
         '/performance/result/<key>': PerformanceModelEstimationResultApi,
         '/datasource/init': DataSourceInitializationApi,
         '/metric': MetricListApi,
+        '/metrics': MetricsApi,
         '/workflow': WorkflowStartActionApi,
         '/workflow/source-code': WorkflowSourceCodeApi,
         '/workflow/source-code/<key>': WorkflowSourceCodeResultApi,
@@ -215,251 +236,107 @@ def mocked_emit(original_emit, app_):
     """
 
     redis_store_ = create_redis_store(app_)
+    emit_config = app_.config['STAND_CONFIG'].get('emit', {})
+
+    # Persistence may be done in this process (inline) or by a pool of
+    # persistence workers consuming events from a Redis Stream (stream).
+    stream_config = None
+    if emit_config.get('persistence', 'inline') == 'stream':
+        stream_config = get_event_stream_config(app_.config['STAND_CONFIG'])
+
+    # Write-behind for job step logs. When disabled, each message is
+    # committed as soon as it is received.
+    write_behind_config = emit_config.get('write_behind', {})
+    log_buffer = None
+    if stream_config is None and write_behind_config.get('enabled', False):
+        log_buffer = JobStepLogBuffer(
+            app_, max_size=int(write_behind_config.get('max_size', 500)),
+            flush_interval=float(
+                write_behind_config.get('flush_interval', 2)))
+        log_buffer.start()
+
+    configure_job_metadata_cache(app_.config['STAND_CONFIG'])
+    emit_service = EmitService(app_, redis_store_, log_buffer)
+    room_cache_config = get_room_cache_config(app_.config['STAND_CONFIG'])
+
+    # Protects the server (and clients) from jobs flooding their rooms
+    rate_limiter = None
+    rate_limit_config = get_rate_limit_config(app_.config['STAND_CONFIG'])
+    if rate_limit_config['enabled']:
+        rate_limiter = RoomRateLimiter(rate_limit_config)
+
+    def process_emit(server, event, data, namespace, room, skip_sid,
+                     callback):
+        started = time.time()
+        try:
+            # Replayed messages were already handled and cached
+            replayed = event == REPLAY_EVENT or (
+                isinstance(data, dict) and data.get('fromcache'))
+            # Events are always persisted. Rate limited ones (including
+            # coalesced events) are not sent to clients and, if dropped,
+            # not cached for replay either.
+            action = RATE_LIMIT_SEND
+            if room and not replayed:
+                if rate_limiter is not None:
+                    action = rate_limiter.check(room, event)
+                if isinstance(data.get('message', ''), bytes):
+                    data['message'] = str(data['message'], 'utf-8')
+                EMIT_EVENTS.inc(event=event)
+                if isinstance(data.get('message'), str):
+                    EMIT_BYTES.inc(len(data['message']), event=event)
+                if stream_config is not None:
+                    if event in PERSISTENT_EVENTS:
+                        with EMIT_REDIS_SECONDS.time(event=event):
+                            publish_event(redis_store_, stream_config,
+                                          event, data, namespace, room)
+                    emit_service.enrich(event, data)
+                else:
+                    emit_service.handle(
+                        event, data, namespace, room,
+                        notify=lambda evt, msg, ns, rm: server.emit(
+                            evt, msg, ns, rm, skip_sid, callback))
+                if data.get('type') == 'OBJECT':
+                    data['message'] = json.loads(data['message'])
+                if action != RATE_LIMIT_DROP:
+                    with EMIT_REDIS_SECONDS.time(event=event):
+                        cache_room_messages(
+                            redis_store_, room_cache_config, room,
+                            [{'event': event, 'data': data,
+                              'namespace': namespace}])
+                if event == 'update job' and \
+                        data.get('status') in FINAL_STATES:
+                    forget_room_cache(room)
+            if action != RATE_LIMIT_SEND:
+                return
+            return original_emit(server, event, data, namespace, room=room,
+                                 skip_sid=skip_sid,
+                                 callback=callback)
+        finally:
+            EMIT_SECONDS.observe(time.time() - started, event=event)
+
+    # Bursts of 'update task' events with the same status are merged
+    coalescer = None
+    coalesce_window = float(
+        emit_config.get('coalesce', {}).get('window', 0) or 0)
+    if coalesce_window > 0:
+        coalescer = TaskEventCoalescer(
+            coalesce_window,
+            lambda server, event, data, namespace, room: process_emit(
+                server, event, data, namespace, room, None, None))
+        coalescer.start()
 
     def new_emit(self, event, data, namespace, room=None, skip_sid=None,
                  callback=None):
-        use_callback = callback
-        if room:
-            use_callback = handle_emit(data, event, namespace, room, self,
-                                       skip_sid, use_callback, redis_store_)
-            if isinstance(data.get('message', ''), bytes):
-                data['message'] = str(data['message'], 'utf-8')
-            if data.get('type') == 'OBJECT':
-                data['message'] = json.loads(data['message'])
-            cached_data = data.copy()
-            cached_data['fromcache'] = True
-            redis_store_.rpush(f'cache_room_{room}', json.dumps(
-                {'event': event, 'data': cached_data, 'namespace': namespace,
-                 'room': room}, indent=0))
-            redis_store_.expire(f'cache_room_{room}', 600)
-        return original_emit(self, event, data, namespace, room=room,
-                             skip_sid=skip_sid,
-                             callback=use_callback)
-
-    def _gettext(title):
-        with app_.request_context(
-                {'wsgi.url_scheme': "", 'SERVER_PORT': "", 'SERVER_NAME': "",
-                 'REQUEST_METHOD': ""}):
-            return gettext(title)
-
-    def handle_emit(data, event, namespace, room, self, skip_sid, use_callback,
-                    redis_store):
-        logger = logging.getLogger(__name__)
-        # print(('-' * 40))
-        # print((data, event, namespace, room, self, skip_sid, use_callback,
-        #       redis_store_))
-        # print(('-' * 40))
-        try:
-            now = datetime.datetime.now().strftime(
-                '%Y-%m-%dT%H:%m:%S')
-            with app_.app_context():
-                if event == 'update job':
-                    status = data.get('status')
-                    if status is None:
-                        raise ValueError('Status not provided!')
-                    job_id = int(room)
-                    #logger.info(_gettext('Updating job id=%s'), job_id)
-                    job: Job = Job.query.get(job_id)
-                    if job is not None:
-                        final_states = [EXEC.COMPLETED,
-                                        EXEC.CANCELED,
-                                        EXEC.ERROR]
-                        job.status = status
-                        logger.info(_gettext('Updating job id=%s to status %s'),
-                            job_id, job.status)
-                        job.status_text = data.get('msg',
-                                                   data.get('message', ''))
-                        job.exception_stack = data.get('exception_stack')
-                        if job.status in final_states:
-                            job.finished = datetime.datetime.utcnow()
-                            data['finished'] = job.finished.strftime(
-                                '%Y-%m-%dT%H:%m:%S')
-                        # Update Job Step status
-                        if job.status == EXEC.COMPLETED:
-                            for job_step in job.steps:
-                                if job_step.status == 'PENDING':
-                                    job_step.status = 'COMPLETED'
-                                    db.session.add(job_step)
-                        elif job.status == EXEC.ERROR:
-                            # Something went wrong, record the cause
-                            for job_step in job.steps:
-                                level = data.get('level', 'ERROR')
-
-                                step_log = JobStepLog(
-                                    level=level, date=datetime.datetime.now(),
-                                    status=job_step.status,
-                                    type=data.get('type', 'TEXT'),
-                                    message=_gettext('Canceled by error'))
-
-                                job_step.logs.append(step_log)
-                                if job_id > 0:
-                                    db.session.add(job_step)
-                                    db.session.commit()
-
-                                msg = {
-                                    'type': data.get('type', 'TEXT') or 'TEXT',
-                                    'task': {'id': job_step.task_id},
-                                    'id': step_log.id,
-                                    'level': level,
-                                    'date': now,
-                                    'room': job_id
-                                }
-                                # Indicate if the message should be stored for
-                                # the client
-                                cache = False
-                                if job_step.status == EXEC.RUNNING:
-                                    job_step.status = EXEC.ERROR
-                                    msg['message'] = _gettext(
-                                        'Canceled by error')
-                                    msg['status'] = EXEC.ERROR
-                                    #original_emit(self, 'update task', msg,
-                                    #              namespace, room, skip_sid,
-                                    #              use_callback)
-                                    cache = True
-                                elif job_step.status not in final_states:
-                                    job_step.status = EXEC.CANCELED
-                                    msg['message'] = _gettext('Skiped by error')
-                                    msg['status'] = EXEC.CANCELED
-
-                                    #original_emit(self, 'update task', msg,
-                                    #              namespace, room, skip_sid,
-                                    #              use_callback)
-                                    cache = True
-                                if cache:
-                                    redis_store.rpush(
-                                        f'cache_room_{room}',
-                                        json.dumps({'event': 'update task',
-                                                    'data': msg,
-                                                    'namespace': namespace,
-                                                    'room': room}))
-
-                                if job_id > 0:
-                                    db.session.add(job_step)
-
-                        elif job.status == EXEC.CANCELED:
-                            for job_step in job.steps:
-                                if job_step.status not in final_states:
-                                    job_step.status = EXEC.CANCELED
-                                if job_id > 0:
-                                    db.session.add(job_step)
-
-                        logger.info('Is job associated to pipeline run? %s',
-                                 f'Yes, {job.pipeline_step_run.id}' if
-                                 job.pipeline_step_run is not None else 'No')
-                        if (job.pipeline_step_run):
-                            update_pipeline_run(job)
-                            notification_msg = {
-                                'date': datetime.datetime.utcnow().isoformat(),
-                                'pipeline_run': {
-                                    'id': job.pipeline_run.id,
-                                    'status': job.pipeline_run.status,
-                                },
-                                'pipeline_step_run': {
-                                    'id': job.pipeline_step_run.id,
-                                    'status': job.pipeline_step_run.status,
-                                    'order': job.pipeline_step_run.order
-                                },
-                                'job': {
-                                    'id': job.id,
-                                    'status': job.status,
-                                },
-                                'message': data.get('message')
-                            }
-                            log.info('Notify room pipeline_runs: %s', notification_msg)
-                            self.emit('update pipeline run',
-                                            notification_msg,
-                                            namespace, 'pipeline_runs', skip_sid,
-                                            use_callback)
-                        db.session.add(job)
-                        db.session.commit()
-                    else:
-                        logger.info(gettext("Job %s is not persistent."), job_id)
-                elif event == 'update task' or event == 'user message':
-                    job_id = int(room)
-                    job_step = JobStep.query.filter(and_(
-                        JobStep.job_id == job_id,
-                        JobStep.task_id == data.get('id'))).first()
-                    # print('=' * 20)
-                    # print(data)
-                    # print(job_step)
-                    # print(event)
-                    # print('=' * 20)
-                    status = data.get('status')
-                    if job_step is not None:
-                        job_step.status = status
-                        level = data.get('level')
-                        if level is None:
-                            if job_step.status == EXEC.ERROR:
-                                level = 'WARN'
-                            else:
-                                level = 'INFO'
-                        data['date'] = now
-                        step_log_msg = data.get('message', 'no message')
-                        if isinstance(step_log_msg, dict):
-                            step_log_msg = json.dumps(step_log_msg)
-
-                        step_log_type = data.get('type', 'TEXT')
-                        if event == 'user message':
-                            step_log_type = 'USER'
-
-
-                        # Messages must be serialized in the client
-                        #if step_log_type == 'OBJECT':
-                        #    step_log_msg = json.dumps(step_log_msg)
-
-                        step_log = JobStepLog(
-                            level=level, date=datetime.datetime.now(),
-                            status=job_step.status,
-                            type=step_log_type,
-                            message=step_log_msg)
-                        job_step.logs.append(step_log)
-                        # If job_id <= 0, it is internal and it is not persisted
-                        if data.get('type') != 'SILENT' and job_id > 0:
-                            db.session.add(job_step)
-                            db.session.commit()
-                        data['type'] = data.get('type', 'TEXT') or 'TEXT'
-                        data['id'] = step_log.id
-                        data['level'] = level
-                        data['task'] = {'id': job_step.task_id}
-                elif event == 'task result':
-                    job_id = int(room)
-                    job = Job.query.get(job_id)
-                    if job is not None:
-                        task_id = data.get('id')
-                        op_id = data.get('operation_id')
-
-                        content = data.get('message')
-                        if isinstance(content, dict):
-                            content = json.dumps(content)
-
-                        result = JobResult(
-                            task_id=task_id,
-                            operation_id=op_id,
-                            type=data.get('type'),
-                            title=data.get('title'),
-                            content=content)
-                        job.results.append(result)
-                        if job_id > 0:
-                            db.session.add(job)
-                            db.session.commit()
-                        # if 'operation_id' in data:
-                        #     del data['operation_id']
-                        # data['time'] = datetime.datetime.now().isoformat()
-                        # data['id'] = result.id
-                        # data['task'] = {'id': task_id}
-                        # data['message'] = json.loads(data['message'])
-
-                        # If metric, post again to be read by metric agent
-                        # if data.get('type') == 'METRIC':
-                        #     q = rq.Queue(name=SEED_QUEUE_NAME,
-                        #                  connection=redis_store)
-                        #     data['content'] = json.loads(data['content'])
-                        #     rq_job = q.enqueue(SEED_METRIC_JOB_NAME, data)
-                        #     logger.info('Scheduled job for metric %s', rq_job)
-        except Exception as ex:
-            logger.exception(ex)
-        return use_callback
-
+        if (coalescer is not None and room and isinstance(data, dict)
+                and not data.get('fromcache')):
+            if event == TaskEventCoalescer.EVENT:
+                if not coalescer.add(self, data, namespace, room):
+                    return
+            elif event == 'update job':
+                # Held events must be sent before the job status
+                coalescer.flush(room)
+        return process_emit(self, event, data, namespace, room, skip_sid,
+                            callback)
 
     return new_emit
 
@@ -500,12 +377,10 @@ def create_redis_store(_app):
     """
     Redis store. Used to control queues and subscription services
     :param _app: Flask app
-    :return: redis_store instance (wrapper around pyredis)
+    :return: redis_store instance (pyredis client, sharing a connection pool)
     """
-    redis_store = connect_redis_store(_app.config['REDIS_URL'], False)
-    redis_store.init_app(_app)
-
-    return redis_store
+    with _app.app_context():
+        return connect_redis_store(_app.config['REDIS_URL'], False)
 
 
 def create_services(_app):
@@ -7,19 +7,36 @@ import rq
 import logging
 
 from flask import g as flask_global
-from flask import request, current_app
+from flask import request, current_app, Response, stream_with_context
 from flask_babel import gettext
 from flask_restful import Resource
 from marshmallow import ValidationError
-from sqlalchemy import and_
+from sqlalchemy import and_, func
+from sqlalchemy.orm import contains_eager, load_only
 from stand.app_auth import requires_auth
 from stand.schema import (Job, JobCreateRequestSchema, JobItemResponseSchema,
-                          JobListResponseSchema, JobStep, ExecutionPermission,
+                          JobListResponseSchema, JobStep,
                           PermissionType, Cluster, translate_validation,
-                          JobException, db)
-from stand.models import JobType, StatusExecution
-from stand.services.job_services import JobService
+                          JobException, JobResult, JobStepLog,
+                          JobStepLogTaskListResponseSchema, ResultType, db)
+from stand.models import JobArchive, JobType, StatusExecution
+from stand.services.archive_service import get_archived_job
+from stand.services.job_metadata_cache import job_metadata_cache
+from stand.services.job_services import DEFAULT_SAMPLE_CONFIG, JobService
+from stand.services.latest_job_service import (ALL_USERS, get_latest_job_id,
+                                               repair_latest_job)
+from stand.services.pagination_service import (DEFAULT_COUNT_TTL,
+                                               cached_count, get_page_size,
+                                               keyset_paginate)
+from stand.services.permission_service import get_execution_permissions
+from stand.services.query_service import (apply_projection,
+                                          job_detail_options)
 from stand.services.redis_service import connect_redis_store
+from stand.services.result_store import iter_result_content
+from stand.services.tahiti_service import (CircuitOpenError,
+                                           get_tahiti_client)
+from stand.services.version_service import (COLLECTION, JOB, PIPELINE_RUN,
+                                            conditional_get)
 from rq.exceptions import NoSuchJobError
 
 log = logging.getLogger(__name__)
@@ -35,46 +52,90 @@ def apply_filter(query, args, name, transform=None, transform_name=None):
     return result
 
 
-def _get_jobs(jobs, permissions):
-    if flask_global.user.id != 0:  # It is not a inter service call
-        any_permission = ExecutionPermission.query.filter(
-            ExecutionPermission.permission.in_(permissions)).all()
-        if len(any_permission) == 0:
-            jobs = jobs.filter(Job.user_id == flask_global.user.id)
+def _can_access_all(permissions):
+    """ Returns if the user can access jobs of other users """
+    if flask_global.user.id == 0:  # It is a inter service call
+        return True
+    user_permissions = get_execution_permissions(flask_global.user.id)
+    return not user_permissions.isdisjoint(permissions)
+
+
+def _get_jobs(jobs, permissions, model=Job):
+    if not _can_access_all(permissions):
+        jobs = jobs.filter(model.user_id == flask_global.user.id)
     return jobs
 
 
+# Contents of results of the other jobs in the pipeline run of a job are not
+# returned with it (see job_detail_options)
+_PIPELINE_RESULTS_CONTENT = 'pipeline_run.steps.jobs.results.content'
+
+
 class LatestJobDetailApi(Resource):
     @staticmethod
     @requires_auth
     def get():
-        workflow_id = request.args.get('workflow')
+        workflow_id = request.args.get('workflow', type=int)
+        if workflow_id is None:
+            return dict(status="ERROR", message=gettext("Not found")), 404
 
-        jobs = _get_jobs(Job.query, [PermissionType.LIST, PermissionType.STOP,
-                                     PermissionType.MANAGE])
-        jobs = jobs.filter(Job.workflow_id == workflow_id).order_by(
-            Job.created.desc()).limit(1).all()
+        if _can_access_all([PermissionType.LIST, PermissionType.STOP,
+                            PermissionType.MANAGE]):
+            field = ALL_USERS
+        else:
+            field = flask_global.user.id
+        # Fast path: latest job is known (see latest_job_service)
+        latest_id = get_latest_job_id(workflow_id, field)
+        job = None
+        if latest_id is not None:
+            job = Job.query.filter(
+                Job.id == latest_id, Job.workflow_id == workflow_id).options(
+                *job_detail_options()).first()
+        if job is None:
+            query = Job.query.filter(Job.workflow_id == workflow_id)
+            if field != ALL_USERS:
+                query = query.filter(Job.user_id == field)
+            job = query.order_by(Job.created.desc()).options(
+                *job_detail_options()).first()
+            repair_latest_job(workflow_id, field, latest_id,
+                              job.id if job is not None else None)
 
-        if len(jobs) == 1:
-            return JobItemResponseSchema(exclude=('workflow',)).dump(
-                jobs[0])
+        if job is not None:
+            return JobItemResponseSchema(
+                exclude=('workflow', _PIPELINE_RESULTS_CONTENT)).dump(job)
         else:
             return dict(status="ERROR", message=gettext("Not found")), 404
 
 
 class JobListApi(Resource):
     """ REST API for listing class Job """
+    # Not nullable columns, usable in cursor pagination
+    KEYSET_SORTS = ['status', 'id', 'user_name', 'workflow_name',
+                    'workflow_id', 'created']
 
     @staticmethod
     @requires_auth
     def get():
+        # Jobs include their pipeline runs
+        not_modified = conditional_get((JOB, COLLECTION),
+                                       (PIPELINE_RUN, COLLECTION))
+        if not_modified is not None:
+            return not_modified
+
         only = None if request.args.get('simple') != 'true' else ('id',)
         if request.args.get('fields'):
             only = tuple(
                 [x.strip() for x in request.args.get('fields').split(',')])
 
+        # Results content may be large, it is returned only if requested
+        exclude = () if request.args.get('results_content') == 'true' \
+            else ('results.content',)
+
         jobs = _get_jobs(Job.query, [PermissionType.LIST, PermissionType.STOP,
                                      PermissionType.MANAGE])
+        # Only columns used in the response are loaded
+        jobs = apply_projection(jobs, Job, JobListResponseSchema, only,
+                                exclude)
         for name in ['workflow_id', 'user_id']:
             jobs = apply_filter(jobs, request.args, name, int,
                                 lambda field: field)
@@ -89,19 +150,26 @@ class JobListApi(Resource):
         if sort not in ['status', 'id', 'user_name', 'workflow_name',
                         'workflow_id', 'finished', 'started', 'created']:
             sort = 'id'
+        ascending = request.args.get('asc', 'true') != 'false'
+
+        if 'after' in request.args:
+            return JobListApi._get_page_after(jobs, sort, ascending, only,
+                                              exclude)
+
         sort_option = getattr(Job, sort)
-        if request.args.get('asc', 'true') == 'false':
+        if not ascending:
             sort_option = sort_option.desc()
 
         jobs = jobs.order_by(sort_option)
         page = request.args.get('page') or '1'
 
         if page is not None and page.isdigit():
-            page_size = int(request.args.get('size', 20))
+            page_size = get_page_size(request.args.get('size'))
             page = int(page)
             pagination = jobs.paginate(page, page_size, True)
             result = {
-                'data': JobListResponseSchema(many=True, only=only).dump(
+                'data': JobListResponseSchema(
+                    many=True, only=only, exclude=exclude).dump(
                     pagination.items),
                 'pagination': {
                     'page': page, 'size': page_size,
@@ -109,11 +177,39 @@ class JobListApi(Resource):
                     'pages': int(math.ceil(1.0 * pagination.total / page_size))}
             }
         else:
-            result = {'data': JobListResponseSchema(many=True, only=only).dump(
-                jobs)}
+            result = {'data': JobListResponseSchema(
+                many=True, only=only, exclude=exclude).dump(jobs)}
 
         return result
 
+    @staticmethod
+    def _get_page_after(jobs, sort, ascending, only, exclude):
+        """
+        Cursor (keyset) pagination, used when parameter `after` is informed
+        (empty for the first page). Total is returned only if requested
+        (total=true) and it is cached for some seconds.
+        """
+        if sort not in JobListApi.KEYSET_SORTS:
+            sort = 'id'
+        page_size = get_page_size(request.args.get('size'))
+        try:
+            items, next_cursor = keyset_paginate(
+                jobs, getattr(Job, sort), Job.id, page_size,
+                request.args.get('after'), ascending)
+        except ValueError:
+            return {'status': 'ERROR',
+                    'message': gettext('Invalid cursor')}, 400
+        pagination = {'size': page_size, 'next': next_cursor}
+        if request.args.get('total') == 'true':
+            config = current_app.config['STAND_CONFIG']
+            pagination['total'] = cached_count(
+                connect_redis_store(None, current_app.testing), 'jobs', jobs,
+                config.get('pagination', {}).get('count_ttl',
+                                                 DEFAULT_COUNT_TTL))
+        return {'data': JobListResponseSchema(
+                    many=True, only=only, exclude=exclude).dump(items),
+                'pagination': pagination}
+
     @staticmethod
     @requires_auth
     def post():
@@ -185,19 +281,140 @@ class JobListApi(Resource):
         return result, result_code
 
 
+class JobBulkApi(Resource):
+    """ RPC API for starting many jobs of the same workflow (e.g. a parameter
+    sweep). Workflow, cluster and user are validated once. """
+    MAX_JOBS = 1000
+    # Job attributes shared by all jobs
+    SHARED = ['type', 'trigger_type', 'job_key', 'pipeline_run_id',
+              'cluster_id', 'user_id', 'user_name', 'user_login',
+              'workflow_id', 'workflow_name', 'workflow_definition']
+
+    @staticmethod
+    @requires_auth
+    def post():
+        result, result_code = dict(
+            status="ERROR",
+            message=gettext("Missing json in the request body")), 400
+        if request.json is None:
+            return result, result_code
+        try:
+            request_json = request.json
+            specs = request_json.pop('jobs', None)
+            if not specs or not isinstance(specs, list):
+                raise ValidationError({'jobs': ['Missing data for required '
+                                                'field.']})
+            if len(specs) > JobBulkApi.MAX_JOBS:
+                raise ValidationError({'jobs': [
+                    f'Longer than maximum length {JobBulkApi.MAX_JOBS}.']})
+            request_json['user'] = {
+                'id': flask_global.user.id,
+                'login': flask_global.user.login,
+                'name': f'{flask_global.user.first_name} {flask_global.user.last_name}'
+            }
+            request_json['job_key'] = ''
+            template = JobCreateRequestSchema().load(request_json)
+
+            spec_schema = JobCreateRequestSchema(only=('name', 'description'))
+            errors = {}
+            for i, spec in enumerate(specs):
+                spec_errors = spec_schema.validate(spec)
+                if not isinstance(spec.get('app_configs', {}), dict):
+                    spec_errors['app_configs'] = ['Not a valid mapping type.']
+                if spec_errors:
+                    errors[i] = spec_errors
+            if errors:
+                raise ValidationError({'jobs': errors})
+
+            cluster = Cluster.query.get(template.cluster_id)
+            if cluster is None:
+                raise ValidationError({'cluster': ['Invalid cluster']})
+
+            jobs = []
+            app_configs_list = []
+            shared_configs = request_json.get('app_configs', {})
+            for spec in specs:
+                job = Job(cluster=cluster, **{
+                    name: getattr(template, name)
+                    for name in JobBulkApi.SHARED})
+                job.name = (spec.get('name') or template.name or
+                            template.workflow_name or gettext('Unnamed job'))
+                job.description = spec.get('description',
+                                           template.description)
+                jobs.append(job)
+                app_configs_list.append(
+                    dict(shared_configs, **spec.get('app_configs', {})))
+
+            JobService.start_many(jobs, request_json['workflow'],
+                                  app_configs_list,
+                                  testing=current_app.testing,
+                                  lang=flask_global.user.locale)
+            result_code = 201
+            result = {'status': 'OK', 'message': '',
+                      'data': [{'id': job.id, 'name': job.name}
+                               for job in jobs]}
+        except ValidationError as e:
+            result = {'status': 'ERROR',
+                      'message': gettext("Validation error"),
+                      'errors': translate_validation(e.messages)}
+            result_code = 400
+        except JobException as je:
+            log.exception(gettext('Error in POST'))
+            result = dict(status="ERROR", message=str(je),
+                          code=je.error_code)
+            result_code = 422
+            db.session.rollback()
+        except Exception as e:
+            log.exception(gettext('Error in POST'))
+            result, result_code = dict(status="ERROR",
+                                       message=gettext(
+                                           "Internal error")), 500
+            if current_app.debug:
+                result['debug_detail'] = str(e)
+            db.session.rollback()
+
+        return result, result_code
+
+
 class JobDetailApi(Resource):
     """ REST API for a single instance of class Job """
 
     @staticmethod
     @requires_auth
     def get(job_id):
+        # Results content may be large, it is returned only if requested.
+        # Otherwise, use JobResultContentApi.
+        result_content = request.args.get('results_content') == 'true'
+        versions = [(JOB, job_id)]
+        pipeline_run_id = db.session.query(Job.pipeline_run_id).filter(
+            Job.id == job_id).scalar()
+        if pipeline_run_id is not None:
+            # Pipeline run includes the other jobs of the run
+            versions += [(PIPELINE_RUN, pipeline_run_id), (JOB, COLLECTION)]
+        not_modified = conditional_get(*versions)
+        if not_modified is not None:
+            return not_modified
+
         jobs = _get_jobs(Job.query.filter(Job.id == job_id),
                          [PermissionType.LIST, PermissionType.STOP,
-                          PermissionType.MANAGE]).all()
+                          PermissionType.MANAGE]).options(
+            *job_detail_options(result_content)).all()
+        exclude = (_PIPELINE_RESULTS_CONTENT,)
+        if not result_content:
+            exclude += ('results.content',)
         if len(jobs) == 1:
-            return JobItemResponseSchema().dump(jobs[0])
-        else:
-            return dict(status="ERROR", message=gettext("Not found")), 404
+            return JobItemResponseSchema(exclude=exclude).dump(jobs[0])
+
+        # Old jobs are moved to the archive (see archive_service)
+        archive = _get_jobs(JobArchive.query.filter(JobArchive.id == job_id),
+                            [PermissionType.LIST, PermissionType.STOP,
+                             PermissionType.MANAGE], JobArchive).first()
+        if archive is not None:
+            result = JobItemResponseSchema(exclude=exclude).dump(
+                get_archived_job(archive))
+            result['archived'] = True
+            return result
+        return dict(status="ERROR", message=gettext("Not found")), 404
 
     @staticmethod
     @requires_auth
@@ -211,6 +428,7 @@ class JobDetailApi(Resource):
                 JobService.stop(job, True)
                 db.session.delete(job)
                 db.session.commit()
+                job_metadata_cache.invalidate(job.id)
                 result, result_code = dict(status="OK", message="Deleted"), 204
             except Exception as e:
                 log.exception('Error in DELETE')
@@ -222,6 +440,101 @@ class JobDetailApi(Resource):
         return result, result_code
 
 
+class JobResultContentApi(Resource):
+    """ REST API for the content of a job result, streamed in chunks """
+
+    MIMETYPES = {
+        ResultType.HTML: 'text/html',
+        ResultType.VISUALIZATION: 'application/json',
+    }
+
+    @staticmethod
+    @requires_auth
+    def get(job_id, result_id):
+        job = _get_jobs(Job.query.filter(Job.id == job_id),
+                        [PermissionType.LIST, PermissionType.STOP,
+                         PermissionType.MANAGE]).first()
+        result = JobResult.query.filter(
+            JobResult.job_id == job_id,
+            JobResult.id == result_id).first() if job is not None else None
+        if result is None:
+            return dict(status="ERROR", message=gettext("Not found")), 404
+        response = Response(
+            stream_with_context(iter_result_content(result)),
+            mimetype=JobResultContentApi.MIMETYPES.get(
+                result.type, 'text/plain'))
+        if result.content_hash:
+            response.set_etag(result.content_hash)
+        return response
+
+
+class JobLogListApi(Resource):
+    """
+    REST API for listing logs of a job, ordered by date, using cursor
+    pagination. Parameters:
+      task_id, level, type: filters (comma separated values)
+      start, end: date range (ISO 8601)
+      after: cursor returned in `next`, for the next page
+      since: id returned in `last`, for logs added after a previous
+             request (polling). They are returned in insertion order (id),
+             because logs may be committed after logs with later dates.
+    """
+
+    @staticmethod
+    @requires_auth
+    def get(job_id):
+        job = _get_jobs(Job.query.filter(Job.id == job_id),
+                        [PermissionType.LIST, PermissionType.STOP,
+                         PermissionType.MANAGE]).options(
+            load_only(Job.id)).first()
+        if job is None:
+            return dict(status="ERROR", message=gettext("Not found")), 404
+
+        logs = JobStepLog.query.join(JobStepLog.step).filter(
+            JobStep.job_id == job_id)
+        for name, column in [('task_id', JobStep.task_id),
+                             ('level', JobStepLog.level),
+                             ('type', JobStepLog.type)]:
+            if request.args.get(name):
+                logs = logs.filter(column.in_(
+                    [x.strip() for x in request.args.get(name).split(',')]))
+        page_size = get_page_size(request.args.get('size'), default=100,
+                                  maximum=1000)
+        try:
+            if request.args.get('start'):
+                logs = logs.filter(JobStepLog.date >=
+                                   datetime.datetime.fromisoformat(
+                                       request.args.get('start')))
+            if request.args.get('end'):
+                logs = logs.filter(JobStepLog.date <=
+                                   datetime.datetime.fromisoformat(
+                                       request.args.get('end')))
+            since = request.args.get('since')
+            options = contains_eager(JobStepLog.step).load_only(
+                JobStep.task_id)
+            if since:
+                # Uses index (step_id, id)
+                items = logs.filter(JobStepLog.id > int(since)).order_by(
+                    JobStepLog.id).options(options).limit(page_size).all()
+                next_cursor = None
+                last_id = items[-1].id if items else int(since)
+            else:
+                last_id = logs.with_entities(
+                    func.max(JobStepLog.id)).scalar() or 0
+                items, next_cursor = keyset_paginate(
+                    logs.options(options), JobStepLog.date, JobStepLog.id,
+                    page_size, request.args.get('after'),
+                    request.args.get('asc', 'true') != 'false')
+        except ValueError as ve:
+            return {'status': 'ERROR', 'message': str(ve)}, 400
+
+        return {
+            'data': JobStepLogTaskListResponseSchema(many=True).dump(items),
+            'pagination': {'size': page_size, 'next': next_cursor,
+                           'last': last_id}
+        }
+
+
 class JobStopActionApi(Resource):
     """ RPC API for action that stops a Job """
 
@@ -328,13 +641,25 @@ class JobSampleActionApi(Resource):
         if job is not None:
             try:
                 data = json.loads(request.data)
+                config = current_app.config['STAND_CONFIG'].get('sample', {})
+                wait = float(data.get('wait', config.get(
+                    'max_wait', DEFAULT_SAMPLE_CONFIG['max_wait'])))
                 resp = JobService.retrieve_sample(data['user'], job, task_id,
-                                                  data['port'], wait=30)
-
-                result, result_code = dict(status=resp['status'],
-                                           message=resp['message'],
-                                           data=data,
-                                           sample=resp['sample']), 200
+                                                  data['port'], wait=wait,
+                                                  config=config)
+
+                if resp is None:
+                    # Client must repeat the request later
+                    result, result_code = dict(
+                        status='PENDING',
+                        message=gettext('Sample is not available yet'),
+                        key=JobService.get_sample_key(job, task_id,
+                                                      data['port'])), 202
+                else:
+                    result, result_code = dict(status=resp['status'],
+                                               message=resp['message'],
+                                               data=data,
+                                               sample=resp['sample']), 200
 
             except JobException as je:
                 log.exception('Error in POST')
@@ -550,13 +875,22 @@ class WorkflowStartActionApi(Resource):
         )
         # Retrieves the workflow from tahiti
         tahiti_config = current_app.config['STAND_CONFIG']['services']['tahiti']
-        url = f'{tahiti_config.get("url")}/workflows/{workflow_id}'
-        headers = {'X-Auth-Token': str(tahiti_config['auth_token'])}
         try:
-            r = requests.get(url, headers=headers)
-            if r.status_code == 200:
+            workflow_definition = get_tahiti_client(
+                tahiti_config).get_workflow(workflow_id)
+        except CircuitOpenError as e:
+            logging.error(e)
+            return {'status': 'ERROR',
+                    'message': gettext('Workflow service is unavailable. '
+                                       'Please, try again later.')}, 503
+        except requests.exceptions.RequestException as e:
+            logging.error(gettext('Error retrieving workflow {}: {}').format(
+                workflow_id, e))
+            workflow_definition = None
+        try:
+            if workflow_definition is not None:
 
-                workflow = r.json()
+                workflow = json.loads(workflow_definition)
                 cluster_id = request.json.get('cluster_id',
                                               workflow.get('preferred_cluster_id'))
                 if not cluster_id:
@@ -566,13 +900,11 @@ class WorkflowStartActionApi(Resource):
                                 'preferred one in workflow.')}
 
                 job.cluster = Cluster.query.get(int(cluster_id))
-                job.workflow_definition = r.text
+                job.workflow_definition = workflow_definition
                 JobService.start(job, workflow, {},
                                  JobType.BATCH, persist=True)
                 return {'data': {'job': {'id': job.id}}}
             else:
-                logging.error(gettext('Error retrieving workflow {}: {}').format(
-                    workflow_id, r.text))
                 return {'status': 'ERROR',
                         'message': gettext(
                             'Workflow not found or error retrieving it.')}
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-}
+from flask import request, Response
+from flask_restful import Resource
+from stand.app_auth import requires_auth, requires_permission
+from stand.services.metrics_service import registry
+
+
+class MetricsApi(Resource):
+    """ REST API for metrics collected by this process """
+
+    @staticmethod
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def get():
+        if request.args.get('format') == 'prometheus':
+            return Response(registry.render_text(),
+                            mimetype='text/plain; version=0.0.4')
+        return registry.collect(), 200
@@ -1,9 +1,15 @@
 import datetime
+import hashlib
+import itertools
+import zlib
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, \
-    DateTime, Text
+    DateTime, Text, LargeBinary, Index, event, inspect
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, Session
 
 db = SQLAlchemy()
 
@@ -273,6 +279,44 @@ class ClusterPlatform(db.Model):
         return '<Instance {}: {}>'.format(self.__class__, self.id)
 
 
+class ContentBlob(db.Model):
+    """ Content shared by jobs (workflow definition, source code),
+    identified by its hash and stored compressed """
+    __tablename__ = 'content_blob'
+
+    ZLIB = 'zlib'
+
+    # Fields
+    hash = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    encoding = Column(String(50))
+    content = Column(LargeBinary(4294000000), nullable=False)
+    created = Column(DateTime,
+                     default=func.now(), nullable=False)
+
+    @staticmethod
+    def get_hash(text):
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    @classmethod
+    def values_from_text(cls, text):
+        data = text.encode('utf8')
+        return dict(hash=hashlib.sha256(data).hexdigest(), size=len(data),
+                    encoding=cls.ZLIB, content=zlib.compress(data))
+
+    @property
+    def text(self):
+        if self.encoding == self.ZLIB:
+            return zlib.decompress(self.content).decode('utf8')
+        return self.content.decode('utf8')
+
+    def __str__(self):
+        return self.hash
+
+    def __repr__(self):
+        return '<Instance {}: {}>'.format(self.__class__, self.hash)
+
+
 class ExecutionPermission(db.Model):
     """ Associates permissions to a user """
     __tablename__ = 'execution_permission'
@@ -293,13 +337,18 @@ class ExecutionPermission(db.Model):
 class Job(db.Model):
     """ A workflow execution """
     __tablename__ = 'job'
+    __table_args__ = (
+        Index('ix_job_workflow_id_created', 'workflow_id', 'created'),
+        Index('ix_job_created_id', 'created', 'id'),
+    )
 
     # Fields
     id = Column(Integer, primary_key=True)
     name = Column(String(50))
     description = Column(String(400))
     created = Column(DateTime,
-                     default=func.now(), nullable=False)
+                     default=func.now(), nullable=False,
+                     index=True)
     type = Column(Enum(*list(JobType.values()),
                        name='JobTypeEnumType'),
                   default=JobType.NORMAL, nullable=False)
@@ -312,11 +361,13 @@ class Job(db.Model):
     exception_stack = Column(Text(4294000000))
     workflow_id = Column(Integer, nullable=False)
     workflow_name = Column(String(200), nullable=False)
-    workflow_definition = Column(Text(4294000000))
+    # Workflow definition and source code are stored in content_blob (see
+    # the properties below). These columns have content of rows not migrated.
+    _workflow_definition = Column('workflow_definition', Text(4294000000))
     user_id = Column(Integer, nullable=False)
     user_login = Column(String(50), nullable=False)
     user_name = Column(String(200), nullable=False)
-    source_code = Column(Text(4294000000))
+    _source_code = Column('source_code', Text(4294000000))
     job_key = Column(String(200))
     trigger_type = Column(Enum(*list(TriggerType.values()),
                                name='TriggerTypeEnumType'),
@@ -351,11 +402,74 @@ class Job(db.Model):
         "PipelineRun",
         overlaps='job',
         foreign_keys=[pipeline_run_id])
+    workflow_definition_hash = Column(
+        String(64),
+        ForeignKey("content_blob.hash",
+                   name="fk_job_workflow_definition_hash"),
+        index=True)
+    workflow_definition_blob = relationship(
+        "ContentBlob",
+        foreign_keys=[workflow_definition_hash])
+    source_code_hash = Column(
+        String(64),
+        ForeignKey("content_blob.hash",
+                   name="fk_job_source_code_hash"),
+        index=True)
+    source_code_blob = relationship(
+        "ContentBlob",
+        foreign_keys=[source_code_hash])
     steps = relationship("JobStep",
                          cascade="all, delete-orphan")
     results = relationship("JobResult",
                            cascade="all, delete-orphan")
 
+    @property
+    def workflow_definition(self):
+        return self._get_content('workflow_definition')
+
+    @workflow_definition.setter
+    def workflow_definition(self, value):
+        self._set_content('workflow_definition', value)
+
+    @property
+    def source_code(self):
+        return self._get_content('source_code')
+
+    @source_code.setter
+    def source_code(self, value):
+        self._set_content('source_code', value)
+
+    def _get_content(self, name):
+        content_hash = getattr(self, f'{name}_hash')
+        if content_hash is None:
+            return getattr(self, f'_{name}')
+        pending = self.__dict__.get('_pending_contents', {})
+        if content_hash in pending:
+            return pending[content_hash]
+        blob = getattr(self, f'{name}_blob')
+        return blob.text if blob is not None else None
+
+    def _set_content(self, name, value):
+        # Blob is created (if it does not exist) when the job is flushed
+        content_hash = None
+        if value is not None:
+            content_hash = ContentBlob.get_hash(value)
+            self.__dict__.setdefault('_pending_contents', {})[
+                content_hash] = value
+        setattr(self, f'{name}_hash', content_hash)
+        setattr(self, f'_{name}', None)
+
+    def _get_new_contents(self):
+        """ Returns contents (hash -> text) set since the last flush """
+        pending = self.__dict__.get('_pending_contents')
+        if not pending:
+            return {}
+        state = inspect(self)
+        return {content_hash: pending[content_hash]
+                for name in ['workflow_definition_hash', 'source_code_hash']
+                for content_hash in state.attrs[name].history.added or ()
+                if content_hash in pending}
+
     def __str__(self):
         return self.name
 
@@ -363,6 +477,31 @@ class Job(db.Model):
         return '<Instance {}: {}>'.format(self.__class__, self.id)
 
 
+class JobArchive(db.Model):
+    """ A job (with steps, logs and results) moved out of job table """
+    __tablename__ = 'job_archive'
+
+    # Fields
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    created = Column(DateTime, nullable=False)
+    archived = Column(DateTime,
+                      default=func.now(), nullable=False)
+    status = Column(Enum(*list(StatusExecution.values()),
+                         name='StatusExecutionEnumType'), nullable=False)
+    workflow_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    encoding = Column(String(50))
+    content = Column(LargeBinary(4294000000))
+    content_ref = Column(String(500))
+
+    def __str__(self):
+        return str(self.id)
+
+    def __repr__(self):
+        return '<Instance {}: {}>'.format(self.__class__, self.id)
+
+
 class JobResult(db.Model):
     """ Result of a job """
     __tablename__ = 'job_result'
@@ -375,6 +514,10 @@ class JobResult(db.Model):
     type = Column(Enum(*list(ResultType.values()),
                        name='ResultTypeEnumType'), nullable=False)
     content = Column(Text(4294000000))
+    content_ref = Column(String(500))
+    content_size = Column(Integer)
+    content_hash = Column(String(64))
+    content_encoding = Column(String(50))
 
     # Associations
     job_id = Column(
@@ -437,6 +580,9 @@ class JobStep(db.Model):
 class JobStepLog(db.Model):
     """ Log of task execution as a step in the job """
     __tablename__ = 'job_step_log'
+    __table_args__ = (
+        Index('ix_job_step_log_step_id_id', 'step_id', 'id'),
+    )
 
     # Fields
     id = Column(Integer, primary_key=True)
@@ -628,3 +774,45 @@ class RoomParticipant(db.Model):
     def __repr__(self):
         return '<Instance {}: {}>'.format(self.__class__, self.id)
 
+
+
+def _insert_ignoring_duplicates(connection, table, rows):
+    """ Inserts rows, ignoring the ones whose primary key already exists
+    (e.g. inserted meanwhile by a concurrent transaction) """
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        key = table.primary_key.columns.values()[0].name
+        connection.execute(stmt.on_duplicate_key_update(
+            {key: stmt.inserted[key]}), rows)
+    elif dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        connection.execute(insert(table).on_conflict_do_nothing(), rows)
+    else:
+        for row in rows:
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert(), row)
+            except IntegrityError:
+                pass
+
+
+@event.listens_for(Session, 'before_flush')
+def _add_content_blobs(session, flush_context, instances):
+    """ Stores contents set in jobs, if not stored yet """
+    contents = {}
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, Job):
+            contents.update(obj._get_new_contents())
+    if not contents:
+        return
+    with session.no_autoflush:
+        existing = {content_hash for (content_hash,) in session.query(
+            ContentBlob.hash).filter(ContentBlob.hash.in_(list(contents)))}
+    # Jobs created at the same time may store the same new content
+    rows = [ContentBlob.values_from_text(text)
+            for content_hash, text in contents.items()
+            if content_hash not in existing]
+    if rows:
+        _insert_ignoring_duplicates(session.connection(),
+                                    ContentBlob.__table__, rows)
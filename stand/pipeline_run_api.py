@@ -10,7 +10,7 @@ from flask_restful import Resource
 from marshmallow import Schema, fields
 from sqlalchemy import and_, func, or_
 
-from stand.services import ServiceException
+from stand.services import ServiceException, ServiceUnavailableException
 from stand.app_auth import requires_auth
 from stand.models import Job, PipelineRun, PipelineStepRun, db
 from stand.models_extra import Period
@@ -27,6 +27,9 @@ from stand.services.pipeline_run_service import (
     get_pipeline_from_api,
     change_pipeline_run_status
 )
+from stand.services.query_service import apply_projection
+from stand.services.version_service import (COLLECTION, JOB, PIPELINE_RUN,
+                                            conditional_get)
 
 log = logging.getLogger(__name__)
 # region Protected\s*
@@ -96,6 +99,12 @@ class PipelineRunListApi(Resource):
         :return: A JSON object containing the list of PipelineRun instances data.
         :rtype: dict
         """
+        # Runs include their jobs
+        not_modified = conditional_get((PIPELINE_RUN, COLLECTION),
+                                       (JOB, COLLECTION))
+        if not_modified is not None:
+            return not_modified
+
         if request.args.get("fields"):
             only = [f.strip() for f in request.args.get("fields").split(",")]
         else:
@@ -104,7 +113,9 @@ class PipelineRunListApi(Resource):
                 if request.args.get("simple", "false") == "true"
                 else None
             )
-        pipeline_runs = _get_pipeline_runs_query()
+        pipeline_runs = apply_projection(
+            _get_pipeline_runs_query(), PipelineRun,
+            PipelineRunListResponseSchema, only)
 
         pipelines_filter = request.args.get("pipelines")
         if pipelines_filter:
@@ -219,6 +230,11 @@ class PipelineRunDetailApi(Resource):
                 pipeline_run_id,
             )
 
+        not_modified = conditional_get((PIPELINE_RUN, pipeline_run_id),
+                                       (JOB, COLLECTION))
+        if not_modified is not None:
+            return not_modified
+
         pipeline_run = PipelineRun.query.get(pipeline_run_id)
         return_code = HTTPStatus.OK
         if pipeline_run is not None:
@@ -343,9 +359,15 @@ class PipelineRunFromPipelineApi(Resource):
         ):
             params = CreatePipelineRunSchema().load(request.json)
             config = current_app.config["STAND_CONFIG"]
-            pipeline, _ = get_pipeline_from_api(
-                config.get("services").get("tahiti"), params.get("id")
-            )
+            try:
+                pipeline, _ = get_pipeline_from_api(
+                    config.get("services").get("tahiti"), params.get("id")
+                )
+            except ServiceUnavailableException as se:
+                return {
+                    'status': 'ERROR',
+                    'message': str(se)
+                }, 503
             try:
                 run = create_pipeline_run_from_pipeline(
                     pipeline, Period(params.get("start"), params.get("finish"))
@@ -477,11 +499,18 @@ class ExecutePipelineRunStepApi(Resource):
             and request.json is not None
         ):
             params = self.ExecutePipelineRunSchema().load(request.json)
-            pipeline_run, job = execute_pipeline_step_run(
-                current_app.config["STAND_CONFIG"].get("services").get("tahiti"),
-                params.get("id"),
-                flask_g.user,
-            )
+            try:
+                pipeline_run, job = execute_pipeline_step_run(
+                    current_app.config["STAND_CONFIG"].get("services").get(
+                        "tahiti"),
+                    params.get("id"),
+                    flask_g.user,
+                )
+            except ServiceUnavailableException as se:
+                return {
+                    "status": "ERROR",
+                    "message": str(se),
+                }, 503
             if pipeline_run is not None:
                 response_schema = PipelineStepRunItemResponseSchema()
                 return {
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Archival worker. Moves old finished jobs (with their steps, logs and
+results) from the job tables to the archive, keeping them small. Run it
+periodically (e.g. cron) or with --interval to keep it running.
+"""
+import argparse
+import logging
+import time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str,
+                        help="Config file", required=True)
+    parser.add_argument("--interval", type=int, required=False,
+                        help="Run every interval seconds (default: once)")
+    parser.add_argument("--max-batches", type=int, required=False,
+                        help="Maximum number of batches per run")
+    args = parser.parse_args()
+
+    from stand.factory import create_app
+    from stand.services.archive_service import (archive_jobs,
+                                                get_archive_config)
+
+    app = create_app(config_file=args.config)
+    log = logging.getLogger('stand.archiver')
+    with app.app_context():
+        config = get_archive_config()
+        while True:
+            total = archive_jobs(config, max_batches=args.max_batches)
+            log.info('%s job(s) archived', total)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
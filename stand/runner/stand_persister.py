@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistence worker. Consumes events sent by executors from a Redis Stream
+and updates the database. Used when Stand is configured with
+`emit.persistence: stream`, so the Socket.IO servers only fan out messages.
+Start as many workers as needed, they share the partitions of the stream
+(each partition is consumed by a single worker at a time).
+Write-behind (emit.write_behind) is not used: events are acknowledged only
+after being committed, so they are never lost if a worker dies.
+"""
+import argparse
+import gettext
+
+import eventlet
+import os
+
+locales_path = os.path.join(os.path.dirname(__file__), '..', 'i18n', 'locales')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str,
+                        help="Config file", required=True)
+    parser.add_argument("--name", type=str, required=False,
+                        help="Consumer name (default: <hostname>-<pid>)")
+    parser.add_argument("--lang", help="Minion messages language (i18n)",
+                        required=False, default="en_US")
+    args = parser.parse_args()
+
+    eventlet.monkey_patch(all=True)
+
+    import socketio
+    from redis import StrictRedis
+    from stand.factory import create_app
+    from stand.services.emit_service import EmitService
+    from stand.services.event_stream_service import (
+        EventStreamConsumer, get_event_stream_config)
+    from stand.services.job_metadata_cache import \
+        configure_job_metadata_cache
+
+    t = gettext.translation('messages', locales_path, [args.lang],
+                            fallback=True)
+    t.install()
+
+    app = create_app(config_file=args.config)
+    stand_config = app.config['STAND_CONFIG']
+    redis_url = stand_config['servers']['redis_url']
+
+    redis_conn = StrictRedis.from_url(redis_url, decode_responses=True)
+    # Notifications are sent to Socket.IO servers through Redis
+    mgr = socketio.RedisManager(redis_url, 'job_output', write_only=True)
+
+    configure_job_metadata_cache(stand_config)
+    emit_service = EmitService(
+        app, redis_conn,
+        notify=lambda event, data, namespace, room: mgr.emit(
+            event, data, namespace=namespace, room=room))
+    consumer = EventStreamConsumer(
+        redis_conn, emit_service, get_event_stream_config(stand_config),
+        args.name)
+    try:
+        consumer.run()
+    finally:
+        # Partitions are taken by other workers without waiting the lease
+        consumer.stop()
@@ -6,6 +6,7 @@ from marshmallow import Schema, fields, post_load, post_dump, EXCLUDE, INCLUDE
 from marshmallow.validate import OneOf
 from flask_babel import gettext
 from .models import *
+from .services.result_store import read_result_content
 
 
 def partial_schema_factory(schema_cls):
@@ -643,10 +644,13 @@ class JobStatusRequestSchema(BaseSchema):
 
 class JobResultItemResponseSchema(BaseSchema):
     """ JSON serialization schema """
+    id = fields.Integer(required=True)
     title = fields.String(required=False, allow_none=True)
     type = fields.String(required=True,
                          validate=[OneOf(ResultType.values())])
-    content = fields.String(required=False, allow_none=True)
+    content = fields.Function(lambda x: read_result_content(x))
+    content_size = fields.Integer(required=False, allow_none=True)
+    content_hash = fields.String(required=False, allow_none=True)
     task = fields.Function(lambda x: {"id": x.task_id})
     operation = fields.Function(lambda x: {"id": x.operation_id})
 
@@ -668,7 +672,7 @@ class JobResultListResponseSchema(BaseSchema):
     title = fields.String(required=False, allow_none=True)
     type = fields.String(required=True,
                          validate=[OneOf(ResultType.values())])
-    content = fields.String(required=False, allow_none=True)
+    content = fields.Function(lambda x: read_result_content(x))
 
     # noinspection PyUnresolvedReferences
     @post_load
@@ -786,6 +790,11 @@ class JobStepLogListResponseSchema(BaseSchema):
         unknown = EXCLUDE
 
 
+class JobStepLogTaskListResponseSchema(JobStepLogListResponseSchema):
+    """ JSON serialization schema, including the task of the log """
+    task = fields.Function(lambda x: {"id": x.step.task_id})
+
+
 class JobStepLogItemResponseSchema(BaseSchema):
     """ JSON serialization schema """
     id = fields.Integer(required=True)
@@ -1,3 +1,7 @@
 
 class ServiceException(Exception):
     pass
+
+
+class ServiceUnavailableException(ServiceException):
+    """ A service used by Stand (e.g. Tahiti) is not available """
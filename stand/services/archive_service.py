@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-}
+import datetime
+import json
+import logging
+import os
+import zlib
+
+from flask import current_app
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import selectinload
+from sqlalchemy.types import DateTime
+from stand.models import (Cluster, Job, JobArchive, JobResult, JobStep,
+                          JobStepLog, StatusExecution, db)
+from stand.services.version_service import JOB, track_changes
+from stand.util import write_file
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_CONFIG = {
+    # Finished jobs created more than max_age days ago are archived
+    'max_age': 180,
+    # Jobs moved per transaction
+    'batch_size': 100,
+    # database: archived jobs are kept (compressed) in job_archive table
+    # filesystem: they are stored in files under `path`
+    'type': 'database',
+    'path': '/var/lib/stand/archive',
+}
+
+ZLIB = 'zlib'
+
+FINAL_STATUSES = [StatusExecution.COMPLETED, StatusExecution.ERROR,
+                  StatusExecution.CANCELED, StatusExecution.INTERRUPTED]
+
+# Columns not archived (contents are archived by their properties)
+_JOB_EXCLUDED = {'_workflow_definition', '_source_code',
+                 'workflow_definition_hash', 'source_code_hash'}
+
+
+def get_archive_config(stand_config=None):
+    """ Returns archive configuration, using defaults for missing values """
+    if stand_config is None:
+        stand_config = current_app.config['STAND_CONFIG']
+    result = dict(DEFAULT_ARCHIVE_CONFIG)
+    result.update(stand_config.get('archive', {}) or {})
+    return result
+
+
+def _dump_columns(obj, exclude=()):
+    result = {}
+    for attr in inspect(obj).mapper.column_attrs:
+        if attr.key not in exclude:
+            value = getattr(obj, attr.key)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            result[attr.key] = value
+    return result
+
+
+def _load_columns(model, data):
+    mapper = inspect(model)
+    values = {}
+    for key, value in data.items():
+        attr = mapper.column_attrs.get(key)
+        if attr is None:
+            continue
+        if value is not None and isinstance(attr.columns[0].type, DateTime):
+            value = datetime.datetime.fromisoformat(value)
+        values[key] = value
+    return model(**values)
+
+
+def dump_job(job):
+    """ Returns a job, its steps (with logs) and results as a dict """
+    data = _dump_columns(job, _JOB_EXCLUDED)
+    data['workflow_definition'] = job.workflow_definition
+    data['source_code'] = job.source_code
+    data['steps'] = [dict(_dump_columns(step),
+                          logs=[_dump_columns(entry) for entry in step.logs])
+                     for step in job.steps]
+    # Result contents stored in files (see result_store) are kept there
+    data['results'] = [_dump_columns(result) for result in job.results]
+    return data
+
+
+def load_job(data):
+    """ Returns a (transient) job from a dict returned by dump_job """
+    data = dict(data)
+    steps = data.pop('steps', [])
+    results = data.pop('results', [])
+    job = _load_columns(Job, data)
+    # Contents are read from the old columns, no blob is created
+    job._workflow_definition = data.get('workflow_definition')
+    job._source_code = data.get('source_code')
+    job.steps = []
+    for step_data in steps:
+        step = _load_columns(JobStep, step_data)
+        step.logs = [_load_columns(JobStepLog, entry)
+                     for entry in step_data.get('logs', [])]
+        job.steps.append(step)
+    job.results = [_load_columns(JobResult, r) for r in results]
+    return job
+
+
+def _create_archive(job, config):
+    data = json.dumps(dump_job(job)).encode('utf8')
+    archive = JobArchive(id=job.id, created=job.created, status=job.status,
+                         workflow_id=job.workflow_id, user_id=job.user_id,
+                         size=len(data), encoding=ZLIB)
+    compressed = zlib.compress(data)
+    if config['type'] == 'filesystem':
+        archive.content_ref = os.path.join(str(job.id // 10000),
+                                           f'{job.id}.json.{ZLIB}')
+        write_file(os.path.join(config['path'], archive.content_ref),
+                   compressed)
+    else:
+        archive.content = compressed
+    return archive
+
+
+def read_archive(archive, config=None):
+    """ Returns the content of an archived job (see dump_job) """
+    if archive.content_ref:
+        config = config or get_archive_config()
+        with open(os.path.join(config['path'], archive.content_ref),
+                  'rb') as f:
+            compressed = f.read()
+    else:
+        compressed = archive.content
+    return json.loads(zlib.decompress(compressed).decode('utf8'))
+
+
+def get_archived_job(archive, config=None):
+    """ Returns an archived job as a (transient) Job, with its steps, logs
+    and results. It must not be added to a session. """
+    job = load_job(read_archive(archive, config))
+    job.cluster = Cluster.query.get(job.cluster_id)
+    return job
+
+
+def archive_jobs(config=None, now=None, max_batches=None):
+    """
+    Moves finished jobs older than config['max_age'] days (and their steps,
+    logs and results) to the archive, in batches of config['batch_size']
+    jobs, each one in its own transaction. Returns the number of jobs
+    archived. Requires an application context.
+    """
+    config = config or get_archive_config()
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=config['max_age'])
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        jobs = Job.query.filter(
+            Job.created < cutoff, Job.status.in_(FINAL_STATUSES)).order_by(
+            Job.id).options(selectinload(Job.steps).selectinload(
+                JobStep.logs), selectinload(Job.results)).limit(
+            config['batch_size']).all()
+        if not jobs:
+            break
+        try:
+            db.session.add_all([_create_archive(job, config)
+                                for job in jobs])
+            db.session.flush()
+
+            # Set-based deletes, instead of one statement per row
+            ids = [job.id for job in jobs]
+            db.session.expunge_all()
+            step_ids = select(JobStep.id).where(JobStep.job_id.in_(ids))
+            JobStepLog.query.filter(JobStepLog.step_id.in_(
+                step_ids)).delete(synchronize_session=False)
+            for model, column in [(JobStep, JobStep.job_id),
+                                  (JobResult, JobResult.job_id),
+                                  (Job, Job.id)]:
+                model.query.filter(column.in_(ids)).delete(
+                    synchronize_session=False)
+            track_changes(JOB, ids, deleted=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        total += len(ids)
+        batches += 1
+        log.info('Archived %s job(s) (%s to %s)', len(ids), ids[0], ids[-1])
+    return total
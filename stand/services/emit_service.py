@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-}
+import datetime
+import json
+import logging
+import threading
+
+from flask_babel import gettext
+from sqlalchemy import event as sa_event, func
+from sqlalchemy.engine import Engine
+from stand.models import db, Job, JobStep, JobStepLog, StatusExecution as EXEC, \
+    JobResult
+from stand.services.job_metadata_cache import job_metadata_cache
+from stand.services.metrics_service import registry
+from stand.services.pipeline_run_service import update_pipeline_run
+from stand.services.result_store import (get_result_store_config,
+                                         store_result_content)
+from stand.services.room_cache_service import (cache_room_messages,
+                                               get_room_cache_config)
+from stand.services.version_service import JOB, track_changes
+
+log = logging.getLogger(__name__)
+
+# Events that change the state of jobs and must be persisted
+PERSISTENT_EVENTS = ('update job', 'update task', 'user message',
+                     'task result')
+FINAL_STATES = [EXEC.COMPLETED, EXEC.CANCELED, EXEC.ERROR]
+
+# Metrics of the emit hook, labeled by event
+EMIT_SECONDS = registry.histogram(
+    'stand_emit_seconds', 'Total time handling an event')
+EMIT_DB_SECONDS = registry.histogram(
+    'stand_emit_db_seconds', 'Time persisting an event')
+EMIT_REDIS_SECONDS = registry.histogram(
+    'stand_emit_redis_seconds', 'Time caching or publishing an event')
+EMIT_EVENTS = registry.counter(
+    'stand_emit_events_total', 'Events handled')
+EMIT_BYTES = registry.counter(
+    'stand_emit_bytes_total', 'Size of the messages in events')
+EMIT_DB_STATEMENTS = registry.counter(
+    'stand_emit_db_statements_total', 'Statements executed persisting events')
+EMIT_DB_ROWS = registry.counter(
+    'stand_emit_db_rows_total', 'Rows changed persisting events')
+
+# Statements executed by the current thread (greenlet) while persisting
+_statement_stats = threading.local()
+
+
+@sa_event.listens_for(Engine, 'after_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    stats = getattr(_statement_stats, 'current', None)
+    if stats is not None:
+        stats['statements'] += 1
+        if not statement.lstrip()[:6].upper() == 'SELECT':
+            stats['rows'] += max(cursor.rowcount, 0)
+
+
+class EmitService:
+    """
+    Updates the database with the information sent by executors through
+    Socket.IO events (job and task statuses, logs and results).
+    Used by the emit hook installed in Socket.IO server and by persistence
+    workers consuming events from a Redis Stream.
+    """
+
+    def __init__(self, app, redis_store, log_buffer=None, notify=None,
+                 metadata_cache=None):
+        self.app = app
+        self.redis_store = redis_store
+        self.log_buffer = log_buffer
+        # Avoids loading job and steps for each message
+        self.metadata_cache = (metadata_cache if metadata_cache is not None
+                               else job_metadata_cache)
+        # Callable used to send notifications to other rooms, with the same
+        # signature of socketio.Server.emit(event, data, namespace, room)
+        self.notify = notify
+        self.room_cache_config = get_room_cache_config(
+            app.config['STAND_CONFIG'])
+        self.result_store_config = get_result_store_config(
+            app.config['STAND_CONFIG'])
+
+    def _gettext(self, title):
+        with self.app.request_context(
+                {'wsgi.url_scheme': "", 'SERVER_PORT': "", 'SERVER_NAME': "",
+                 'REQUEST_METHOD': ""}):
+            return gettext(title)
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().strftime('%Y-%m-%dT%H:%m:%S')
+
+    def enrich(self, event, data):
+        """
+        Fills the fields expected by clients without accessing the
+        database. Used when persistence is done by another process.
+        """
+        if event == 'update job':
+            if data.get('status') in FINAL_STATES:
+                data['finished'] = datetime.datetime.utcnow().strftime(
+                    '%Y-%m-%dT%H:%m:%S')
+        elif event in ('update task', 'user message'):
+            if data.get('level') is None:
+                data['level'] = ('WARN' if data.get('status') == EXEC.ERROR
+                                 else 'INFO')
+            data['date'] = self._now()
+            data['type'] = data.get('type', 'TEXT') or 'TEXT'
+            data['task'] = {'id': data.get('id')}
+            # Log is not persisted yet, so it has no id
+            data['id'] = None
+
+    def handle(self, event, data, namespace, room, notify=None):
+        """ Persists the information in the event, logging errors. """
+        logger = logging.getLogger(__name__)
+        try:
+            self.persist(event, data, namespace, room, notify)
+        except Exception as ex:
+            logger.exception(ex)
+
+    def persist(self, event, data, namespace, room, notify=None):
+        """ Persists the information in the event. `data` may be changed in
+        order to include information generated by the database. """
+        stats = {'statements': 0, 'rows': 0}
+        _statement_stats.current = stats
+        try:
+            with EMIT_DB_SECONDS.time(event=event), self.app.app_context():
+                if event == 'update job':
+                    self._update_job(data, namespace, room,
+                                     notify or self.notify)
+                elif event == 'update task' or event == 'user message':
+                    self._update_task(event, data, room)
+                elif event == 'task result':
+                    self._add_result(data, room)
+        finally:
+            _statement_stats.current = None
+            EMIT_DB_STATEMENTS.inc(stats['statements'], event=event)
+            EMIT_DB_ROWS.inc(stats['rows'], event=event)
+
+    def _update_job(self, data, namespace, room, notify):
+        logger = logging.getLogger(__name__)
+        now = self._now()
+        redis_store = self.redis_store
+        status = data.get('status')
+        if status is None:
+            raise ValueError('Status not provided!')
+        job_id = int(room)
+        if self.log_buffer is not None and status in FINAL_STATES:
+            # Steps statuses must be up to date before
+            # finishing the job
+            self.log_buffer.flush()
+        #logger.info(_gettext('Updating job id=%s'), job_id)
+        if not self.metadata_cache.get(job_id).persistent:
+            logger.info(gettext("Job %s is not persistent."), job_id)
+            return
+        if status in FINAL_STATES:
+            # No more messages are expected for the job
+            self.metadata_cache.invalidate(job_id)
+        job: Job = Job.query.get(job_id)
+        if job is not None:
+            final_states = FINAL_STATES
+            job.status = status
+            logger.info(self._gettext('Updating job id=%s to status %s'),
+                job_id, job.status)
+            job.status_text = data.get('msg',
+                                       data.get('message', ''))
+            job.exception_stack = data.get('exception_stack')
+            if job.status in final_states:
+                job.finished = datetime.datetime.utcnow()
+                data['finished'] = job.finished.strftime(
+                    '%Y-%m-%dT%H:%m:%S')
+            # Update Job Step status. Steps are updated with set-based
+            # statements, because jobs may have hundreds of tasks.
+            cached_messages = []
+            if job_id > 0 and job.status == EXEC.COMPLETED:
+                JobStep.query.filter(
+                    JobStep.job_id == job_id,
+                    JobStep.status == EXEC.PENDING).update(
+                    {'status': EXEC.COMPLETED}, synchronize_session=False)
+            elif job.status == EXEC.ERROR:
+                # Something went wrong, record the cause
+                cached_messages = self._cancel_steps_by_error(
+                    job_id, data, namespace, now)
+            elif job_id > 0 and job.status == EXEC.CANCELED:
+                JobStep.query.filter(
+                    JobStep.job_id == job_id,
+                    JobStep.status.notin_(final_states)).update(
+                    {'status': EXEC.CANCELED}, synchronize_session=False)
+
+            logger.info('Is job associated to pipeline run? %s',
+                     f'Yes, {job.pipeline_step_run.id}' if
+                     job.pipeline_step_run is not None else 'No')
+            if (job.pipeline_step_run):
+                update_pipeline_run(job)
+                notification_msg = {
+                    'date': datetime.datetime.utcnow().isoformat(),
+                    'pipeline_run': {
+                        'id': job.pipeline_run.id,
+                        'status': job.pipeline_run.status,
+                    },
+                    'pipeline_step_run': {
+                        'id': job.pipeline_step_run.id,
+                        'status': job.pipeline_step_run.status,
+                        'order': job.pipeline_step_run.order
+                    },
+                    'job': {
+                        'id': job.id,
+                        'status': job.status,
+                    },
+                    'message': data.get('message')
+                }
+                log.info('Notify room pipeline_runs: %s', notification_msg)
+                if notify is not None:
+                    notify('update pipeline run', notification_msg,
+                           namespace, 'pipeline_runs')
+            db.session.add(job)
+            db.session.commit()
+            # Indicate to the client steps changed by the error
+            cache_room_messages(redis_store, self.room_cache_config, room,
+                                cached_messages)
+        else:
+            logger.info(gettext("Job %s is not persistent."), job_id)
+
+    def _cancel_steps_by_error(self, job_id, data, namespace, now):
+        """
+        Records the error in the log of all steps and changes the status of
+        the unfinished ones, without committing. Returns the messages that
+        must be stored for the client.
+        """
+        steps = db.session.query(
+            JobStep.id, JobStep.task_id, JobStep.status).filter(
+            JobStep.job_id == job_id).all()
+        if not steps:
+            return []
+        level = data.get('level', 'ERROR')
+        canceled_msg = self._gettext('Canceled by error')
+        log_ids = {}
+        if job_id > 0:
+            # Used to find the generated ids, precision is limited by
+            # some databases
+            date = datetime.datetime.now().replace(microsecond=0)
+            db.session.execute(JobStepLog.__table__.insert(), [
+                {'step_id': step_id, 'level': level, 'date': date,
+                 'status': status, 'type': data.get('type', 'TEXT'),
+                 'message': canceled_msg}
+                for step_id, _, status in steps])
+            log_ids = dict(db.session.query(
+                JobStepLog.step_id, func.max(JobStepLog.id)).filter(
+                JobStepLog.step_id.in_([step_id for step_id, _, _ in steps]),
+                JobStepLog.date == date).group_by(JobStepLog.step_id))
+
+            JobStep.query.filter(
+                JobStep.job_id == job_id,
+                JobStep.status == EXEC.RUNNING).update(
+                {'status': EXEC.ERROR}, synchronize_session=False)
+            JobStep.query.filter(
+                JobStep.job_id == job_id,
+                JobStep.status.notin_(FINAL_STATES)).update(
+                {'status': EXEC.CANCELED}, synchronize_session=False)
+
+        result = []
+        skipped_msg = self._gettext('Skiped by error')
+        for step_id, task_id, status in steps:
+            msg = {
+                'type': data.get('type', 'TEXT') or 'TEXT',
+                'task': {'id': task_id},
+                'id': log_ids.get(step_id),
+                'level': level,
+                'date': now,
+                'room': job_id
+            }
+            if status == EXEC.RUNNING:
+                msg['message'] = canceled_msg
+                msg['status'] = EXEC.ERROR
+            elif status not in FINAL_STATES:
+                msg['message'] = skipped_msg
+                msg['status'] = EXEC.CANCELED
+            else:
+                continue
+            result.append({'event': 'update task', 'data': msg,
+                           'namespace': namespace})
+        return result
+
+    def _update_task(self, event, data, room):
+        now = self._now()
+        log_buffer = self.log_buffer
+        job_id = int(room)
+        task_id = data.get('id')
+        metadata = self.metadata_cache.get(job_id)
+        step_id = metadata.get_step(task_id) if metadata.persistent else None
+        if step_id is not None:
+            # Status is required in database. If not informed, the current
+            # one is used (other processes may have changed it, so it is not
+            # cached).
+            new_status = data.get('status')
+            status = new_status or self._get_step_status(step_id)
+            level = data.get('level')
+            if level is None:
+                if status == EXEC.ERROR:
+                    level = 'WARN'
+                else:
+                    level = 'INFO'
+            data['date'] = now
+            step_log_msg = data.get('message', 'no message')
+            if isinstance(step_log_msg, dict):
+                step_log_msg = json.dumps(step_log_msg)
+
+            step_log_type = data.get('type', 'TEXT')
+            if event == 'user message':
+                step_log_type = 'USER'
+
+            # If job_id <= 0, it is internal and it is not persisted
+            persist = data.get('type') != 'SILENT' and job_id > 0
+            if log_buffer is not None:
+                if persist:
+                    log_buffer.add(
+                        step_id, status, level, step_log_type,
+                        step_log_msg, datetime.datetime.now(), job_id,
+                        change_status=bool(new_status))
+                # Log is persisted later, so it has no id
+                data['id'] = None
+            else:
+                # Step is not loaded, its status is updated directly
+                step_log = JobStepLog(
+                    step_id=step_id,
+                    level=level, date=datetime.datetime.now(),
+                    status=status,
+                    type=step_log_type,
+                    message=step_log_msg)
+                if persist:
+                    db.session.add(step_log)
+                    if new_status:
+                        JobStep.query.filter(JobStep.id == step_id).update(
+                            {'status': status}, synchronize_session=False)
+                    track_changes(JOB, [job_id], collection=False)
+                    db.session.commit()
+                data['id'] = step_log.id
+            data['type'] = data.get('type', 'TEXT') or 'TEXT'
+            data['level'] = level
+            data['task'] = {'id': task_id}
+
+    def _get_step_status(self, step_id):
+        status = None
+        if self.log_buffer is not None:
+            status = self.log_buffer.get_status(step_id)
+        if status is None:
+            status = db.session.query(JobStep.status).filter(
+                JobStep.id == step_id).scalar()
+        return status
+
+    def _add_result(self, data, room):
+        job_id = int(room)
+        if self.metadata_cache.get(job_id).persistent:
+            task_id = data.get('id')
+            op_id = data.get('operation_id')
+
+            content = data.get('message')
+            if isinstance(content, dict):
+                content = json.dumps(content)
+
+            result = JobResult(
+                job_id=job_id,
+                task_id=task_id,
+                operation_id=op_id,
+                type=data.get('type'),
+                title=data.get('title'))
+            store_result_content(result, content, self.result_store_config)
+            if job_id > 0:
+                db.session.add(result)
+                db.session.commit()
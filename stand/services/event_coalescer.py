@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-}
+import logging
+import threading
+import time
+
+from stand.services.metrics_service import registry
+
+log = logging.getLogger(__name__)
+
+COALESCED_EVENTS = registry.counter(
+    'stand_emit_coalesced_total', 'Events merged into other events')
+
+
+class TaskEventCoalescer:
+    """
+    Merges consecutive 'update task' events having the same status for the
+    same task (room, task id). The first event of a sequence is sent
+    immediately, the following ones received in the next `window` seconds
+    are held and then sent as a single event (the last one), informing how
+    many events were merged (`coalesced`) and the first merged message
+    (`first_message`). Status changes and warnings/errors are never held.
+    Held events are sent by calling `emit(server, event, data, namespace,
+    room)`.
+    """
+    EVENT = 'update task'
+    NOT_COALESCED_LEVELS = ('WARN', 'ERROR')
+
+    def __init__(self, window, emit):
+        self.window = window
+        self.emit = emit
+
+        # (room, task id) -> state of the current sequence of events
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._running = False
+
+    def add(self, server, data, namespace, room):
+        """
+        Registers an event. Returns False if the event was held (it must not
+        be sent by the caller).
+        """
+        key = (room, data.get('id'))
+        status = data.get('status')
+        now = time.time()
+        pending = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or entry['status'] != status
+                    or now - entry['started'] >= self.window
+                    or data.get('level') in self.NOT_COALESCED_LEVELS):
+                if entry is not None and entry['count']:
+                    pending = entry
+                self._entries[key] = {
+                    'status': status, 'started': now, 'count': 0,
+                    'first': None, 'last': None, 'server': server,
+                    'namespace': namespace, 'room': room}
+            else:
+                entry['count'] += 1
+                entry['first'] = entry['first'] or data
+                entry['last'] = data
+                return False
+        if pending is not None:
+            self._send(pending)
+        return True
+
+    def flush(self, room=None, expired_only=False):
+        """
+        Sends held events. If `room` is informed, only events of that room
+        are sent and the room is forgotten (e.g. the job has finished).
+        """
+        now = time.time()
+        pending = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if room is not None and key[0] != room:
+                    continue
+                expired = now - entry['started'] >= self.window
+                if expired_only and not expired:
+                    continue
+                if entry['count']:
+                    pending.append(dict(entry))
+                if room is not None or expired:
+                    del self._entries[key]
+        for entry in pending:
+            self._send(entry)
+
+    def _send(self, entry):
+        data = dict(entry['last'])
+        data['coalesced'] = entry['count']
+        data['first_message'] = entry['first'].get('message')
+        COALESCED_EVENTS.inc(entry['count'])
+        try:
+            self.emit(entry['server'], self.EVENT, data, entry['namespace'],
+                      entry['room'])
+        except Exception as ex:
+            log.exception(ex)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        """ Starts a background loop sending events held longer than the
+        window """
+        if self._running:
+            return
+        self._running = True
+        import eventlet
+        eventlet.spawn(self._run)
+
+    def _run(self):
+        import eventlet
+        while self._running:
+            eventlet.sleep(self.window)
+            self.flush(expired_only=True)
+
+    def stop(self):
+        self._running = False
+        self.flush()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-}
+import json
+import logging
+import math
+import os
+import socket
+import time
+import zlib
+
+from redis.exceptions import ResponseError, WatchError
+from stand.services.metrics_service import registry
+
+log = logging.getLogger(__name__)
+
+STREAM_LENGTH = registry.gauge(
+    'stand_event_stream_length',
+    'Events in a stream partition not persisted yet (approximate)')
+
+DEFAULT_STREAM_CONFIG = {
+    'name': 'stand_events',
+    'group': 'stand_persisters',
+    # Events are appended to one of `partitions` streams (<name>:<n>),
+    # chosen by job (room). Each partition is consumed by a single worker at
+    # a time, so the events of a job are persisted in the order they were
+    # sent. Workers share the partitions among them.
+    'partitions': 8,
+    # Time (ms) a worker keeps a partition without renewing it. Partitions
+    # of workers that died are taken by other ones after this time.
+    'lease': 30000,
+    # Events are removed from streams only after being persisted. A
+    # warning is logged when a partition has more events than this
+    # (persistence is not keeping up)
+    'warn_length': 100000,
+    # Number of events read in each XREADGROUP call
+    'batch_size': 100,
+    # Time (ms) blocked waiting for new events
+    'block': 1000,
+    # Time (ms) before retrying an event not persisted. Next events of its
+    # partition wait for it.
+    'retry_delay': 1000,
+    # Events failing more times than this are moved to the dead letter
+    # stream (<name>_dead)
+    'max_deliveries': 5,
+}
+
+
+def get_event_stream_config(stand_config):
+    """ Returns stream configuration, using defaults for missing values """
+    result = dict(DEFAULT_STREAM_CONFIG)
+    result.update(stand_config.get('emit', {}).get('stream', {}) or {})
+    return result
+
+
+def get_partition_stream(stream_config, room):
+    """ Returns the name of the stream (partition) of the events of a room
+    (job) """
+    try:
+        key = int(room)
+    except (TypeError, ValueError):
+        key = zlib.crc32(str(room).encode('utf8'))
+    return '{}:{}'.format(stream_config['name'],
+                          key % stream_config['partitions'])
+
+
+def publish_event(redis_store, stream_config, event, data, namespace, room):
+    """ Appends an event to the stream consumed by persistence workers """
+    redis_store.xadd(
+        get_partition_stream(stream_config, room),
+        {'event': event, 'namespace': namespace, 'room': room,
+         'data': json.dumps(data)})
+
+
+class EventStreamConsumer:
+    """
+    Consumes Socket.IO events from Redis Streams (partitions) and persists
+    them using EmitService. Many consumers (workers) can share the same
+    consumer group: each one owns some partitions (a lease renewed while
+    it is alive) and handles their events sequentially. An event is
+    acknowledged only after being handled, and the next events of its
+    partition are handled only after it, so events of a job are never
+    applied out of order, even when retried. Thus, emit_service must commit
+    changes before returning (no write-behind).
+    """
+
+    def __init__(self, redis_conn, emit_service, stream_config,
+                 consumer_name=None):
+        self.redis_conn = redis_conn
+        self.emit_service = emit_service
+        self.config = stream_config
+        self.group = stream_config['group']
+        self.consumer_name = consumer_name or \
+            f'{socket.gethostname()}-{os.getpid()}'
+        self.all_streams = ['{}:{}'.format(stream_config['name'], n)
+                            for n in range(stream_config['partitions'])]
+        # Partitions owned by this consumer
+        self.streams = []
+        self._workers_key = '{}:workers'.format(stream_config['name'])
+        self._renewed = 0
+        # Failures of events (entry id -> attempts)
+        self._failures = {}
+        # Last event acknowledged in each partition
+        self._acked = {}
+        self._running = False
+
+    def create_groups(self):
+        for stream in self.all_streams:
+            try:
+                self.redis_conn.xgroup_create(stream, self.group, id='0',
+                                              mkstream=True)
+            except ResponseError as re:
+                # Group already exists
+                if 'BUSYGROUP' not in str(re):
+                    raise
+
+    @staticmethod
+    def _owner_key(stream):
+        return f'{stream}:owner'
+
+    def _live_workers(self):
+        """ Registers this consumer as alive and returns the number of
+        consumers alive """
+        now = time.time()
+        self.redis_conn.hset(self._workers_key, self.consumer_name, now)
+        workers = self.redis_conn.hgetall(self._workers_key)
+        expired = [name for name, updated in workers.items()
+                   if now - float(updated) > self.config['lease'] / 1000.0]
+        if expired:
+            self.redis_conn.hdel(self._workers_key, *expired)
+        return max(len(workers) - len(expired), 1)
+
+    def _renew(self, stream):
+        """ Renews the lease of a partition, if it is owned by this
+        consumer """
+        key = self._owner_key(stream)
+        with self.redis_conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != self.consumer_name:
+                    return False
+                pipe.multi()
+                pipe.pexpire(key, self.config['lease'])
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    def _release(self, stream):
+        key = self._owner_key(stream)
+        with self.redis_conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) == self.consumer_name:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    def acquire_partitions(self):
+        """
+        Renews the leases of partitions owned by this consumer and takes
+        free ones, up to its share (partitions / consumers alive). Extra
+        partitions are released, to be taken by other consumers.
+        """
+        share = math.ceil(len(self.all_streams) / self._live_workers())
+        # Each consumer starts from a different partition
+        first = zlib.crc32(self.consumer_name.encode('utf8'))
+        owned = []
+        for i in range(len(self.all_streams)):
+            stream = self.all_streams[(first + i) % len(self.all_streams)]
+            if self._renew(stream):
+                if len(owned) < share:
+                    owned.append(stream)
+                else:
+                    self._release(stream)
+            elif len(owned) < share and self.redis_conn.set(
+                    self._owner_key(stream), self.consumer_name, nx=True,
+                    px=self.config['lease']):
+                # Events pending for the previous owner are handled first
+                self._claim_pending(stream)
+                owned.append(stream)
+        if owned != self.streams:
+            log.info('Consumer %s owns partitions %s', self.consumer_name,
+                     owned)
+        self.streams = owned
+        self._renewed = time.time()
+
+    def _claim_pending(self, stream):
+        start = '0-0'
+        while True:
+            response = self.redis_conn.xautoclaim(
+                stream, self.group, self.consumer_name, 0, start,
+                count=self.config['batch_size'], justid=True)
+            start = response[0]
+            if start in ('0-0', b'0-0'):
+                break
+
+    def process(self, stream, entries):
+        """
+        Handles and acknowledges a list of (id, fields) entries of a
+        partition, in order. Stops at the first event not handled, which is
+        retried before the next ones. Returns if all events were handled.
+        """
+        for entry_id, fields in entries:
+            if fields is None:
+                # Pending event removed from the stream
+                self.redis_conn.xack(stream, self.group, entry_id)
+                continue
+            event = fields.get('event')
+            try:
+                self.emit_service.persist(
+                    event, json.loads(fields.get('data', '{}')),
+                    fields.get('namespace'), fields.get('room'))
+            except Exception as ex:
+                log.exception(ex)
+                attempts = self._failures.get(entry_id, 0) + 1
+                if attempts < self.config['max_deliveries']:
+                    # Not acknowledged, it will be retried
+                    self._failures[entry_id] = attempts
+                    return False
+                log.error('Event %s moved to dead letter stream: %s',
+                          entry_id, fields)
+                self.redis_conn.xadd(f"{self.config['name']}_dead", fields)
+            self._failures.pop(entry_id, None)
+            self.redis_conn.xack(stream, self.group, entry_id)
+            self._acked[stream] = entry_id
+        return True
+
+    def trim(self, stream):
+        """
+        Removes events already persisted (acknowledged) from a partition.
+        Events pending or not read yet are never removed.
+        """
+        last_acked = self._acked.pop(stream, None)
+        if last_acked is None:
+            return
+        pending = self.redis_conn.xpending(stream, self.group)
+        min_id = pending['min'] if pending['pending'] else last_acked
+        # Approximate trimming never removes events after min_id
+        self.redis_conn.xtrim(stream, minid=min_id, approximate=True)
+        length = self.redis_conn.xlen(stream)
+        STREAM_LENGTH.set(length, partition=stream)
+        if length > self.config['warn_length']:
+            log.warning('Stream %s has %s events waiting to be persisted',
+                        stream, length)
+
+    def read(self):
+        """
+        Handles the events of owned partitions. Events pending (not
+        acknowledged) are handled first and partitions with pending events
+        do not receive new ones.
+        """
+        ready = []
+        failed = False
+        for stream in self.streams:
+            response = self.redis_conn.xreadgroup(
+                self.group, self.consumer_name, {stream: '0'},
+                count=self.config['batch_size'])
+            entries = response[0][1] if response else []
+            if not entries:
+                ready.append(stream)
+            elif not self.process(stream, entries):
+                failed = True
+            self.trim(stream)
+        if failed:
+            time.sleep(self.config['retry_delay'] / 1000.0)
+        if not ready:
+            return
+        response = self.redis_conn.xreadgroup(
+            self.group, self.consumer_name, {s: '>' for s in ready},
+            count=self.config['batch_size'], block=self.config['block'])
+        for stream, entries in response or []:
+            self.process(stream, entries)
+            self.trim(stream)
+
+    def run(self):
+        self.create_groups()
+        self._running = True
+        log.info('Consumer %s reading events from streams %s*',
+                 self.consumer_name, self.config['name'])
+        while self._running:
+            try:
+                if time.time() - self._renewed > \
+                        self.config['lease'] / 3000.0:
+                    self.acquire_partitions()
+                if self.streams:
+                    self.read()
+                else:
+                    time.sleep(self.config['block'] / 1000.0)
+            except Exception as ex:
+                log.exception(ex)
+                time.sleep(self.config['retry_delay'] / 1000.0)
+
+    def stop(self):
+        """ Stops the consumer, releasing its partitions """
+        self._running = False
+        for stream in self.streams:
+            self._release(stream)
+        self.redis_conn.hdel(self._workers_key, self.consumer_name)
+        self.streams = []
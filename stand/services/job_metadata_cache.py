@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-}
+import threading
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from stand.models import db, Job, JobStep
+
+
+@dataclass
+class JobMetadata:
+    """ Information about a job that does not change during its execution """
+    job_id: int
+    persistent: bool
+    # task_id -> step id (statuses change and are not cached)
+    steps: typing.Dict[str, int] = field(default_factory=dict)
+    pipeline_step_run_id: int = None
+    pipeline_run_id: int = None
+    loaded: float = 0.0
+
+    def get_step(self, task_id):
+        return self.steps.get(task_id)
+
+
+class JobMetadataCache:
+    """
+    In-process LRU cache of job metadata used by the emit hook, avoiding
+    queries for each message received from executors. Entries must be
+    invalidated when the job reaches a final state or is deleted.
+    Jobs not found in database (e.g. not persistent ones) are cached only
+    for `missing_ttl` seconds, because messages may be received before the
+    job is committed.
+    """
+
+    def __init__(self, max_size=1000, missing_ttl=10):
+        self.max_size = max_size
+        self.missing_ttl = missing_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_id) -> JobMetadata:
+        """ Returns job metadata, loading it from database if needed.
+        Requires an application context. """
+        with self._lock:
+            metadata = self._entries.get(job_id)
+            if metadata is not None:
+                if metadata.persistent or (time.time() - metadata.loaded <
+                                           self.missing_ttl):
+                    self._entries.move_to_end(job_id)
+                    return metadata
+                del self._entries[job_id]
+
+        metadata = self._load(job_id)
+        with self._lock:
+            self._entries[job_id] = metadata
+            self._entries.move_to_end(job_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return metadata
+
+    def invalidate(self, job_id):
+        with self._lock:
+            self._entries.pop(job_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _load(job_id) -> JobMetadata:
+        job = db.session.query(
+            Job.id, Job.pipeline_step_run_id, Job.pipeline_run_id).filter(
+            Job.id == job_id).first()
+        if job is None:
+            return JobMetadata(job_id=job_id, persistent=False,
+                               loaded=time.time())
+        steps = db.session.query(JobStep.task_id, JobStep.id).filter(
+            JobStep.job_id == job_id)
+        return JobMetadata(
+            job_id=job_id, persistent=True,
+            steps=dict(steps),
+            pipeline_step_run_id=job.pipeline_step_run_id,
+            pipeline_run_id=job.pipeline_run_id,
+            loaded=time.time())
+
+
+# Shared by all users in the process
+job_metadata_cache = JobMetadataCache()
+
+
+def configure_job_metadata_cache(stand_config):
+    """ Applies configuration (emit.metadata_cache) to the shared cache """
+    config = stand_config.get('emit', {}).get('metadata_cache', {}) or {}
+    job_metadata_cache.max_size = int(
+        config.get('max_size', job_metadata_cache.max_size))
+    job_metadata_cache.missing_ttl = float(
+        config.get('missing_ttl', job_metadata_cache.missing_ttl))
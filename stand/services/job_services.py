@@ -1,6 +1,7 @@
 import datetime
 import json
 import logging
+import time
 from gettext import gettext
 
 import requests
@@ -9,7 +10,9 @@ import stand.util
 from rq.exceptions import NoSuchJobError
 from stand.models import (
     JobStep, db, StatusExecution, JobException, JobType, Cluster)
-from stand.services.redis_service import connect_redis_store
+from stand.services.redis_service import connect_redis_store, redis_batch
+from stand.services.tahiti_service import get_tahiti_client
+from stand.services.version_service import JOB, get_version
 from stand.schema import ClusterItemResponseSchema
 
 logging.basicConfig(
@@ -19,6 +22,16 @@ logging.basicConfig(
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
+DEFAULT_SAMPLE_CONFIG = {
+    # Maximum time (s) a request waits for a sample
+    'max_wait': 30,
+    # While a request is in progress (at most request_ttl seconds),
+    # identical requests do not reach the executor again
+    'request_ttl': 60,
+    # Samples are cached until the job changes (at most cache_ttl seconds)
+    'cache_ttl': 600,
+}
+
 
 class JobService:
     def __init__(self, session, config):
@@ -35,14 +48,16 @@ class JobService:
         result = (True, '')
         tahiti_config = self.config.get('services', {}).get('tahiti', {})
         if all(['url' in tahiti_config, 'token' in tahiti_config]):
-            service_url = f"{tahiti_config['url']}/{job['workflow_id']}"
-            r = requests.get(service_url,
-                             headers={'X-Auth-Token': tahiti_config['token']})
-            if r.status_code == 200:
-                pass  # OK
-            else:
-                result = (False, r.text)
-                self.log.error('Error %d in tahiti: %s', r.status_code, r.text)
+            try:
+                get_tahiti_client(tahiti_config).get_workflow(
+                    job['workflow_id'])
+            except requests.exceptions.HTTPError as e:
+                result = (False, e.response.text)
+                self.log.error('Error %d in tahiti: %s',
+                               e.response.status_code, e.response.text)
+            except requests.exceptions.RequestException as e:
+                result = (False, str(e))
+                self.log.error('Error in tahiti: %s', e)
         else:
             msg = 'Invalid configuration (tahiti server address)'
             result = (False, msg)
@@ -76,20 +91,7 @@ class JobService:
         #         'Workflow is already being run by another job ({})'.format(
         #             jobs_running.id), JobException.ALREADY_RUNNING)
 
-        # Initial job status must be WAITING
-        job.status = StatusExecution.WAITING
-
-        if job_type == JobType.BATCH:
-            job.type = JobType.BATCH
-        elif workflow.get('publishing_status') in ['EDITING', 'PUBLISHED']:
-            job.type = JobType.APP
-
-        job.started = datetime.datetime.utcnow()
-        job.status_text = gettext('Job is allocating computer resources. '
-                                  'Please wait')
-
-        # Limit the name of a job
-        job.name = job.name[:50]
+        JobService._prepare(job, workflow, job_type)
         log.info("Persistent job: %s", persist)
         if persist:
             db.session.add(job)
@@ -107,16 +109,95 @@ class JobService:
                          for t in workflow.get('tasks', [])]
         log.info(gettext('Creating a total of {} step(s)').format(len(job.steps)))
 
+        redis_store = JobService._get_workflow_redis_store(workflow, testing)
+        JobService._check_cluster(job, workflow)
+
+        # Is job persisted in database? If so,
+        # its generated source code must be updated by Juicer
+        app_configs['persist'] = persist
+        app_configs['locale'] = lang or 'pt'
+        msg = JobService._get_start_message(job, workflow, app_configs)
+        with redis_batch(redis_store) as batch:
+            batch.rpush("queue_start", msg)
+            JobService._record_workflow_status(batch, job)
+
+        if persist:
+            db.session.commit()
+        else:
+            db.session.rollback()
+
+    @staticmethod
+    def start_many(jobs, workflow, app_configs_list, job_type=None,
+                   testing=False, lang=None):
+        """
+        Starts many (persistent) jobs of the same workflow, e.g. a parameter
+        sweep. Steps are inserted in bulk and all start messages are sent to
+        Juicer in a single round trip.
+        """
+        if not jobs:
+            return
+        for job in jobs:
+            JobService._prepare(job, workflow, job_type)
+            JobService._check_cluster(job, workflow)
+        db.session.add_all(jobs)
+        db.session.flush()  # Flush is needed to get the value of job.id
+
+        tasks = workflow.get('tasks', [])
+        if tasks:
+            now = datetime.datetime.utcnow()
+            db.session.execute(JobStep.__table__.insert(), [
+                {'date': now, 'status': StatusExecution.PENDING,
+                 'task_id': t['id'], 'task_name': t.get('name'),
+                 'operation_id': t['operation']['id'],
+                 'operation_name': t.get('name'), 'job_id': job.id}
+                for job in jobs for t in tasks])
+        log.info(gettext('Creating a total of {} job(s) with {} step(s)'
+                         ).format(len(jobs), len(tasks)))
+
+        redis_store = JobService._get_workflow_redis_store(workflow, testing)
+        messages = []
+        for job, app_configs in zip(jobs, app_configs_list):
+            app_configs = dict(app_configs or {}, persist=True,
+                               locale=lang or 'pt')
+            messages.append(
+                JobService._get_start_message(job, workflow, app_configs))
+        with redis_batch(redis_store) as batch:
+            batch.rpush("queue_start", *messages)
+            JobService._record_workflow_status(batch, jobs[0])
+
+        db.session.commit()
+
+    @staticmethod
+    def _prepare(job, workflow, job_type):
+        # Initial job status must be WAITING
+        job.status = StatusExecution.WAITING
+
+        if job_type == JobType.BATCH:
+            job.type = JobType.BATCH
+        elif workflow.get('publishing_status') in ['EDITING', 'PUBLISHED']:
+            job.type = JobType.APP
+
+        job.started = datetime.datetime.utcnow()
+        job.status_text = gettext('Job is allocating computer resources. '
+                                  'Please wait')
+
+        # Limit the name of a job
+        job.name = job.name[:50]
+
+    @staticmethod
+    def _get_workflow_redis_store(workflow, testing):
         # Test if workflow has a variable indicating the Redis db to be used.
         # Useful when debugging a shared environment
         redis_db = next((v for v in workflow.get('variables', [])
                          if v.get('name') == 'redis_db'), None)
         if redis_db is not None:
-            redis_store = JobService._get_redis_store(
+            return JobService._get_redis_store(
                 None, testing, db=int(redis_db.get('default_value')))
         else:
-            redis_store = JobService._get_redis_store(None, testing)
+            return JobService._get_redis_store(None, testing)
 
+    @staticmethod
+    def _check_cluster(job, workflow):
         # This queue is used to keep the order of execution and to know
         # what is pending
         if job.cluster is None:
@@ -130,6 +211,8 @@ class JobService:
                 gettext('Cluster {} is not enabled.').format(job.cluster.name),
                 JobException.CLUSTER_DISABLED)
 
+    @staticmethod
+    def _get_start_message(job, workflow, app_configs):
         cluster_properties = ['id', 'type', 'address', 'executors',
                               'executor_cores', 'executor_memory',
                               'auth_token', 'general_parameters']
@@ -137,33 +220,25 @@ class JobService:
         for p in cluster_properties:
             cluster_info[p] = getattr(job.cluster, p)
 
-        # Is job persisted in database? If so,
-        # its generated source code must be updated by Juicer
-        app_configs['persist'] = persist
-        app_configs['locale'] = lang or 'pt'
-        msg = json.dumps(dict(workflow_id=job.workflow_id,
-                              app_id=job.workflow_id,
-                              job_id=job.id,
-                              job_type=job.type,
-                              type='execute',
-                              cluster=cluster_info,
-                              app_configs=app_configs,
-                              workflow=workflow))
-        redis_store.rpush("queue_start", msg)
+        return json.dumps(dict(workflow_id=job.workflow_id,
+                               app_id=job.workflow_id,
+                               job_id=job.id,
+                               job_type=job.type,
+                               type='execute',
+                               cluster=cluster_info,
+                               app_configs=app_configs,
+                               workflow=workflow))
 
+    @staticmethod
+    def _record_workflow_status(batch, job):
         # This hash controls the status of job. Used for prevent starting
         # jobs in invalid states
         record_wf_id = f'record_workflow_{job.workflow_id}'
-        redis_store.hset(record_wf_id, 'status', job.status)
+        batch.hset(record_wf_id, 'status', job.status)
 
         # TTL=1h (sufficient time to other stages use the information)
-        redis_store.expire(record_wf_id, time=3600)
-        redis_store.expire(f'queue_app_{job.workflow_id}', time=3600)
-
-        if persist:
-            db.session.commit()
-        else:
-            db.session.rollback()
+        batch.expire(record_wf_id, time=3600)
+        batch.expire(f'queue_app_{job.workflow_id}', time=3600)
 
     @staticmethod
     def stop(job, ignore_if_stopped=False, job_id=None):
@@ -205,16 +280,18 @@ class JobService:
                         job_id=job.id,
                         cluster=ClusterItemResponseSchema().dump(cluster),
                         type='terminate'))
-                redis_store.rpush("queue_start", msg)
-
-                # # This hash controls the status of job. Used for prevent
-                # starting a canceled job be started by Juicer (FIXME: is it
-                # used?).
-                # redis_store.hset('record_workflow_{}'.format(job.workflow_id),
-                #                  'status', StatusExecution.CANCELED)
-                #
-                redis_store.hset('job_{}'.format(job.id),
-                                'status', StatusExecution.CANCELED)
+                with redis_batch(redis_store) as batch:
+                    batch.rpush("queue_start", msg)
+
+                    # # This hash controls the status of job. Used for prevent
+                    # starting a canceled job be started by Juicer (FIXME: is
+                    # it used?).
+                    # redis_store.hset(
+                    #     'record_workflow_{}'.format(job.workflow_id),
+                    #     'status', StatusExecution.CANCELED)
+                    #
+                    batch.hset('job_{}'.format(job.id),
+                               'status', StatusExecution.CANCELED)
 
                 db.session.commit()
             elif job.status in valid_end_status and not ignore_if_stopped:
@@ -255,22 +332,76 @@ class JobService:
             return None
 
     @staticmethod
-    def retrieve_sample(user, job, task_id, port_name, wait):
-        # DELIVER messages request the delivery of a result (task_id)
+    def get_sample_key(job, task_id, port_name):
+        """ Identifies requests for the same sample """
+        return f'{job.id}_{task_id}_{port_name}'
+
+    @staticmethod
+    def retrieve_sample(user, job, task_id, port_name, wait, config=None):
+        """
+        Requests a sample of the data in a task port to the executor and
+        waits at most `wait` seconds (0 does not wait) for it. Returns None
+        if the sample is not available yet: the request remains in progress
+        and the sample is returned by a subsequent call.
+        """
+        config = dict(DEFAULT_SAMPLE_CONFIG, **(config or {}))
         redis_store = JobService._get_redis_store(None)
-        output = 'queue_delivery_app_{app_id}_{port_name}'.format(
-            app_id=job.workflow_id, port_name=port_name)
-        msg = json.dumps({
-            'workflow_id': job.workflow_id,
-            'app_id': job.workflow_id,
-            'job_id': job.id,
-            'type': 'deliver',
-            'task_id': task_id,
-            'output': output,
-            'port': port_name
-        })
-        redis_store.rpush("queue_start", msg)
-        return json.loads(redis_store.blpop(output)[1])
+        key = JobService.get_sample_key(job, task_id, port_name)
+        cache_key = f'sample_cache_job_{job.id}'
+        field = f'{task_id}_{port_name}'
+        version = get_version(JOB, job.id)
+
+        sample = JobService._get_cached_sample(redis_store, cache_key, field,
+                                               version)
+        if sample is not None:
+            return sample
+
+        output = 'queue_delivery_app_{app_id}_{port_name}_{key}'.format(
+            app_id=job.workflow_id, port_name=port_name, key=key)
+        request_key = f'sample_request_{key}'
+        if redis_store.set(request_key, 1, nx=True,
+                           ex=config['request_ttl']):
+            # DELIVER messages request the delivery of a result (task_id)
+            msg = json.dumps({
+                'workflow_id': job.workflow_id,
+                'app_id': job.workflow_id,
+                'job_id': job.id,
+                'type': 'deliver',
+                'task_id': task_id,
+                'output': output,
+                'port': port_name
+            })
+            redis_store.rpush("queue_start", msg)
+
+        deadline = time.time() + min(wait, config['max_wait'])
+        while True:
+            if deadline - time.time() >= 1:
+                item = redis_store.blpop(output, timeout=1)
+                msg = item[1] if item else None
+            else:
+                msg = redis_store.lpop(output)
+            if msg is not None:
+                sample = json.loads(msg)
+                with redis_batch(redis_store) as batch:
+                    batch.hset(cache_key, field, json.dumps(
+                        {'version': version, 'sample': sample}))
+                    batch.expire(cache_key, config['cache_ttl'])
+                    batch.delete(request_key)
+                return sample
+            # Sample may have been received by an identical request
+            sample = JobService._get_cached_sample(redis_store, cache_key,
+                                                   field, version)
+            if sample is not None or time.time() >= deadline:
+                return sample
+
+    @staticmethod
+    def _get_cached_sample(redis_store, cache_key, field, version):
+        cached = redis_store.hget(cache_key, field)
+        if cached:
+            cached = json.loads(cached)
+            if cached['version'] == version:
+                return cached['sample']
+        return None
 
     @staticmethod
     def trigger_job(name: str, payload: dict, user):
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-}
+import logging
+
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError, WatchError
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from stand.models import Job
+from stand.services.redis_service import connect_redis_store, redis_batch
+
+log = logging.getLogger(__name__)
+
+# Latest job of each workflow, used to answer LatestJobDetailApi without
+# sorting jobs. A Redis hash per workflow keeps the id of its latest job
+# (field '*') and of the latest job of each user (field user id), updated
+# after jobs are created (only to newer jobs). Hashes of workflows with
+# deleted jobs are discarded. Pointers may be missing or point to jobs not
+# available anymore, readers must fall back to the database (see
+# repair_latest_job).
+ALL_USERS = '*'
+
+_KEY = 'stand_latest_job:{}'
+_SESSION_KEY = 'stand_latest_jobs'
+# Pointers of workflows not used for this time (s) are discarded
+_TTL = 7 * 24 * 3600
+
+
+def _get_store():
+    store = current_app.extensions.get('stand_latest_job')
+    if store is None:
+        store = connect_redis_store(None, current_app.testing)
+        current_app.extensions['stand_latest_job'] = store
+    return store
+
+
+def get_latest_job_id(workflow_id, field=ALL_USERS):
+    """ Returns the id of the latest job of a workflow (of all users or of
+    a user) or None if it is not known (or Redis is not available) """
+    try:
+        job_id = _get_store().hget(_KEY.format(workflow_id), str(field))
+    except RedisError as ex:
+        log.warning('Latest job of workflow %s not available: %s',
+                    workflow_id, ex)
+        return None
+    return int(job_id) if job_id else None
+
+
+def _delete_if_equal(store, key, field, value):
+    """ Deletes a field of a hash, unless its value was changed """
+    with store.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.hget(key, field) == str(value):
+                pipe.multi()
+                pipe.hdel(key, field)
+                pipe.execute()
+        except WatchError:
+            # Changed meanwhile
+            pass
+
+
+def _set_if_greater(store, key, pointers):
+    """ Sets fields of a hash to job ids, unless they point to newer jobs
+    (sessions may commit in a different order than their job ids) """
+    with store.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                changed = {field: job_id
+                           for field, job_id in pointers.items()
+                           if int(pipe.hget(key, field) or 0) < job_id}
+                pipe.multi()
+                for field, job_id in changed.items():
+                    pipe.hset(key, field, job_id)
+                pipe.expire(key, _TTL)
+                pipe.execute()
+                return
+            except WatchError:
+                # Changed meanwhile, pointers are compared again
+                continue
+
+
+def repair_latest_job(workflow_id, field, invalid_id, job_id):
+    """
+    Replaces an invalid (or missing) pointer by the id of the latest job
+    found in the database. Pointers changed meanwhile by new jobs are kept.
+    """
+    key = _KEY.format(workflow_id)
+    try:
+        store = _get_store()
+        if invalid_id is not None:
+            _delete_if_equal(store, key, str(field), invalid_id)
+        if job_id is not None:
+            store.hsetnx(key, str(field), job_id)
+            store.expire(key, _TTL)
+    except RedisError as ex:
+        # Pointer is repaired by the next request
+        log.warning('Latest job of workflow %s not repaired: %s',
+                    workflow_id, ex)
+
+
+def _get_changes(session):
+    return session.info.setdefault(_SESSION_KEY, ({}, set()))
+
+
+@event.listens_for(Job, 'after_insert')
+def _job_created(mapper, connection, target):
+    created, _ = _get_changes(object_session(target))
+    pointers = created.setdefault(target.workflow_id, {})
+    for field in [ALL_USERS, str(target.user_id)]:
+        pointers[field] = max(pointers.get(field, 0), target.id)
+
+
+@event.listens_for(Job, 'after_delete')
+def _job_deleted(mapper, connection, target):
+    _, deleted = _get_changes(object_session(target))
+    deleted.add(target.workflow_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop(_SESSION_KEY, None)
+    if changes and has_app_context():
+        created, deleted = changes
+        try:
+            store = _get_store()
+            if deleted:
+                with redis_batch(store) as batch:
+                    for workflow_id in deleted:
+                        batch.delete(_KEY.format(workflow_id))
+            for workflow_id, pointers in created.items():
+                _set_if_greater(store, _KEY.format(workflow_id), pointers)
+        except Exception as ex:
+            # Readers fall back to the database
+            log.exception(ex)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-}
+import atexit
+import logging
+import threading
+import time
+
+from flask import has_app_context
+from stand.models import db, JobStep, JobStepLog
+from stand.services.version_service import JOB, track_changes
+
+log = logging.getLogger(__name__)
+
+
+class JobStepLogBuffer:
+    """
+    Write-behind buffer for job step logs and job step status changes.
+    Executors may send thousands of 'update task' messages for a single job
+    and committing each one of them is expensive. Rows are accumulated in
+    memory and persisted in bulk, when the buffer reaches `max_size` or
+    after `flush_interval` seconds, whatever happens first. Rows are
+    persisted in a dedicated session and, if it fails, they are kept in the
+    buffer and discarded only after `max_attempts` consecutive failures.
+    """
+
+    def __init__(self, app, max_size=500, flush_interval=2.0,
+                 max_attempts=5):
+        self.app = app
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+
+        self._logs = []
+        self._statuses = {}
+        self._job_ids = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._failures = 0
+        self._running = False
+
+    def add(self, step_id, status, level, log_type, message, date,
+            job_id=None, change_status=True):
+        """ Adds a log to the buffer and, if `change_status`, records the
+        new step status """
+        with self._lock:
+            self._logs.append({
+                'step_id': step_id, 'status': status, 'level': level,
+                'type': log_type, 'message': message, 'date': date})
+            if change_status:
+                self._statuses[step_id] = status
+            self._job_ids.add(job_id)
+            must_flush = (len(self._logs) >= self.max_size or
+                          time.time() - self._last_flush >=
+                          self.flush_interval)
+        if must_flush:
+            self.flush()
+
+    def get_status(self, step_id):
+        """ Returns the step status waiting to be persisted, if any """
+        with self._lock:
+            return self._statuses.get(step_id)
+
+    def __len__(self):
+        return len(self._logs)
+
+    def flush(self):
+        """ Persists all buffered rows in a single transaction """
+        with self._lock:
+            logs, self._logs = self._logs, []
+            statuses, self._statuses = self._statuses, {}
+            job_ids, self._job_ids = self._job_ids, set()
+            self._last_flush = time.time()
+
+        if not logs and not statuses:
+            return
+        if has_app_context():
+            persisted = self._persist(logs, statuses, job_ids)
+        else:
+            with self.app.app_context():
+                persisted = self._persist(logs, statuses, job_ids)
+        if persisted:
+            self._failures = 0
+        else:
+            self._requeue(logs, statuses, job_ids)
+
+    def _requeue(self, logs, statuses, job_ids):
+        """ Returns rows not persisted to the buffer, before the ones added
+        meanwhile, unless they have failed too many times """
+        self._failures += 1
+        if self._failures >= self.max_attempts:
+            log.error('Discarding %s log(s) and %s step status(es) after %s '
+                      'failed attempts', len(logs), len(statuses),
+                      self._failures)
+            self._failures = 0
+            return
+        with self._lock:
+            self._logs = logs + self._logs
+            statuses.update(self._statuses)
+            self._statuses = statuses
+            self._job_ids.update(job_ids)
+
+    @staticmethod
+    def _persist(logs, statuses, job_ids):
+        """ Persists rows in a dedicated session, so a failure does not
+        discard changes pending in the session of the caller """
+        session = db.create_session({})()
+        try:
+            # Changes versions of jobs used by conditional requests
+            track_changes(JOB, job_ids, session=session, collection=False)
+            session.bulk_update_mappings(
+                JobStep, [{'id': step_id, 'status': status}
+                          for step_id, status in statuses.items()])
+            session.bulk_insert_mappings(JobStepLog, logs)
+            session.commit()
+            log.debug('Flushed %s log(s) and %s step status(es)',
+                      len(logs), len(statuses))
+            return True
+        except Exception as ex:
+            log.exception(ex)
+            session.rollback()
+            return False
+        finally:
+            session.close()
+
+    def start(self):
+        """
+        Starts a background loop that flushes the buffer periodically, so
+        rows are not kept in memory when executors stop sending messages.
+        Buffer is also flushed when the process exits.
+        """
+        if self._running:
+            return
+        self._running = True
+        import eventlet
+        eventlet.spawn(self._run)
+        atexit.register(self.flush)
+
+    def _run(self):
+        import eventlet
+        while self._running:
+            eventlet.sleep(self.flush_interval)
+            if time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def stop(self):
+        self._running = False
+        self.flush()
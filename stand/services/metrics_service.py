@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-}
+"""
+Simple in-process metrics registry (counters, gauges and histograms), exposed
+by MetricsApi as JSON or in Prometheus text format.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """ Returns a list of (suffix, labels, value) """
+        with self._lock:
+            return [('', dict(k), v) for k, v in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """ Value is computed by calling `function` when collected """
+        with self._lock:
+            self._values[_key(labels)] = function
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(_key(labels), None)
+
+    def samples(self):
+        return [(suffix, labels, value() if callable(value) else value)
+                for suffix, labels, value in super().samples()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = {'buckets': [0] * (len(self.buckets) + 1),
+                         'count': 0, 'sum': 0.0}
+                self._values[key] = entry
+            entry['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            entry['count'] += 1
+            entry['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes the time (s) spent in the block """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, entry in self._values.items():
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',),
+                                        entry['buckets']):
+                    cumulative += count
+                    result.append(('_bucket', dict(labels, le=str(bound)),
+                                   cumulative))
+                result.append(('_count', labels, entry['count']))
+                result.append(('_sum', labels, entry['sum']))
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, description, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, description, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f'Metric {name} is a {metric.type}')
+            return metric
+
+    def counter(self, name, description=''):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description=''):
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name, description='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description,
+                                   buckets=buckets)
+
+    def collect(self):
+        """ Returns all metrics as a dict, suitable for JSON """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {
+                'type': metric.type,
+                'description': metric.description,
+                'samples': [{'name': metric.name + suffix, 'labels': labels,
+                             'value': value}
+                            for suffix, labels, value in metric.samples()]
+            } for metric in metrics}
+
+    def render_text(self):
+        """ Returns all metrics in Prometheus text format """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                label_str = ','.join(
+                    '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+                lines.append(f'{metric.name}{suffix}'
+                             f'{{{label_str}}} {value}' if label_str else
+                             f'{metric.name}{suffix} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by all users in the process
+registry = MetricsRegistry()
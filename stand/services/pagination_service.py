@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-}
+import base64
+import datetime
+import hashlib
+import json
+
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime
+
+DEFAULT_COUNT_TTL = 60
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 500
+
+
+def get_page_size(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """ Returns the page size requested by a client, limited to `maximum`.
+    Invalid (or missing) values are replaced by `default` """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return min(size, maximum) if size > 0 else default
+
+
+def encode_cursor(value, id_):
+    """ Returns an opaque cursor pointing to a row, by its sort value and
+    id """
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(
+        json.dumps([value, id_]).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor, column):
+    """ Returns (sort value, id) from a cursor. Raises ValueError if the
+    cursor is invalid """
+    try:
+        value, id_ = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if value is not None and isinstance(column.type, DateTime):
+        value = datetime.datetime.fromisoformat(value)
+    return value, int(id_)
+
+
+def keyset_paginate(query, sort_column, id_column, size, after=None,
+                    ascending=True):
+    """
+    Returns a page of rows and the cursor of the next page (None if it is
+    the last page). Instead of OFFSET, rows are located using a predicate on
+    (sort column, id), so the cost does not depend on the page number.
+    Sort column must not be nullable. The redundant bound on the sort
+    column allows the database to use an index on (sort column, id) for a
+    range scan, which the OR alone may prevent.
+    """
+    if after:
+        value, id_ = decode_cursor(after, sort_column)
+        if ascending:
+            query = query.filter(sort_column >= value, or_(
+                sort_column > value,
+                and_(sort_column == value, id_column > id_)))
+        else:
+            query = query.filter(sort_column <= value, or_(
+                sort_column < value,
+                and_(sort_column == value, id_column < id_)))
+    if ascending:
+        query = query.order_by(sort_column, id_column)
+    else:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+
+    # One more row indicates that there is a next page
+    items = query.limit(size + 1).all()
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, sort_column.key),
+                                    getattr(last, id_column.key))
+    return items, next_cursor
+
+
+def cached_count(redis_store, prefix, query, ttl=DEFAULT_COUNT_TTL):
+    """
+    Returns the number of rows returned by the query, cached for `ttl`
+    seconds, so it is not computed for every page. The value may be
+    outdated.
+    """
+    statement = query.statement.compile()
+    key = '{}_count_{}'.format(prefix, hashlib.sha1(
+        (str(statement) + repr(sorted(statement.params.items()))).encode(
+            'utf8')).hexdigest())
+    total = redis_store.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        redis_store.set(key, total, ex=ttl)
+    return int(total)
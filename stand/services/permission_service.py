@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-}
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from stand.models import ExecutionPermission
+
+# Time (s) permissions of a user are kept in memory. Changes made by other
+# processes are visible only after it.
+DEFAULT_PERMISSION_CACHE_TTL = 30
+
+# user_id -> (expiration, permissions)
+_permissions = {}
+_lock = threading.Lock()
+
+
+def _get_ttl():
+    config = current_app.config['STAND_CONFIG'].get('permissions', {}) or {}
+    return config.get('cache_ttl', DEFAULT_PERMISSION_CACHE_TTL)
+
+
+def get_execution_permissions(user_id):
+    """ Returns the set of execution permissions granted to a user. Requires
+    an application context. """
+    user_id = int(user_id)
+    now = time.time()
+    with _lock:
+        entry = _permissions.get(user_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    permissions = frozenset(p for (p,) in ExecutionPermission.query.filter(
+        ExecutionPermission.user_id == user_id).with_entities(
+        ExecutionPermission.permission))
+    with _lock:
+        _permissions[user_id] = (now + _get_ttl(), permissions)
+    return permissions
+
+
+def invalidate_execution_permissions(user_id=None):
+    """ Discards cached permissions of a user (or of all users) """
+    with _lock:
+        if user_id is None:
+            _permissions.clear()
+        else:
+            _permissions.pop(int(user_id), None)
+
+
+@event.listens_for(ExecutionPermission, 'after_insert')
+@event.listens_for(ExecutionPermission, 'after_update')
+@event.listens_for(ExecutionPermission, 'after_delete')
+def _permission_changed(mapper, connection, target):
+    # Bulk changes (Query.update/delete) do not trigger this event, they
+    # must call invalidate_execution_permissions()
+    invalidate_execution_permissions(target.user_id)
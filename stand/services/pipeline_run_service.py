@@ -1,3 +1,4 @@
+import json
 import typing
 from datetime import datetime
 
@@ -8,8 +9,10 @@ from flask_babel import gettext
 from stand.app_auth import User
 from stand.models import Cluster, Job, JobType, PipelineRun, PipelineStepRun, StatusExecution, db
 from stand.models_extra import Period, Pipeline, PipelineStep, Workflow
-from stand.services import ServiceException
+from stand.services import ServiceException, ServiceUnavailableException
 from stand.services.job_services import JobService
+from stand.services.tahiti_service import CircuitOpenError, \
+    get_tahiti_client
 import logging
 from stand.models import db, Job, JobStep, JobStepLog, StatusExecution as EXEC, \
     JobResult
@@ -18,20 +21,21 @@ log = logging.getLogger(__name__)
 def get_resource_from_api(config: typing.Dict, resource_type: str,
                           resource_id: int) -> object:
     """Load a resource from Tahiti API"""
-    url = f"{config.get('url').strip('/')}/{resource_type}s/{resource_id}"
-    headers = {"X-Auth-Token": str(config.get("auth_token"))}
-
     try:
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()  # Raise an exception for non-200 status codes
+        # Raises an exception for non-200 status codes
+        text = get_tahiti_client(config).get(
+            f"{resource_type}s/{resource_id}")
 
         if resource_type == "pipeline":
-            data = resp.json().get("data")[0]
+            data = json.loads(text).get("data")[0]
             return Pipeline(**data), data
         elif resource_type == "workflow":
-            return resp.json(), resp.text
+            return json.loads(text), text
         else:
             raise ValueError(f"Invalid resource type: {resource_type}")
+    except CircuitOpenError as e:
+        raise ServiceUnavailableException(
+            f"Error retrieving {resource_type} {resource_id}: {str(e)}")
     except requests.exceptions.RequestException as e:
         raise ServiceException(
             f"Error retrieving {resource_type} {resource_id}: {str(e)}")
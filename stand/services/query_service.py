@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-}
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from stand.models import (Cluster, Job, JobResult, JobStep, PipelineRun,
+                          PipelineStepRun)
+
+# Columns (or relationships) used by schema fields not mapped directly to a
+# column
+FIELD_COLUMNS = {
+    'Job': {
+        'user': ['user_id', 'user_name', 'user_login'],
+        'workflow': ['workflow_definition_hash', '_workflow_definition',
+                     'workflow_definition_blob'],
+    },
+}
+
+
+def apply_projection(query, model, schema_cls, only=None, exclude=()):
+    """
+    Limits the columns loaded by a query to the ones used by the schema
+    fields that will be serialized (`only`, or all fields if None). Other
+    columns (usually large text columns) are deferred and relationships
+    serialized are loaded in a single query (instead of one per row).
+    Columns of relationships excluded from serialization (`exclude`, e.g.
+    'results.content') are deferred too.
+    """
+    mapper = inspect(model)
+    field_columns = FIELD_COLUMNS.get(model.__name__, {})
+    if only is None:
+        only = schema_cls._declared_fields.keys()
+
+    columns = set()
+    options = []
+    loaded_relationships = set()
+    names = []
+    for name in only:
+        name = name.split('.')[0]
+        names.extend(field_columns.get(name, [name]))
+    for name in names:
+        if name in mapper.column_attrs:
+            columns.add(name)
+        elif name in mapper.relationships and \
+                name not in loaded_relationships:
+            relationship = mapper.relationships[name]
+            # Keys used to load the relationship
+            columns.update(c.key for c in relationship.local_columns)
+            loader = selectinload(getattr(model, name))
+            for excluded in exclude:
+                prefix, _, attr = excluded.partition('.')
+                if prefix == name and \
+                        attr in relationship.mapper.column_attrs:
+                    loader = loader.defer(
+                        getattr(relationship.mapper.class_, attr))
+            options.append(loader)
+            loaded_relationships.add(name)
+
+    columns = [getattr(model, c) for c in columns if c in mapper.column_attrs]
+    if columns:
+        options.append(load_only(*columns))
+    return query.options(*options)
+
+
+def job_detail_options(result_content=True):
+    """
+    Loader options for serializing a job using JobItemResponseSchema,
+    loading the relationships walked by the schema (workflow definition,
+    steps and their logs, results, cluster and pipeline run) with a fixed number of queries,
+    regardless of the number of steps. Contents of results are loaded only
+    if `result_content` (never for other jobs of the pipeline run).
+    """
+    results = selectinload(Job.results)
+    if not result_content:
+        results = results.defer(JobResult.content)
+    cluster = joinedload(Job.cluster)
+    pipeline_steps = joinedload(Job.pipeline_run).selectinload(
+        PipelineRun.steps)
+    step_jobs = pipeline_steps.selectinload(PipelineStepRun.jobs)
+    return [
+        selectinload(Job.workflow_definition_blob),
+        cluster.selectinload(Cluster.flavors),
+        cluster.selectinload(Cluster.platforms),
+        selectinload(Job.steps).selectinload(JobStep.logs),
+        results,
+        pipeline_steps.selectinload(PipelineStepRun.logs),
+        step_jobs.selectinload(Job.steps).selectinload(JobStep.logs),
+        # Contents of results of other jobs of the pipeline run are not
+        # serialized (see JobDetailApi)
+        step_jobs.selectinload(Job.results).defer(JobResult.content),
+    ]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-}
+import logging
+import threading
+import time
+
+from stand.services.metrics_service import registry
+
+log = logging.getLogger(__name__)
+
+RATE_LIMITED_EVENTS = registry.counter(
+    'stand_emit_rate_limited_total',
+    'Events above the rate limit, by outcome (sampled, dropped or cached)')
+
+DEFAULT_RATE_LIMIT_CONFIG = {
+    'enabled': False,
+    # Events per second allowed for each room and event type
+    'rate': 50,
+    # Events allowed in a burst, above the rate
+    'burst': 200,
+    # What to do with events above the limit:
+    #   drop: events are not sent to clients, nor cached for replay
+    #   sample: one of each `sample` events is sent, others are dropped
+    #   cache: events are cached for replay, but not sent to clients
+    # Events are always persisted.
+    'overflow': 'cache',
+    'sample': 10,
+    # Events never limited
+    'exempt': ['update job', 'task result'],
+    # Limits for specific events, e.g. {'update task': {'rate': 20}}
+    'events': {},
+}
+
+SEND = 'send'
+DROP = 'drop'
+CACHE = 'cache'
+OVERFLOW_MODES = ('drop', 'sample', 'cache')
+
+# Buckets not used for this time (s) are discarded
+_IDLE_TIME = 60
+
+
+def get_rate_limit_config(stand_config):
+    """ Returns rate limit configuration, using defaults for missing values """
+    result = dict(DEFAULT_RATE_LIMIT_CONFIG)
+    result.update(stand_config.get('emit', {}).get('rate_limit', {}) or {})
+    if result['overflow'] not in OVERFLOW_MODES:
+        raise ValueError(
+            f'Invalid rate limit overflow mode: {result["overflow"]}')
+    return result
+
+
+class RoomRateLimiter:
+    """
+    Token bucket rate limiter for events sent to rooms. Each room and event
+    type has its own bucket, so a job flooding its room does not affect
+    other jobs.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._buckets = {}
+        self._overflows = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = time.time()
+
+    def _limits(self, event):
+        limits = self.config.get('events', {}).get(event, {})
+        return (float(limits.get('rate', self.config['rate'])),
+                float(limits.get('burst', self.config['burst'])))
+
+    def check(self, room, event):
+        """
+        Consumes a token from the bucket of the room and event. Returns
+        SEND if the event can be sent to clients, DROP if it must not be
+        sent nor cached or CACHE if it must be cached but not sent.
+        """
+        if event in self.config['exempt']:
+            return SEND
+        key = (room, event)
+        now = time.time()
+        rate, burst = self._limits(event)
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                # Flood has ended
+                self._overflows.pop(key, None)
+                result = SEND
+            else:
+                self._buckets[key] = (tokens, now)
+                result = self._overflow(key, event)
+            if now - self._last_cleanup > _IDLE_TIME:
+                self._cleanup(now)
+        return result
+
+    def _overflow(self, key, event):
+        overflows = self._overflows.get(key, 0) + 1
+        self._overflows[key] = overflows
+        if overflows == 1:
+            log.warning('Rate limit exceeded for event "%s" in room %s',
+                        event, key[0])
+        mode = self.config['overflow']
+        if mode == 'sample':
+            if overflows % int(self.config['sample']) == 0:
+                RATE_LIMITED_EVENTS.inc(event=event, outcome='sampled')
+                return SEND
+            RATE_LIMITED_EVENTS.inc(event=event, outcome='dropped')
+            return DROP
+        elif mode == 'cache':
+            RATE_LIMITED_EVENTS.inc(event=event, outcome='cached')
+            return CACHE
+        RATE_LIMITED_EVENTS.inc(event=event, outcome='dropped')
+        return DROP
+
+    def _cleanup(self, now):
+        for key, (_, last) in list(self._buckets.items()):
+            if now - last > _IDLE_TIME:
+                del self._buckets[key]
+                self._overflows.pop(key, None)
+        self._last_cleanup = now
@@ -1,40 +1,187 @@
 # -*- coding: utf-8 -*-}
+import threading
+import time
 import urllib.parse
+from contextlib import contextmanager
 
+import redis
 from flask import current_app
 from flask_redis import FlaskRedis
 from mockredis import MockRedis
+from mockredis.pipeline import MockRedisPipeline
+from stand.services.metrics_service import registry
 
+DEFAULT_REDIS_POOL_CONFIG = {
+    # Maximum number of connections of each pool. When all of them are in
+    # use, callers wait up to `timeout` seconds for one to be released
+    'max_connections': 50,
+    'timeout': 5,
+    # Idle connections are checked (PING) before being reused
+    'health_check_interval': 30,
+    'socket_connect_timeout': 5,
+}
 
-class MockRedisWrapper(MockRedis):
+POOL_CONNECTIONS = registry.gauge(
+    'stand_redis_pool_connections', 'Connections in Redis pools, by state')
+POOL_WAIT_SECONDS = registry.histogram(
+    'stand_redis_pool_wait_seconds', 'Time waiting for a Redis connection')
+
+# (url, db, decode_responses) -> redis.StrictRedis sharing a pool
+_clients = {}
+_lock = threading.Lock()
+
+
+class MockRedisCommandsMixin:
+    """
+    Adds the `expire`, `hdel`, `hsetnx`, `set`, `llen` and `ltrim` methods,
+    missing in MockRedis, and fixes `lrange` with negative indexes
+    """
+
+    def expire(self, key, time):
+        return 1
+
+    def set(self, key, value, ex=None):
+        self.redis[key] = str(value)
+        return True
+
+    def llen(self, key):
+        return len(self.redis.get(key) or [])
+
+    def lrange(self, key, start, stop):
+        values = self.redis.get(key) or []
+        return values[start:None if stop == -1 else stop + 1]
+
+    def ltrim(self, key, start, stop):
+        if key in self.redis:
+            self.redis[key] = self.lrange(key, start, stop)
+        return True
+
+    def hdel(self, key, *fields):
+        values = self.redis.get(key, {})
+        return len([values.pop(field) for field in fields
+                    if field in values])
+
+    def hsetnx(self, key, field, value):
+        if self.hget(key, field):
+            return 0
+        return self.hset(key, field, value)
+
+
+class MockRedisPipelineWrapper(MockRedisCommandsMixin, MockRedisPipeline):
+    """
+    A wrapper to add methods missing in MockRedisPipeline. Commands are
+    executed immediately, so `watch` and `multi` do nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def watch(self, *keys):
+        pass
+
+    def multi(self):
+        pass
+
+
+class MockRedisWrapper(MockRedisCommandsMixin, MockRedis):
     """
-    A wrapper to add the `from_url` classmethod
+    A wrapper to add the `from_url` classmethod and methods missing in
+    MockRedis
     """
 
     @classmethod
     def from_url(cls, *args, **kwargs):
         return cls()
 
+    def pipeline(self, transaction=True):
+        return MockRedisPipelineWrapper(self.redis)
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """ Connection pool recording the number of connections in use and the
+    time spent waiting for one """
+
+    def __init__(self, name, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.in_use = 0
+        POOL_CONNECTIONS.set_function(lambda: self.in_use, pool=name,
+                                      state='in_use')
+        POOL_CONNECTIONS.set_function(
+            lambda: len(self._connections) - self.in_use, pool=name,
+            state='idle')
+
+    def get_connection(self, *args, **kwargs):
+        started = time.time()
+        connection = super().get_connection(*args, **kwargs)
+        POOL_WAIT_SECONDS.observe(time.time() - started, pool=self.name)
+        self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        self.in_use -= 1
+        super().release(connection)
+
+
+def get_redis_client(url, db=0, decode_responses=True, config=None):
+    """
+    Returns a Redis client for the url. Clients (and their connection pools)
+    are shared by all users in the process with the same url, database and
+    decoding option.
+    """
+    key = (url, db, decode_responses)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                if config is None and current_app:
+                    config = current_app.config['STAND_CONFIG'].get('redis')
+                pool_config = dict(DEFAULT_REDIS_POOL_CONFIG, **(config or {}))
+                parsed = urllib.parse.urlparse(url)
+                name = f'{parsed.hostname}:{parsed.port}/{db}'
+                if not decode_responses:
+                    name += '/bytes'
+                pool = InstrumentedConnectionPool(
+                    name,
+                    host=parsed.hostname, port=parsed.port or 6379, db=db,
+                    password=parsed.password,
+                    decode_responses=decode_responses,
+                    socket_keepalive=True, **pool_config)
+                client = redis.StrictRedis(connection_pool=pool)
+                _clients[key] = client
+    return client
+
+
+@contextmanager
+def redis_batch(redis_store):
+    """
+    Groups the commands sent to Redis inside the block (using the yielded
+    pipeline) in a single round trip, executed atomically (MULTI/EXEC) when
+    the block ends. Results are available in the `results` attribute of the
+    pipeline.
+    """
+    pipe = redis_store.pipeline()
+    yield pipe
+    pipe.results = pipe.execute()
+
 
 def connect_redis_store(url, testing=False, decode_responses=True, db=0):
     """ Connect to redis or FakeRedis if testing app """
 
     def _redis_from_url(redis_url):
-        parsed = urllib.parse.urlparse(redis_url)
-        parsed_qs = urllib.parse.parse_qs(parsed.query)
-        return FlaskRedis(host=parsed.hostname, port=parsed.port,
-                          db=int(parsed_qs.get('db', db)),
-                          decode_responses=decode_responses)
+        parsed_qs = urllib.parse.parse_qs(urllib.parse.urlparse(
+            redis_url).query)
+        return get_redis_client(redis_url, int(parsed_qs.get('db', [db])[0]),
+                                decode_responses)
     if testing or (current_app and current_app.testing):
         redis_store = FlaskRedis.from_custom_provider(MockRedisWrapper)
         redis_store.init_app(current_app)
-        setattr(redis_store, 'expire', lambda x, time: 1)
-    elif current_app:
-        redis_store = _redis_from_url(current_app.config['REDIS_URL'])
-        redis_store.init_app(current_app)
     elif url is None:
-        redis_store = FlaskRedis()
-        redis_store.init_app(current_app)
+        redis_store = _redis_from_url(current_app.config['REDIS_URL'])
     else:
         redis_store = _redis_from_url(url)
     return redis_store
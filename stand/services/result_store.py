@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-}
+import base64
+import hashlib
+import logging
+import os
+import zlib
+
+from flask import current_app
+from stand.util import write_file
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RESULT_STORE_CONFIG = {
+    # database: content is kept in job_result table
+    # filesystem: large content is stored in files under `path`
+    'type': 'database',
+    'path': '/var/lib/stand/results',
+    # Content larger than this (bytes) is compressed (and stored in a file,
+    # if type is filesystem)
+    'threshold': 65536,
+}
+
+# Encodings of job_result.content
+PLAIN = None
+ZLIB = 'zlib'
+ZLIB_BASE64 = 'zlib+base64'
+
+_CHUNK_SIZE = 65536
+
+
+def get_result_store_config(stand_config=None):
+    """ Returns result store configuration, using defaults for missing
+    values """
+    if stand_config is None:
+        stand_config = current_app.config['STAND_CONFIG']
+    result = dict(DEFAULT_RESULT_STORE_CONFIG)
+    result.update(stand_config.get('result_store', {}) or {})
+    return result
+
+
+def _blob_path(config, ref):
+    return os.path.join(config['path'], ref)
+
+
+def store_result_content(result, content, config):
+    """
+    Sets the content of a JobResult. Content larger than the threshold is
+    compressed and, if configured, written to the filesystem, keeping only a
+    reference in the database. Files are named after the content hash, so
+    identical contents share the same file.
+    """
+    if content is None:
+        result.content = None
+        return
+    data = content.encode('utf8')
+    result.content_size = len(data)
+    result.content_hash = hashlib.sha256(data).hexdigest()
+    if len(data) <= config['threshold']:
+        result.content = content
+        result.content_encoding = PLAIN
+        return
+
+    compressed = zlib.compress(data)
+    if config['type'] == 'filesystem':
+        ref = os.path.join(result.content_hash[:2],
+                           f'{result.content_hash}.{ZLIB}')
+        path = _blob_path(config, ref)
+        if not os.path.exists(path):
+            write_file(path, compressed)
+        result.content = None
+        result.content_ref = ref
+        result.content_encoding = ZLIB
+    else:
+        result.content = base64.b64encode(compressed).decode('ascii')
+        result.content_encoding = ZLIB_BASE64
+
+
+def iter_result_content(result, config=None, chunk_size=_CHUNK_SIZE):
+    """ Generates the (decompressed) content of a JobResult in chunks of
+    bytes """
+    if result.content_encoding == ZLIB_BASE64:
+        yield zlib.decompress(base64.b64decode(result.content))
+    elif result.content_encoding == ZLIB:
+        config = config or get_result_store_config()
+        decompressor = zlib.decompressobj()
+        with open(_blob_path(config, result.content_ref), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+    elif result.content is not None:
+        yield result.content.encode('utf8')
+
+
+def read_result_content(result, config=None):
+    """ Returns the content of a JobResult as text, or None if its file is
+    not available """
+    if result.content_encoding is PLAIN:
+        return result.content
+    try:
+        return b''.join(iter_result_content(result, config)).decode('utf8')
+    except OSError as e:
+        log.warning('Content of result %s not available: %s', result.id, e)
+        return None
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-}
+import json
+import threading
+import time
+import zlib
+
+from redis.exceptions import WatchError
+from stand.services.metrics_service import registry
+
+DEFAULT_ROOM_CACHE_CONFIG = {
+    # Maximum number of messages kept for each room (older are discarded)
+    'max_length': 2000,
+    # Time (s) to keep messages after the last one was sent to the room
+    'ttl': 600,
+}
+# Event used to send all cached messages of a room in a single frame
+REPLAY_EVENT = 'replay'
+# Event sent before replayed messages when messages after the sequence number
+# informed by the client are not cached anymore
+REPLAY_GAP_EVENT = 'replay gap'
+
+# Lengths of room caches written by this process, room -> (length, time
+# when the cache expires). Metrics are aggregated, instead of one series per
+# room, and rooms are discarded when their caches expire.
+_lengths = {}
+_lengths_lock = threading.Lock()
+
+
+def _live_lengths():
+    now = time.time()
+    with _lengths_lock:
+        for room in [room for room, (_, expires) in _lengths.items()
+                     if expires <= now]:
+            del _lengths[room]
+        return [length for length, _ in _lengths.values()]
+
+
+ROOM_CACHE_ROOMS = registry.gauge(
+    'stand_room_cache_rooms', 'Number of rooms with cached messages')
+ROOM_CACHE_ROOMS.set_function(lambda: len(_live_lengths()))
+ROOM_CACHE_MAX_LENGTH = registry.gauge(
+    'stand_room_cache_max_length',
+    'Number of messages cached for the room with most messages')
+ROOM_CACHE_MAX_LENGTH.set_function(lambda: max(_live_lengths(), default=0))
+
+
+def get_room_cache_config(stand_config):
+    """ Returns room cache configuration, using defaults for missing values """
+    result = dict(DEFAULT_ROOM_CACHE_CONFIG)
+    result.update(stand_config.get('emit', {}).get('room_cache', {}) or {})
+    return result
+
+
+def _cache_key(room):
+    return f'cache_room_{room}'
+
+
+def _seq_key(room):
+    return f'cache_room_seq_{room}'
+
+
+def cache_room_messages(redis_store, config, room, messages):
+    """
+    Appends messages to the room cache (a capped list). Each message
+    receives a monotonically increasing sequence number (`seq`), also set
+    in its data, used by clients to resume from the last message received.
+    Sequence numbers are assigned and messages are appended atomically
+    (WATCH/MULTI), so the cache is always ordered by `seq`, even with
+    concurrent writers.
+    :param messages: list of dicts with keys event, data and namespace.
+    :return: the sequence number of the last message
+    """
+    if not messages:
+        return None
+    cache_key = _cache_key(room)
+    seq_key = _seq_key(room)
+    with redis_store.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(seq_key)
+                seq = int(pipe.get(seq_key) or 0)
+                length = pipe.llen(cache_key) + len(messages)
+                entries = []
+                for message in messages:
+                    seq += 1
+                    message['data']['seq'] = seq
+                    cached_data = message['data'].copy()
+                    cached_data['fromcache'] = True
+                    entries.append(json.dumps(
+                        {'event': message['event'], 'data': cached_data,
+                         'namespace': message['namespace'], 'room': room,
+                         'seq': seq},
+                        indent=0))
+                pipe.multi()
+                pipe.set(seq_key, seq, ex=config['ttl'])
+                pipe.rpush(cache_key, *entries)
+                pipe.ltrim(cache_key, -config['max_length'], -1)
+                pipe.expire(cache_key, config['ttl'])
+                pipe.execute()
+                break
+            except WatchError:
+                # Another writer appended messages, sequence is read again
+                continue
+    with _lengths_lock:
+        _lengths[room] = (min(length, config['max_length']),
+                          time.time() + config['ttl'])
+    return seq
+
+
+def forget_room_cache(room):
+    """ Stops reporting the length of a room cache (e.g. job finished) """
+    with _lengths_lock:
+        _lengths.pop(room, None)
+
+
+def get_room_messages(redis_store, room, last_seq=None):
+    """
+    Returns the cached messages of a room and if there is a gap between
+    `last_seq` and them. If `last_seq` is informed, only messages after it
+    are returned. A gap means that messages after `last_seq` are not cached
+    anymore (discarded or expired): all cached messages are returned and
+    clients must reload the state of the room.
+    """
+    seq_key = _seq_key(room)
+    with redis_store.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(seq_key)
+                current = int(pipe.get(seq_key) or 0)
+                if last_seq is None or last_seq > current:
+                    # Sequence was reset (cache expired) if last_seq > current
+                    start = 0
+                elif last_seq == current:
+                    return [], False
+                else:
+                    # Cache is ordered by seq
+                    start = -(current - last_seq)
+                entries = pipe.lrange(_cache_key(room), start, -1)
+                # Fails if messages were appended after the sequence was read
+                pipe.multi()
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+
+    result = [json.loads(entry) for entry in entries]
+    if last_seq is None:
+        return result, False
+    elif last_seq > current:
+        return result, True
+    gap = not result or result[0].get('seq', 0) > last_seq + 1
+    return [msg for msg in result if msg.get('seq', 0) > last_seq], gap
+
+
+def touch_room_cache(redis_store, config, room):
+    """ Renews the TTL of the room cache """
+    redis_store.expire(_cache_key(room), config['ttl'])
+    redis_store.expire(_seq_key(room), config['ttl'])
+
+
+def build_replay_payload(room, messages, compress=False, gap=False):
+    """
+    Builds the payload of the replay event, sent to a client joining a room
+    instead of one event per cached message:
+      room: room identifier
+      last_seq: sequence number of the last message (null if no messages)
+      count: number of messages
+      gap: true if messages after the sequence number informed by the
+           client are missing, it must reload the state of the room
+      messages: list of {event, data}, in the order they were sent.
+    If `compress` is true, `messages` is replaced by `payload`, a binary
+    attachment with the JSON list compressed using zlib, and `encoding` is
+    set to `zlib`.
+    """
+    items = [{'event': msg['event'], 'data': msg['data']} for msg in messages]
+    result = {
+        'room': room,
+        'last_seq': messages[-1].get('seq') if messages else None,
+        'count': len(items),
+        'gap': gap,
+    }
+    if compress:
+        result['encoding'] = 'zlib'
+        result['payload'] = zlib.compress(json.dumps(items).encode('utf8'))
+    else:
+        result['messages'] = items
+    return result
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-}
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from stand.services.metrics_service import registry
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+CIRCUIT_STATE = registry.gauge(
+    'stand_tahiti_circuit_state',
+    'State of circuits to Tahiti, by endpoint (0: closed, 1: half open, '
+    '2: open)')
+TAHITI_REQUESTS = registry.counter(
+    'stand_tahiti_requests_total',
+    'Requests to Tahiti, by endpoint and outcome (success, failure, '
+    'rejected by open circuit, stale response)')
+
+DEFAULT_TAHITI_CLIENT_CONFIG = {
+    # Seconds to wait for a connection and for a response
+    'connect_timeout': 3,
+    'timeout': 15,
+    # Retries of failed GET requests (connection errors and 502/503/504,
+    # slow responses are not retried)
+    'retries': 2,
+    'backoff_factor': 0.3,
+    # Connections kept open to Tahiti
+    'pool_size': 10,
+    # Cached resources are always revalidated (If-None-Match/
+    # If-Modified-Since), so a job never starts with an outdated workflow,
+    # but unchanged ones are not transferred again
+    'cache_max_size': 500,
+    # After failure_threshold consecutive failures (errors or timeouts) of
+    # an endpoint, its requests fail immediately for reset_timeout seconds.
+    # Then, one request is allowed (probe) and closes the circuit if it
+    # succeeds.
+    'failure_threshold': 5,
+    'reset_timeout': 30,
+    # Cached (even if expired) resources are returned when Tahiti fails
+    'serve_stale': True,
+    # Settings by endpoint (first part of the path), e.g.
+    # {'workflows': {'timeout': 5}}
+    'endpoints': {},
+}
+
+# (url, token) -> TahitiClient
+_clients = {}
+_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Request not sent, because Tahiti is failing """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for an endpoint. Closed: requests are sent. Open: they
+    fail immediately. Half open: one request is sent to probe the endpoint.
+    """
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set_function(lambda: self.state, endpoint=name)
+
+    def allow(self):
+        """ Returns if a request can be sent """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                log.info('Probing Tahiti endpoint %s', self.name)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def release(self):
+        """ Must be called after each request allowed, whatever its
+        outcome, so that another probe can be sent """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info('Circuit of Tahiti endpoint %s closed', self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    log.warning('Circuit of Tahiti endpoint %s opened after '
+                                '%s failure(s)', self.name, self.failures)
+                self.state = self.OPEN
+                self.opened = time.time()
+
+
+class _CacheEntry:
+    __slots__ = ('text', 'etag', 'last_modified')
+
+    def __init__(self, text, etag, last_modified):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class TahitiClient:
+    """
+    Client of Tahiti API, keeping connections open (pooled session) and
+    caching retrieved resources in memory. Requests have timeouts and
+    failed ones are retried. Each endpoint has a circuit breaker. Errors
+    are raised as requests exceptions (CircuitOpenError if the request was
+    not sent).
+    """
+
+    def __init__(self, url, auth_token, config=None):
+        self.url = url.rstrip('/')
+        self.config = dict(DEFAULT_TAHITI_CLIENT_CONFIG, **(config or {}))
+        self.session = requests.Session()
+        self.session.headers['X-Auth-Token'] = str(auth_token)
+        retry = Retry(total=self.config['retries'],
+                      backoff_factor=self.config['backoff_factor'],
+                      status_forcelist=[502, 503, 504],
+                      read=0, allowed_methods=['GET'],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.config['pool_size'],
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._breakers = {}
+
+    def _get_entry(self, path):
+        with self._cache_lock:
+            entry = self._cache.get(path)
+            if entry is not None:
+                self._cache.move_to_end(path)
+            return entry
+
+    def _set_entry(self, path, entry):
+        with self._cache_lock:
+            self._cache[path] = entry
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.config['cache_max_size']:
+                self._cache.popitem(last=False)
+
+    def _get_breaker(self, endpoint):
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._cache_lock:
+                breaker = self._breakers.get(endpoint)
+                if breaker is None:
+                    config = self._endpoint_config(endpoint)
+                    breaker = CircuitBreaker(endpoint,
+                                             config['failure_threshold'],
+                                             config['reset_timeout'])
+                    self._breakers[endpoint] = breaker
+        return breaker
+
+    def _endpoint_config(self, endpoint):
+        return dict(self.config,
+                    **self.config['endpoints'].get(endpoint, {}))
+
+    def get(self, path, use_cache=True):
+        """ Returns the body (text) of a Tahiti resource, e.g.
+        'workflows/10' """
+        entry = self._get_entry(path) if use_cache else None
+        endpoint = path.split('/')[0]
+        config = self._endpoint_config(endpoint)
+        breaker = self._get_breaker(endpoint)
+        try:
+            if not breaker.allow():
+                TAHITI_REQUESTS.inc(endpoint=endpoint, outcome='rejected')
+                raise CircuitOpenError(
+                    f'Tahiti endpoint {endpoint} is unavailable')
+            try:
+                resp = self._request(path, entry, config)
+                breaker.record_success()
+            except requests.exceptions.RequestException:
+                breaker.record_failure()
+                TAHITI_REQUESTS.inc(endpoint=endpoint, outcome='failure')
+                raise
+            finally:
+                breaker.release()
+            TAHITI_REQUESTS.inc(endpoint=endpoint, outcome='success')
+        except requests.exceptions.RequestException as e:
+            if entry is not None and config['serve_stale']:
+                log.warning('Using cached %s: %s', path, e)
+                TAHITI_REQUESTS.inc(endpoint=endpoint, outcome='stale')
+                return entry.text
+            raise
+
+        if resp.status_code == 304 and entry is not None:
+            return entry.text
+        resp.raise_for_status()
+        if use_cache:
+            self._set_entry(path, _CacheEntry(
+                resp.text, resp.headers.get('ETag'),
+                resp.headers.get('Last-Modified')))
+        return resp.text
+
+    def _request(self, path, entry, config):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        resp = self.session.get(
+            f'{self.url}/{path}', headers=headers,
+            timeout=(config['connect_timeout'], config['timeout']))
+        # Client errors (e.g. not found) are not failures of Tahiti
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        return resp
+
+    def get_workflow(self, workflow_id):
+        return self.get(f'workflows/{workflow_id}')
+
+    def get_pipeline(self, pipeline_id):
+        return self.get(f'pipelines/{pipeline_id}')
+
+    def invalidate(self, path=None):
+        """ Discards a cached resource (or all of them) """
+        with self._cache_lock:
+            if path is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(path, None)
+
+
+def get_tahiti_client(tahiti_config):
+    """
+    Returns the Tahiti client for a configuration (services.tahiti). Clients
+    (and their connections and caches) are shared by all users in the
+    process.
+    """
+    token = tahiti_config.get('auth_token', tahiti_config.get('token'))
+    key = (tahiti_config['url'], token)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = TahitiClient(tahiti_config['url'], token, {
+                    k: v for k, v in tahiti_config.items()
+                    if k in DEFAULT_TAHITI_CLIENT_CONFIG})
+                _clients[key] = client
+    return client
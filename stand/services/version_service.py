@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-}
+import hashlib
+import logging
+import uuid
+
+from flask import (after_this_request, current_app, has_app_context,
+                   request, Response)
+from flask import g as flask_global
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from stand.models import Job, JobResult, JobStep, PipelineRun, \
+    PipelineStepRun, db
+from stand.services.redis_service import connect_redis_store, redis_batch
+
+log = logging.getLogger(__name__)
+
+# Version tokens of jobs and pipeline runs, used to answer conditional
+# requests (If-None-Match) without loading and serializing resources.
+# Tokens are kept in a Redis hash per resource type (id -> token) and a new
+# token is assigned to a resource after each committed change. Tokens of
+# deleted resources are removed and tokens are only created for resources
+# returned by the API. Field '*' holds the token of the collection, changed
+# only when resources are created, deleted or changed in a way visible in
+# list responses (e.g. job status, but not job step logs).
+# Changes made through the ORM are tracked automatically, set-based changes
+# (bulk updates and inserts) must be registered with track_changes().
+JOB = 'job'
+PIPELINE_RUN = 'pipeline_run'
+COLLECTION = '*'
+
+_KEY = 'stand_versions:{}'
+_SESSION_KEY = 'stand_changed_versions'
+
+
+def _get_store():
+    store = current_app.extensions.get('stand_versions')
+    if store is None:
+        store = connect_redis_store(None, current_app.testing)
+        current_app.extensions['stand_versions'] = store
+    return store
+
+
+def track_changes(resource, ids, session=None, collection=True,
+                  deleted=False):
+    """ Registers resources changed (or deleted) in the current transaction.
+    Their versions (and the version of their collection, if `collection`)
+    are changed after commit. """
+    session = session or db.session()
+    changed, collections = session.info.setdefault(_SESSION_KEY,
+                                                   ({}, set()))
+    for id_ in ids:
+        if id_ is not None:
+            changed[(resource, id_)] = (deleted or
+                                        changed.get((resource, id_), False))
+    if collection:
+        collections.add(resource)
+
+
+def bump_versions(redis_store, changed, collections=()):
+    """ Assigns new version tokens to resources and collections. `changed`
+    maps (resource, id) to a flag indicating if it was deleted. """
+    token = uuid.uuid4().hex
+    with redis_batch(redis_store) as batch:
+        for resource in collections:
+            batch.hset(_KEY.format(resource), COLLECTION, token)
+        for (resource, id_), deleted in changed.items():
+            if deleted:
+                batch.hdel(_KEY.format(resource), str(id_))
+            else:
+                batch.hset(_KEY.format(resource), str(id_), token)
+
+
+def get_version(resource, id_=COLLECTION, create=True):
+    """ Returns the version token of a resource. If it has none yet, one is
+    assigned (if `create`, the resource must exist) or None is returned. """
+    store = _get_store()
+    key = _KEY.format(resource)
+    token = store.hget(key, str(id_))
+    if not token and create:
+        # Another process may assign a token at the same time
+        store.hsetnx(key, str(id_), uuid.uuid4().hex)
+        token = store.hget(key, str(id_))
+    return token or None
+
+
+def _compute_etag(tokens):
+    parts = tokens + [request.full_path, str(flask_global.user.id),
+                      request.headers.get('Accept-Language', '')]
+    return hashlib.sha1('|'.join(parts).encode('utf8')).hexdigest()
+
+
+def get_etag(*versions, create=True):
+    """
+    Returns the entity tag of the response for the current request, given
+    the resources (resource, id) it is built from. Requested URL, user and
+    language are part of the tag, because they change the response.
+    Returns None if versions are not available (or some resource has no
+    version, if not `create`).
+    """
+    try:
+        tokens = [get_version(resource, id_, create)
+                  for resource, id_ in versions]
+    except Exception as ex:
+        log.warning('Versions not available: %s', ex)
+        return None
+    if None in tokens:
+        return None
+    return _compute_etag(tokens)
+
+
+def conditional_get(*versions):
+    """
+    Returns a 304 (Not Modified) response if the client already has the
+    current version of the response (If-None-Match), otherwise returns None
+    and the entity tag is added to the response, if successful. Missing
+    versions are only assigned after a successful response, so requests
+    for resources that do not exist do not create them.
+    """
+    etag = get_etag(*versions, create=False)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    @after_this_request
+    def _set_etag(response):
+        if response.status_code == 200:
+            tag = etag or get_etag(*versions)
+            if tag is not None:
+                response.set_etag(tag)
+        return response
+    return None
+
+
+@event.listens_for(Job, 'after_insert')
+@event.listens_for(Job, 'after_update')
+@event.listens_for(JobResult, 'after_insert')
+@event.listens_for(JobResult, 'after_update')
+def _job_changed(mapper, connection, target):
+    job_id = target.job_id if isinstance(target, JobResult) else target.id
+    track_changes(JOB, [job_id], object_session(target))
+
+
+@event.listens_for(JobStep, 'after_insert')
+@event.listens_for(JobStep, 'after_update')
+def _job_step_changed(mapper, connection, target):
+    # Steps are not part of job lists
+    track_changes(JOB, [target.job_id], object_session(target),
+                  collection=False)
+
+
+@event.listens_for(Job, 'after_delete')
+def _job_deleted(mapper, connection, target):
+    track_changes(JOB, [target.id], object_session(target), deleted=True)
+
+
+@event.listens_for(PipelineRun, 'after_insert')
+@event.listens_for(PipelineRun, 'after_update')
+def _pipeline_run_changed(mapper, connection, target):
+    track_changes(PIPELINE_RUN, [target.id], object_session(target))
+
+
+@event.listens_for(PipelineRun, 'after_delete')
+def _pipeline_run_deleted(mapper, connection, target):
+    track_changes(PIPELINE_RUN, [target.id], object_session(target),
+                  deleted=True)
+
+
+@event.listens_for(PipelineStepRun, 'after_insert')
+@event.listens_for(PipelineStepRun, 'after_update')
+def _pipeline_step_run_changed(mapper, connection, target):
+    track_changes(PIPELINE_RUN, [target.pipeline_run_id],
+                  object_session(target))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop(_SESSION_KEY, None)
+    if changes and has_app_context():
+        try:
+            bump_versions(_get_store(), *changes)
+        except Exception as ex:
+            # Clients may receive outdated responses until the next change
+            log.exception(ex)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
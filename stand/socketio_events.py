@@ -4,6 +4,13 @@ import logging
 
 from flask_babel import gettext
 from stand.factory import create_socket_io_app, create_redis_store
+from stand.services.redis_service import redis_batch
+from stand.services.room_cache_service import (REPLAY_EVENT,
+                                               REPLAY_GAP_EVENT,
+                                               build_replay_payload,
+                                               get_room_cache_config,
+                                               get_room_messages,
+                                               touch_room_cache)
 
 
 class StandSocketIO:
@@ -14,6 +21,8 @@ class StandSocketIO:
         self.socket_io, self.socket_app = create_socket_io_app(_app)
         self.logger = logging.getLogger(__name__)
         self.redis_store = create_redis_store(_app)
+        self.room_cache_config = get_room_cache_config(
+            _app.config['STAND_CONFIG'])
 
         handlers = {
             'connect': self.on_connect,
@@ -80,13 +89,26 @@ class StandSocketIO:
         # print('*'* 20)
         room = str(message.get('room'))
         replay_cached = message.get('cached', True)
-
-        self.redis_store.hset(
-            'room_{}'.format(room), sid,
-            json.dumps({'joined': datetime.datetime.utcnow().isoformat()}))
-
-        self.redis_store.expire('room_{}'.format(room), 3600)
-        self.redis_store.expire(f'cache_room_{room}', 600)
+        # Clients reconnecting inform the sequence number of the last
+        # message received, so only new messages are sent
+        try:
+            last_seq = int(message['last_seq'])
+            if last_seq < 0:
+                raise ValueError(last_seq)
+        except KeyError:
+            last_seq = None
+        except (TypeError, ValueError):
+            self.logger.warning('[%s] invalid last_seq %r ignored', sid,
+                                message.get('last_seq'))
+            last_seq = None
+
+        with redis_batch(self.redis_store) as batch:
+            batch.hset(
+                'room_{}'.format(room), sid,
+                json.dumps({'joined': datetime.datetime.utcnow().isoformat()}))
+
+            batch.expire('room_{}'.format(room), 3600)
+            touch_room_cache(batch, self.room_cache_config, room)
 
         self.logger.info(gettext('[%s] joined room %s'), sid, room)
         self.socket_io.enter_room(sid, room, namespace=self.namespace)
@@ -102,10 +124,22 @@ class StandSocketIO:
         if not replay_cached:
             return
 
-        cached = self.redis_store.lrange(f'cache_room_{room}', 0, -1)
-        for msg in cached:
-            msg = json.loads(msg)
-            self.socket_io.emit(msg['event'], msg['data'], room=sid,
+        cached, gap = get_room_messages(self.redis_store, room, last_seq)
+        if message.get('batch', False):
+            # All messages in a single frame
+            self.socket_io.emit(
+                REPLAY_EVENT,
+                build_replay_payload(room, cached,
+                                     message.get('compress', False), gap),
+                room=sid, namespace=self.namespace)
+        else:
+            if gap:
+                # Client must reload the state of the room
+                self.socket_io.emit(
+                    REPLAY_GAP_EVENT, {'room': room, 'last_seq': last_seq},
+                    room=sid, namespace=self.namespace)
+            for msg in cached:
+                self.socket_io.emit(msg['event'], msg['data'], room=sid,
                                     namespace=self.namespace)
 
     def on_leave_room(self, sid, message, connected=True):
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-}
+import os
+import tempfile
 from datetime import datetime
 
 
@@ -9,3 +11,16 @@ def get_now():
      testing.
     """
     return datetime.now()
+
+
+def write_file(path, data):
+    """
+    Writes data (bytes) to a file, creating its directory if needed. Data
+    is written to a temporary file that replaces the target, so readers
+    never see a partially written file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
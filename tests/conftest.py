@@ -5,7 +5,7 @@ import pytest
 import datetime
 import flask_migrate
 
-from stand.models import (Job, ClusterType, Cluster,
+from stand.models import (Job, ClusterType, Cluster, JobStep,
                           JobType, PipelineRun, PipelineStepRun, StatusExecution, db)
 from stand.services.redis_service import connect_redis_store
 
@@ -69,6 +69,43 @@ def get_jobs():
     return [j1, j2, j3]
 
 
+def get_job(job_id, task_ids=(), **kwargs):
+    now = datetime.datetime.now()
+    values = dict(
+        id=job_id, created=now, name=f'Job {job_id}', type=JobType.NORMAL,
+        status=StatusExecution.RUNNING, workflow_id=1000,
+        workflow_name='WF', workflow_definition='{"id": 1}',
+        user_id=1, user_login='aa', user_name='AA', cluster_id=1,
+        steps=[JobStep(date=now, status=StatusExecution.PENDING,
+                       task_id=task_id, operation_id=1, operation_name='Op')
+               for task_id in task_ids])
+    values.update(kwargs)
+    return Job(**values)
+
+
+@pytest.fixture
+def create_job(client, app):
+    """ Creates jobs (see get_job), deleted after the test. Returns the ids
+    of the steps of the created job. """
+    created = []
+
+    def _create(job_id, task_ids=(), **kwargs):
+        with app.app_context():
+            job = get_job(job_id, task_ids, **kwargs)
+            db.session.add(job)
+            db.session.commit()
+            created.append(job_id)
+            return [step.id for step in job.steps]
+    yield _create
+
+    with app.app_context():
+        for job_id in created:
+            job = Job.query.get(job_id)
+            if job is not None:
+                db.session.delete(job)
+        db.session.commit()
+
+
 @pytest.fixture(scope='session')
 def app():
     from stand.app import create_app
@@ -0,0 +1,68 @@
+import datetime
+import json
+
+from stand.models import (Job, JobArchive, JobResult, JobStep, JobStepLog,
+                          StatusExecution, db)
+from stand.services.archive_service import archive_jobs, get_archive_config
+
+HEADERS = {'X-Auth-Token': '123456'}
+
+
+def _old_job(job_id, status=StatusExecution.COMPLETED):
+    created = datetime.datetime.now() - datetime.timedelta(days=400)
+    return Job(id=job_id, workflow_id=1000, cluster_id=1,
+               workflow_name='Archive', user_id=1, user_name='AA',
+               user_login='aa', status=status, created=created,
+               workflow_definition=json.dumps({'id': 1000}),
+               steps=[JobStep(date=created, status=StatusExecution.COMPLETED,
+                              task_id='t1', operation_id=1,
+                              operation_name='Read',
+                              logs=[JobStepLog(level='INFO', date=created,
+                                               status='COMPLETED',
+                                               message='Done', type='TEXT')])],
+               results=[JobResult(task_id='t1', operation_id=1,
+                                  type='HTML', content='<b>Ok</b>')])
+
+
+def test_old_jobs_are_archived(client, app, tmp_path):
+    with app.app_context():
+        db.session.add_all([_old_job(7320), _old_job(7321),
+                            _old_job(7322, StatusExecution.RUNNING)])
+        db.session.commit()
+
+        for storage in [{'type': 'database'},
+                        {'type': 'filesystem', 'path': str(tmp_path)}]:
+            config = get_archive_config({'archive': dict(
+                storage, max_age=365, batch_size=1)})
+            # Batches are bounded
+            assert archive_jobs(config, max_batches=1) == 1
+        assert archive_jobs(get_archive_config()) == 0
+        db.session.remove()
+
+        assert Job.query.filter(Job.id.in_([7320, 7321])).count() == 0
+        assert JobStep.query.filter(
+            JobStep.job_id.in_([7320, 7321])).count() == 0
+        # Running jobs are not archived
+        assert Job.query.get(7322) is not None
+        assert JobArchive.query.get(7320).content is not None
+        assert JobArchive.query.get(7321).content_ref is not None
+        app.config['STAND_CONFIG']['archive'] = {'path': str(tmp_path)}
+
+    try:
+        for job_id in [7320, 7321]:
+            response = client.get(f'/jobs/{job_id}', headers=HEADERS,
+                                  query_string={'results_content': 'true'})
+            assert response.status_code == 200, response.json
+            job = response.json
+            assert job['archived']
+            assert job['workflow'] == {'id': 1000}
+            assert job['cluster']['id'] == 1
+            assert job['steps'][0]['logs'][0]['message'] == 'Done'
+            assert job['results'][0]['content'] == '<b>Ok</b>'
+    finally:
+        with app.app_context():
+            del app.config['STAND_CONFIG']['archive']
+            JobArchive.query.filter(JobArchive.id.in_([7320, 7321])).delete(
+                synchronize_session=False)
+            db.session.delete(Job.query.get(7322))
+            db.session.commit()
@@ -0,0 +1,70 @@
+import datetime
+import json
+
+from stand.models import ContentBlob, Job, StatusExecution, db
+
+
+def _job(job_id, definition, source_code=None):
+    return Job(id=job_id, workflow_id=1000, cluster_id=1,
+               workflow_name='Blobs', user_id=1, user_name='AA',
+               user_login='aa', status=StatusExecution.COMPLETED,
+               created=datetime.datetime.now(),
+               workflow_definition=definition, source_code=source_code)
+
+
+def test_job_contents_are_shared_and_compressed(client, app):
+    from sqlalchemy import event
+    definition = json.dumps({'id': 1000, 'tasks': [{'id': 't'}] * 1000})
+    statements = []
+
+    def _capture(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _capture)
+        try:
+            db.session.add_all([_job(7310, definition, 'print(1)'),
+                                _job(7311, definition)])
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', _capture)
+        inserts = [s for s in statements if s.startswith('INSERT INTO')]
+        # Blobs are inserted before the jobs referencing them
+        assert inserts[0].startswith('INSERT INTO content_blob')
+
+        db.session.remove()
+        jobs = Job.query.filter(Job.id.in_([7310, 7311])).order_by(
+            Job.id).all()
+        assert jobs[0].workflow_definition_hash == \
+               jobs[1].workflow_definition_hash
+        assert [j.workflow_definition for j in jobs] == [definition] * 2
+        assert [j.source_code for j in jobs] == ['print(1)', None]
+        assert jobs[0]._workflow_definition is None
+
+        blob = ContentBlob.query.get(jobs[0].workflow_definition_hash)
+        assert blob.size == len(definition)
+        assert len(blob.content) < len(definition)
+
+        jobs[1].workflow_definition = 'changed'
+        db.session.commit()
+        assert Job.query.get(7311).workflow_definition == 'changed'
+        assert ContentBlob.query.count() >= 3
+
+        for job in jobs:
+            db.session.delete(job)
+        db.session.commit()
+
+
+def test_content_stored_concurrently_is_not_duplicated(client, app):
+    from stand.models import _insert_ignoring_duplicates
+    row = ContentBlob.values_from_text('{"id": 7312}')
+    with app.app_context():
+        # Same content inserted by another transaction after the check
+        for _ in range(2):
+            _insert_ignoring_duplicates(db.session.connection(),
+                                        ContentBlob.__table__, [row])
+            db.session.commit()
+        assert ContentBlob.query.filter(
+            ContentBlob.hash == row['hash']).count() == 1
+        db.session.delete(ContentBlob.query.get(row['hash']))
+        db.session.commit()
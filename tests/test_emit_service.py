@@ -0,0 +1,324 @@
+import json
+import time
+
+import mock
+from mock import MagicMock
+
+from stand.factory import mocked_emit
+from stand.models import Job, JobResult, JobStep, StatusExecution, db
+from stand.services.emit_service import EMIT_SECONDS, EmitService
+from stand.services.event_stream_service import (EventStreamConsumer,
+                                                 get_event_stream_config,
+                                                 get_partition_stream,
+                                                 publish_event)
+from stand.services.job_metadata_cache import JobMetadataCache
+from stand.services.log_buffer import JobStepLogBuffer
+
+
+def test_update_task_persists_log_and_status(create_job, app,
+                                            redis_store):
+    job_id = 7200
+    create_job(job_id, ['t1'])
+    service = EmitService(app, redis_store)
+
+    data = {'id': 't1', 'status': StatusExecution.RUNNING, 'message': 'Go'}
+    service.persist('update task', data, '/stand', str(job_id))
+
+    assert data['level'] == 'INFO'
+    assert data['task'] == {'id': 't1'}
+    with app.app_context():
+        step = JobStep.query.filter(JobStep.job_id == job_id).one()
+        assert step.status == StatusExecution.RUNNING
+        assert [x.message for x in step.logs] == ['Go']
+        assert data['id'] == step.logs[0].id
+
+
+def test_update_task_with_log_buffer_has_no_log_id(create_job, app,
+                                                  redis_store):
+    job_id = 7207
+    create_job(job_id, ['t1'])
+    log_buffer = JobStepLogBuffer(app, flush_interval=3600)
+    service = EmitService(app, redis_store, log_buffer=log_buffer)
+
+    data = {'id': 't1', 'status': StatusExecution.RUNNING, 'message': 'Go'}
+    service.persist('update task', data, '/stand', str(job_id))
+
+    assert data['id'] is None
+    assert data['task'] == {'id': 't1'}
+    assert len(log_buffer) == 1
+    log_buffer.flush()
+
+
+def test_update_job_completed_updates_pending_steps(create_job, app,
+                                                   redis_store):
+    job_id = 7201
+    create_job(job_id, ['t1', 't2'])
+    service = EmitService(app, redis_store)
+
+    data = {'status': StatusExecution.COMPLETED, 'message': 'Done'}
+    service.persist('update job', data, '/stand', str(job_id))
+
+    assert 'finished' in data
+    with app.app_context():
+        job = Job.query.get(job_id)
+        assert job.status == StatusExecution.COMPLETED
+        assert job.status_text == 'Done'
+        assert all(s.status == StatusExecution.COMPLETED for s in job.steps)
+
+
+def test_task_result_is_added_to_job(create_job, app, redis_store):
+    job_id = 7202
+    create_job(job_id, ['t1'])
+    service = EmitService(app, redis_store)
+
+    data = {'id': 't1', 'operation_id': 1, 'type': 'HTML',
+            'title': 'Result', 'message': '<b>OK</b>'}
+    service.persist('task result', data, '/stand', str(job_id))
+
+    with app.app_context():
+        results = JobResult.query.filter(JobResult.job_id == job_id).all()
+        assert [r.content for r in results] == ['<b>OK</b>']
+
+
+def test_stream_consumer_handles_events_of_a_partition_in_order():
+    redis_conn = MagicMock()
+    emit_service = MagicMock()
+    emit_service.persist.side_effect = [None, Exception('Database is down'),
+                                        Exception('Database is down'), None]
+    config = get_event_stream_config({'emit': {'stream': {
+        'max_deliveries': 2}}})
+    consumer = EventStreamConsumer(redis_conn, emit_service, config, 'test')
+    stream = get_partition_stream(config, '1')
+
+    entries = [
+        ('1-0', {'event': 'update task', 'namespace': '/stand',
+                 'room': '1', 'data': json.dumps({'id': 't1'})}),
+        ('2-0', {'event': 'update task', 'namespace': '/stand',
+                 'room': '1', 'data': json.dumps({'id': 't2'})}),
+        ('3-0', {'event': 'update job', 'namespace': '/stand',
+                 'room': '1', 'data': json.dumps({'status': 'COMPLETED'})}),
+    ]
+    # Next events wait for the failed one
+    assert not consumer.process(stream, entries)
+    assert emit_service.persist.call_count == 2
+    redis_conn.xack.assert_called_once_with(stream, config['group'], '1-0')
+
+    # Moved to dead letter stream after max_deliveries
+    assert consumer.process(stream, entries[1:])
+    assert [c[0][0] for c in redis_conn.xadd.call_args_list] == [
+        'stand_events_dead']
+    assert [c[0][2] for c in redis_conn.xack.call_args_list] == [
+        '1-0', '2-0', '3-0']
+
+
+def test_stream_keeps_events_not_persisted():
+    redis_conn = MagicMock()
+    emit_service = MagicMock()
+    emit_service.persist.side_effect = [None, Exception('Database is down')]
+    config = get_event_stream_config({})
+    consumer = EventStreamConsumer(redis_conn, emit_service, config, 'test')
+    stream = get_partition_stream(config, '1')
+
+    publish_event(redis_conn, config, 'update task', {'id': 't1'},
+                  '/stand', '1')
+    assert 'maxlen' not in redis_conn.xadd.call_args[1]
+
+    redis_conn.xpending.return_value = {'pending': 1, 'min': '2-0'}
+    redis_conn.xlen.return_value = 1
+    consumer.process(stream, [
+        ('1-0', {'event': 'update task', 'room': '1', 'data': '{}'}),
+        ('2-0', {'event': 'update task', 'room': '1', 'data': '{}'})])
+    consumer.trim(stream)
+    redis_conn.xtrim.assert_called_once_with(stream, minid='2-0',
+                                             approximate=True)
+
+    # Nothing acknowledged since the last trim
+    consumer.trim(stream)
+    assert redis_conn.xtrim.call_count == 1
+
+
+def test_stream_consumer_reads_new_events_only_without_pending():
+    redis_conn = MagicMock()
+    emit_service = MagicMock()
+    config = get_event_stream_config({'emit': {'stream': {
+        'partitions': 2, 'retry_delay': 0}}})
+    consumer = EventStreamConsumer(redis_conn, emit_service, config, 'test')
+    consumer.streams = ['stand_events:0', 'stand_events:1']
+    pending = {'stand_events:0': [],
+               'stand_events:1': [('1-0', {'event': 'update task',
+                                           'room': '1', 'data': '{}'})]}
+    emit_service.persist.side_effect = Exception('Database is down')
+
+    def xreadgroup(group, consumer_name, streams, **kwargs):
+        if list(streams.values()) == ['0']:
+            stream = list(streams.keys())[0]
+            return [[stream, pending[stream]]]
+        assert streams == {'stand_events:0': '>'}
+        return []
+    redis_conn.xreadgroup.side_effect = xreadgroup
+    consumer.read()
+    assert redis_conn.xreadgroup.call_count == 3
+    assert not redis_conn.xack.called
+
+
+def test_stream_partitions_are_shared_by_consumers():
+    config = get_event_stream_config({'emit': {'stream': {
+        'partitions': 4}}})
+    assert get_partition_stream(config, '6') == 'stand_events:2'
+    assert get_partition_stream(config, 'pipeline_runs').startswith(
+        'stand_events:')
+
+    redis_conn = MagicMock()
+    redis_conn.hgetall.return_value = {'a': time.time(), 'b': time.time(),
+                                       'dead': 0}
+    # Partitions are free
+    redis_conn.pipeline.return_value.__enter__.return_value.get. \
+        return_value = None
+    redis_conn.set.return_value = True
+    redis_conn.xautoclaim.return_value = ['0-0', [], []]
+    consumer = EventStreamConsumer(redis_conn, MagicMock(), config, 'a')
+    consumer.acquire_partitions()
+    assert len(consumer.streams) == 2
+    redis_conn.hdel.assert_called_once_with('stand_events:workers', 'dead')
+
+    # Consumer publishes to the partition of the room
+    redis_store = MagicMock()
+    publish_event(redis_store, config, 'update task', {'id': 't1'},
+                  '/stand', '6')
+    assert redis_store.xadd.call_args[0][0] == 'stand_events:2'
+
+
+def test_stream_mode_publishes_and_enriches_events(app):
+    original_emit = MagicMock()
+    stand_config = app.config['STAND_CONFIG']
+    with mock.patch.dict(stand_config, {'emit': {'persistence': 'stream'}}), \
+            mock.patch('stand.factory.publish_event') as publish, \
+            mock.patch('stand.factory.cache_room_messages'):
+        new_emit = mocked_emit(original_emit, app)
+        data = {'id': 't1', 'status': StatusExecution.ERROR,
+                'message': 'Failed'}
+        new_emit(MagicMock(), 'update task', data, '/stand', room='7205')
+
+    assert publish.call_count == 1
+    assert publish.call_args[0][2:] == ('update task', data, '/stand',
+                                        '7205')
+    # Fields expected by clients are filled without persisting the event
+    assert data['task'] == {'id': 't1'}
+    assert data['level'] == 'WARN'
+    assert data['type'] == 'TEXT'
+    assert 'date' in data
+    assert data['id'] is None
+    assert original_emit.call_args[0][1:3] == ('update task', data)
+
+
+def _count_timed_events(event):
+    return sum(value for suffix, labels, value in EMIT_SECONDS.samples()
+               if suffix == '_count' and labels == {'event': event})
+
+
+def test_rate_limited_events_are_persisted(create_job, app):
+    job_id = 7206
+    create_job(job_id, ['t1'])
+    original_emit = MagicMock()
+    stand_config = app.config['STAND_CONFIG']
+    rate_limit = {'enabled': True, 'overflow': 'drop', 'rate': 0.0001,
+                  'burst': 1}
+    timed = _count_timed_events('update task')
+    with mock.patch.dict(stand_config, {'emit': {'rate_limit': rate_limit}}), \
+            mock.patch('stand.factory.cache_room_messages') as cache:
+        new_emit = mocked_emit(original_emit, app)
+        for message in ['A', 'B']:
+            new_emit(MagicMock(), 'update task',
+                     {'id': 't1', 'status': StatusExecution.RUNNING,
+                      'message': message}, '/stand', room=str(job_id))
+
+    # Only the broadcast (and the replay cache) are limited
+    assert original_emit.call_count == 1
+    assert cache.call_count == 1
+    # Events not sent are timed too
+    assert _count_timed_events('update task') == timed + 2
+    with app.app_context():
+        step = JobStep.query.filter(JobStep.job_id == job_id).one()
+        assert [x.message for x in step.logs] == ['A', 'B']
+
+
+def test_update_task_uses_job_metadata_cache(create_job, app,
+                                            redis_store):
+    job_id = 7203
+    create_job(job_id, ['t1'])
+    cache = JobMetadataCache(max_size=10)
+    service = EmitService(app, redis_store, metadata_cache=cache)
+
+    with mock.patch.object(JobMetadataCache, '_load',
+                           wraps=JobMetadataCache._load) as load:
+        for status in [StatusExecution.RUNNING, None,
+                       StatusExecution.COMPLETED]:
+            service.persist('update task', {'id': 't1', 'status': status,
+                                            'message': 'Go'},
+                            '/stand', str(job_id))
+        assert load.call_count == 1
+        # Status changed by another process
+        with app.app_context():
+            JobStep.query.filter(JobStep.job_id == job_id).update(
+                {'status': StatusExecution.PENDING})
+            db.session.commit()
+        for status in [None, StatusExecution.COMPLETED]:
+            service.persist('update task', {'id': 't1', 'status': status,
+                                            'message': 'Go'},
+                            '/stand', str(job_id))
+        assert load.call_count == 1
+
+    with app.app_context():
+        step = JobStep.query.filter(JobStep.job_id == job_id).one()
+        assert step.status == StatusExecution.COMPLETED
+        assert [x.status for x in step.logs] == [
+            StatusExecution.RUNNING, StatusExecution.RUNNING,
+            StatusExecution.COMPLETED, StatusExecution.PENDING,
+            StatusExecution.COMPLETED]
+
+    service.persist('update job', {'status': StatusExecution.COMPLETED},
+                    '/stand', str(job_id))
+    assert len(cache) == 0
+
+
+def test_job_metadata_cache_expires_missing_jobs(create_job, app):
+    cache = JobMetadataCache(max_size=2, missing_ttl=0)
+    with app.app_context():
+        assert not cache.get(7299).persistent
+        create_job(7299, ['t1'])
+        assert cache.get(7299).persistent
+        cache.get(7298)
+        cache.get(7297)
+        assert len(cache) == 2
+
+
+def test_update_job_error_cancels_unfinished_steps(create_job, app,
+                                                   redis_store):
+    job_id = 7204
+    create_job(job_id, ['t1', 't2', 't3'])
+    with app.app_context():
+        steps = JobStep.query.filter(JobStep.job_id == job_id).order_by(
+            JobStep.task_id).all()
+        steps[0].status = StatusExecution.RUNNING
+        steps[2].status = StatusExecution.COMPLETED
+        db.session.commit()
+    service = EmitService(app, redis_store)
+
+    with mock.patch('stand.services.emit_service.cache_room_messages') as \
+            cache_messages:
+        service.persist('update job', {'status': StatusExecution.ERROR},
+                        '/stand', str(job_id))
+        assert cache_messages.call_count == 1
+        messages = cache_messages.call_args[0][3]
+
+    with app.app_context():
+        steps = JobStep.query.filter(JobStep.job_id == job_id).order_by(
+            JobStep.task_id).all()
+        assert [s.status for s in steps] == [
+            StatusExecution.ERROR, StatusExecution.CANCELED,
+            StatusExecution.COMPLETED]
+        assert all(len(s.logs) == 1 for s in steps)
+        assert [(m['data']['task']['id'], m['data']['status'],
+                 m['data']['id']) for m in messages] == [
+            ('t1', StatusExecution.ERROR, steps[0].logs[0].id),
+            ('t2', StatusExecution.CANCELED, steps[1].logs[0].id)]
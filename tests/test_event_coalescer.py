@@ -0,0 +1,51 @@
+from mock import MagicMock
+
+from stand.models import StatusExecution
+from stand.services.event_coalescer import TaskEventCoalescer
+
+
+def _event(message, status=StatusExecution.RUNNING, task_id='t1'):
+    return {'id': task_id, 'status': status, 'message': message}
+
+
+def test_same_status_events_are_merged():
+    emit = MagicMock()
+    server = object()
+    coalescer = TaskEventCoalescer(60, emit)
+
+    assert coalescer.add(server, _event('a'), '/stand', '1')
+    assert not coalescer.add(server, _event('b'), '/stand', '1')
+    assert not coalescer.add(server, _event('c'), '/stand', '1')
+    # Other task is not affected
+    assert coalescer.add(server, _event('x', task_id='t2'), '/stand', '1')
+    emit.assert_not_called()
+
+    # Status change sends held events before
+    assert coalescer.add(
+        server, _event('d', StatusExecution.COMPLETED), '/stand', '1')
+    emit.assert_called_once()
+    args = emit.call_args[0]
+    assert args[0] is server
+    assert args[1:] == ('update task', {
+        'id': 't1', 'status': StatusExecution.RUNNING, 'message': 'c',
+        'coalesced': 2, 'first_message': 'b'}, '/stand', '1')
+
+
+def test_flush_room_sends_held_events_and_forgets_room():
+    emit = MagicMock()
+    coalescer = TaskEventCoalescer(60, emit)
+
+    coalescer.add(None, _event('a'), '/stand', '1')
+    coalescer.add(None, _event('b'), '/stand', '1')
+    coalescer.add(None, _event('a'), '/stand', '2')
+    assert not coalescer.add(
+        None, dict(_event('w'), level='INFO'), '/stand', '1')
+    assert coalescer.add(
+        None, dict(_event('w'), level='WARN'), '/stand', '1')
+    assert emit.call_count == 1
+
+    coalescer.add(None, _event('c'), '/stand', '1')
+    coalescer.flush('1')
+    assert emit.call_count == 2
+    assert emit.call_args[0][2]['message'] == 'c'
+    assert len(coalescer) == 1
@@ -200,3 +200,74 @@ def test_lock_job_by_id_api_already_locked_failure(client, app, redis_store):
 
 def test_unlock_job_by_id_api_failure(client):
     assert True
+
+
+class _SampleRedis:
+    """ Minimal Redis used by sample requests """
+    def __init__(self):
+        self.data = {}
+        self.lists = {}
+        self.pushed = []
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def rpush(self, key, value):
+        self.pushed.append(json.loads(value))
+
+    def blpop(self, key, timeout):
+        value = self.lpop(key)
+        return (key, value) if value is not None else None
+
+    def lpop(self, key):
+        items = self.lists.get(key)
+        return items.pop(0) if items else None
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def expire(self, key, ttl):
+        pass
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+def test_retrieve_sample_is_coalesced_and_cached(client, app, monkeypatch):
+    from stand.services.job_services import JobService
+    store = _SampleRedis()
+    monkeypatch.setattr(JobService, '_get_redis_store',
+                        staticmethod(lambda *args: store))
+    job = Job(id=2100, workflow_id=1000)
+    with app.test_request_context():
+        # Executor did not answer yet
+        assert JobService.retrieve_sample(None, job, 't1', 'out', 0) is None
+        assert JobService.retrieve_sample(None, job, 't1', 'out', 0) is None
+        assert len(store.pushed) == 1
+        output = store.pushed[0]['output']
+
+        sample = {'status': 'OK', 'message': '', 'sample': [[1]]}
+        store.lists[output] = [json.dumps(sample)]
+        assert JobService.retrieve_sample(None, job, 't1', 'out', 0) == sample
+        # Cached
+        assert JobService.retrieve_sample(None, job, 't1', 'out', 0) == sample
+        assert len(store.pushed) == 1
+
+        # Job changed, cache is not valid anymore
+        from stand.services.version_service import (JOB, bump_versions,
+                                                    _get_store)
+        bump_versions(_get_store(), {(JOB, job.id): False})
+        assert JobService.retrieve_sample(None, job, 't1', 'out', 0) is None
+        assert len(store.pushed) == 2
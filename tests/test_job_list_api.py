@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
+import datetime
 import json
+from contextlib import contextmanager
 from functools import partial
 
 from flask import url_for, current_app
 from flask_babel import gettext
-from stand.models import Job, StatusExecution, db
+import mock
+from mock import MagicMock
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy import event
+from stand.models import (Job, JobResult, JobStep, JobStepLog,
+                          StatusExecution, db)
+from stand.services.latest_job_service import (ALL_USERS, get_latest_job_id,
+                                               repair_latest_job)
+from stand.services.pagination_service import (DEFAULT_PAGE_SIZE,
+                                               MAX_PAGE_SIZE, cached_count)
+from stand.services.version_service import JOB, get_version, track_changes
 
 # partial(url_for, endpoint='joblistapi', external=False)
 def job_list_url(): return '/jobs'
@@ -324,3 +336,343 @@ def test_delete_job_success(client, app):
     assert (response.status_code == 204)
     with app.app_context():
         assert Job.query.get(job_id) is None
+
+
+def test_list_jobs_using_cursor(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    query = {'name': 'Job ', 'sort': 'created', 'asc': 'false', 'size': 2,
+             'after': ''}
+    response = client.get(job_list_url(), headers=headers,
+                          query_string=query)
+    assert response.status_code == 200
+    assert [job['id'] for job in response.json['data']] == [3, 2]
+    assert 'total' not in response.json['pagination']
+    cursor = response.json['pagination']['next']
+    assert cursor is not None
+
+    response = client.get(job_list_url(), headers=headers,
+                          query_string=dict(query, after=cursor))
+    assert [job['id'] for job in response.json['data']] == [1]
+    assert response.json['pagination']['next'] is None
+
+    response = client.get(job_list_url(), headers=headers,
+                          query_string=dict(query, after='invalid'))
+    assert response.status_code == 400
+
+    # Invalid sizes are replaced by the default, large ones are limited
+    for size, expected in [('x', DEFAULT_PAGE_SIZE), ('-1', DEFAULT_PAGE_SIZE),
+                           ('100000', MAX_PAGE_SIZE)]:
+        response = client.get(job_list_url(), headers=headers,
+                              query_string=dict(query, size=size))
+        assert response.status_code == 200
+        assert response.json['pagination']['size'] == expected
+
+
+def test_cached_count_uses_cache(client, app):
+    redis_store = MagicMock()
+    with app.app_context():
+        query = Job.query.filter(Job.name.like('Job %'))
+        redis_store.get.return_value = None
+        assert cached_count(redis_store, 'jobs', query, 10) == 3
+        key = redis_store.set.call_args[0][0]
+        redis_store.set.assert_called_once_with(key, 3, ex=10)
+
+        redis_store.get.return_value = '7'
+        assert cached_count(redis_store, 'jobs', query, 10) == 7
+        assert redis_store.get.call_args[0][0] == key
+
+
+@contextmanager
+def _capture_statements(app):
+    statements = []
+
+    def _capture(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', _capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', _capture)
+
+
+def test_list_jobs_loads_only_requested_fields(client, app):
+    headers = {'X-Auth-Token': str(client.secret)}
+    with _capture_statements(app) as statements:
+        response = client.get(job_list_url(), headers=headers,
+                              query_string={'fields': 'id,name,user'})
+
+    assert response.status_code == 200
+    assert set(response.json['data'][0].keys()) == {'id', 'name', 'user'}
+    # Pagination count is not considered (columns are not read)
+    job_selects = [s for s in statements if 'FROM job ' in s + ' '
+                   and not s.startswith('SELECT count(')]
+    assert len(job_selects) > 0
+    assert all('workflow_definition' not in s and 'source_code' not in s
+               for s in job_selects)
+
+
+def _count_job_detail_queries(client, app, create_job, job_id, steps):
+    now = datetime.datetime.now()
+    create_job(
+        job_id, steps=[JobStep(
+            date=now, status='RUNNING', task_id=str(i), operation_id=1,
+            operation_name='Op',
+            logs=[JobStepLog(level='INFO', status='RUNNING', date=now,
+                             message=f'Log {j}', type='TEXT')
+                  for j in range(2)])
+            for i in range(steps)],
+        results=[JobResult(task_id=str(i), operation_id=1, type='HTML',
+                           content='<p/>') for i in range(steps)])
+
+    with _capture_statements(app) as statements:
+        response = client.get(job_detail_url(job_id), headers=HEADERS)
+    assert response.status_code == 200
+    assert len(response.json['steps']) == steps
+    assert all(len(s['logs']) == 2 for s in response.json['steps'])
+    return len(statements)
+
+
+def test_job_detail_queries_do_not_depend_on_steps(client, app, create_job):
+    few = _count_job_detail_queries(client, app, create_job, 7400, 2)
+    many = _count_job_detail_queries(client, app, create_job, 7401, 30)
+    assert few == many
+    assert many <= 10
+
+
+def test_job_detail_omits_results_content_of_pipeline_jobs(client,
+                                                           create_job):
+    for job_id in [7407, 7408]:
+        create_job(job_id, ['t1'], pipeline_run_id=3,
+                   pipeline_step_run_id=5,
+                   results=[JobResult(task_id='t1', operation_id=1,
+                                      type='HTML', content='<p>Big</p>')])
+
+    for result_content in ['false', 'true']:
+        response = client.get(job_detail_url(7407), headers=HEADERS,
+                              query_string={
+                                  'results_content': result_content})
+        assert response.status_code == 200
+        assert ('content' in response.json['results'][0]) == (
+            result_content == 'true')
+        jobs = response.json['pipeline_run']['steps'][0]['jobs']
+        assert sorted(job['id'] for job in jobs) == [7407, 7408]
+        assert all('content' not in result for job in jobs
+                   for result in job['results'])
+
+
+def test_job_logs_are_paginated_and_filtered(client, app, create_job):
+    job_id = 7402
+    now = datetime.datetime(2024, 1, 1, 10, 0, 0)
+    create_job(job_id, created=now, steps=[JobStep(
+        date=now, status='RUNNING', task_id=task_id, operation_id=1,
+        operation_name='Op',
+        logs=[JobStepLog(
+            level=level, status='RUNNING', type='TEXT',
+            date=now + datetime.timedelta(seconds=i),
+            message=f'{task_id} {i}')
+            for i, level in enumerate(['INFO', 'WARN', 'INFO'])])
+        for task_id in ['t1', 't2']])
+
+    url = f'/jobs/{job_id}/logs'
+    response = client.get(url, headers=HEADERS, query_string={'size': 4})
+    assert response.status_code == 200
+    assert [x['message'] for x in response.json['data']] == [
+        't1 0', 't2 0', 't1 1', 't2 1']
+    assert response.json['data'][0]['task'] == {'id': 't1'}
+    next_cursor = response.json['pagination']['next']
+    response = client.get(url, headers=HEADERS,
+                          query_string={'size': 4, 'after': next_cursor})
+    assert [x['message'] for x in response.json['data']] == ['t1 2', 't2 2']
+    assert response.json['pagination']['next'] is None
+    last = response.json['pagination']['last']
+
+    # Polling: no new logs
+    response = client.get(url, headers=HEADERS, query_string={'since': last})
+    assert response.json['data'] == []
+    assert response.json['pagination']['last'] == last
+
+    # Logs committed later are returned, even with earlier dates
+    with app.app_context():
+        step = JobStep.query.filter(JobStep.job_id == job_id,
+                                    JobStep.task_id == 't1').one()
+        db.session.add(JobStepLog(
+            step_id=step.id, level='ERROR', status='ERROR', type='TEXT',
+            date=now - datetime.timedelta(hours=1), message='t1 late'))
+        db.session.commit()
+    response = client.get(url, headers=HEADERS, query_string={'since': last})
+    assert [x['message'] for x in response.json['data']] == ['t1 late']
+    assert response.json['pagination']['last'] > last
+    assert client.get(url, headers=HEADERS, query_string={
+        'since': 'x'}).status_code == 400
+
+    response = client.get(url, headers=HEADERS, query_string={
+        'task_id': 't2', 'level': 'INFO',
+        'start': '2024-01-01T10:00:01'})
+    assert [x['message'] for x in response.json['data']] == ['t2 2']
+
+    response = client.get(url, headers=HEADERS, query_string={
+        'start': 'yesterday'})
+    assert response.status_code == 400
+
+    # Invalid sizes are replaced by the default
+    for size in ['0', '-1', '-2', 'x']:
+        response = client.get(url, headers=HEADERS,
+                              query_string={'size': size})
+        assert response.status_code == 200
+        assert response.json['pagination']['size'] == 100
+        assert len(response.json['data']) == 7
+    assert client.get('/jobs/999999/logs', headers=HEADERS).status_code == 404
+
+
+def test_conditional_get_returns_not_modified(client, app, create_job):
+    job_id = 7403
+    create_job(job_id, ['t1'])
+
+    for url in [job_detail_url(job_id), job_list_url()]:
+        response = client.get(url, headers=HEADERS)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        response = client.get(url, headers={**HEADERS,
+                                             'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+    with app.app_context():
+        # Set-based changes are registered explicitly
+        JobStep.query.filter(JobStep.job_id == job_id).update(
+            {'status': 'COMPLETED'}, synchronize_session=False)
+        track_changes(JOB, [job_id])
+        db.session.commit()
+    for url in [job_list_url(), job_detail_url(job_id)]:
+        response = client.get(url, headers={**HEADERS,
+                                            'If-None-Match': etag})
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+    with app.app_context():
+        db.session.delete(Job.query.get(job_id))
+        db.session.commit()
+    response = client.get(job_detail_url(job_id),
+                          headers={**HEADERS, 'If-None-Match': etag})
+    assert response.status_code == 404
+
+
+def test_versions_change_only_for_visible_changes(client, app, create_job):
+    job_id = 7406
+    create_job(job_id, ['t1'])
+    list_etag = client.get(job_list_url(), headers=HEADERS).headers['ETag']
+    with app.app_context():
+        # Steps (and their logs) change only the version of their job
+        step = JobStep.query.filter(JobStep.job_id == job_id).one()
+        step.status = StatusExecution.RUNNING
+        db.session.commit()
+    response = client.get(job_list_url(), headers={
+        **HEADERS, 'If-None-Match': list_etag})
+    assert response.status_code == 304
+
+    # Versions are not assigned to missing jobs and deleted jobs lose them
+    assert client.get(job_detail_url(999999),
+                      headers=HEADERS).status_code == 404
+    assert client.get(job_detail_url(job_id),
+                      headers=HEADERS).status_code == 200
+    with app.app_context():
+        assert get_version(JOB, 999999, create=False) is None
+        assert get_version(JOB, job_id, create=False) is not None
+        db.session.delete(Job.query.get(job_id))
+        db.session.commit()
+        assert get_version(JOB, job_id, create=False) is None
+
+
+def test_create_jobs_in_bulk(client, app, redis_store):
+    redis_store.flushdb()
+    data = {
+        'workflow': {
+            'id': 556, 'name': 'Sweep', 'enabled': True,
+            'platform': {'id': 1},
+            'tasks': [{'id': 't1', 'name': 'Read', 'forms': {},
+                       'operation': {'id': 1}},
+                      {'id': 't2', 'name': 'Write', 'forms': {},
+                       'operation': {'id': 2}}]
+        },
+        'cluster': {'id': 1},
+        'app_configs': {'seed': 1},
+        'jobs': [{'name': f'Sweep {i}', 'app_configs': {'alpha': i}}
+                 for i in range(3)]
+    }
+    response = client.post('/jobs/bulk', headers=HEADERS, json=data)
+    assert response.status_code == 201, response.json
+    ids = [job['id'] for job in response.json['data']]
+    assert len(ids) == 3
+
+    queued = [json.loads(msg) for msg in
+              redis_store.lrange('queue_start', 0, 2)]
+    assert [msg['job_id'] for msg in queued] == ids
+    assert [msg['app_configs']['alpha'] for msg in queued] == [0, 1, 2]
+    assert all(msg['app_configs']['seed'] == 1 for msg in queued)
+
+    with app.app_context():
+        jobs = Job.query.filter(Job.id.in_(ids)).all()
+        assert sorted(j.name for j in jobs) == ['Sweep 0', 'Sweep 1',
+                                               'Sweep 2']
+        assert all(len(j.steps) == 2 for j in jobs)
+        for job in jobs:
+            db.session.delete(job)
+        db.session.commit()
+
+    data['jobs'] = [{'name': 1}]
+    response = client.post('/jobs/bulk', headers=HEADERS, json=data)
+    assert response.status_code == 400
+    assert 'jobs' in response.json['errors']
+
+
+def test_latest_job_uses_pointer(client, app, create_job):
+    workflow_id = 7410
+    now = datetime.datetime.now()
+    create_job(7404, workflow_id=workflow_id, status='COMPLETED',
+               created=now - datetime.timedelta(days=1))
+    create_job(7405, workflow_id=workflow_id, status='COMPLETED',
+               created=now)
+    with app.app_context():
+        assert get_latest_job_id(workflow_id) == 7405
+        assert get_latest_job_id(workflow_id, 1) == 7405
+
+    url = f'/jobs/latest?workflow={workflow_id}'
+    response = client.get(url, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json['id'] == 7405
+
+    with app.app_context():
+        db.session.delete(Job.query.get(7405))
+        db.session.commit()
+        assert get_latest_job_id(workflow_id) is None
+
+    # Pointer is restored from the database
+    response = client.get(url, headers=HEADERS)
+    assert response.json['id'] == 7404
+    with app.app_context():
+        assert get_latest_job_id(workflow_id) == 7404
+        # Pointers changed by new jobs are not replaced
+        repair_latest_job(workflow_id, ALL_USERS, 7403, 7403)
+        assert get_latest_job_id(workflow_id) == 7404
+
+    # Database is used if Redis is not available
+    with mock.patch('stand.services.latest_job_service._get_store',
+                    side_effect=RedisConnectionError('Down')):
+        response = client.get(url, headers=HEADERS)
+    assert response.json['id'] == 7404
+
+    with app.app_context():
+        db.session.delete(Job.query.get(7404))
+        db.session.commit()
+    response = client.get(url, headers=HEADERS)
+    assert response.status_code == 404
+
+    # Jobs committed in a different order than their ids
+    create_job(7407, workflow_id=workflow_id)
+    create_job(7406, workflow_id=workflow_id)
+    with app.app_context():
+        assert get_latest_job_id(workflow_id) == 7407
+        assert get_latest_job_id(workflow_id, 1) == 7407
@@ -0,0 +1,88 @@
+import datetime
+
+import mock
+
+from stand.models import Job, JobStep, JobStepLog, StatusExecution, db
+from stand.services.log_buffer import JobStepLogBuffer
+
+
+def test_log_buffer_persists_only_when_flushed(create_job, app):
+    job_id = 7100
+    step_id, = create_job(job_id, ['t1'])
+
+    buffer = JobStepLogBuffer(app, max_size=10, flush_interval=3600)
+    now = datetime.datetime.now()
+    buffer.add(step_id, StatusExecution.RUNNING, 'INFO', 'TEXT', 'A', now)
+    buffer.add(step_id, StatusExecution.COMPLETED, 'INFO', 'TEXT', 'B', now)
+    assert len(buffer) == 2
+
+    with app.app_context():
+        assert JobStepLog.query.filter(
+            JobStepLog.step_id == step_id).count() == 0
+
+    buffer.flush()
+    assert len(buffer) == 0
+    with app.app_context():
+        logs = JobStepLog.query.filter(
+            JobStepLog.step_id == step_id).order_by(JobStepLog.id).all()
+        assert [x.message for x in logs] == ['A', 'B']
+        assert JobStep.query.get(step_id).status == StatusExecution.COMPLETED
+
+
+def test_log_buffer_flushes_when_full(create_job, app):
+    job_id = 7101
+    step_id, = create_job(job_id, ['t1'])
+
+    buffer = JobStepLogBuffer(app, max_size=3, flush_interval=3600)
+    now = datetime.datetime.now()
+    for i in range(3):
+        buffer.add(step_id, StatusExecution.RUNNING, 'INFO', 'TEXT',
+                   f'Message {i}', now)
+
+    assert len(buffer) == 0
+    with app.app_context():
+        assert JobStepLog.query.filter(
+            JobStepLog.step_id == step_id).count() == 3
+
+
+def test_log_buffer_keeps_rows_if_flush_fails(create_job, app):
+    job_id = 7102
+    step_id, = create_job(job_id, ['t1'])
+
+    buffer = JobStepLogBuffer(app, max_size=10, flush_interval=3600,
+                              max_attempts=2)
+    now = datetime.datetime.now()
+
+    def add(message):
+        buffer.add(step_id, StatusExecution.RUNNING, 'INFO', 'TEXT',
+                   message, now)
+
+    def failing_flush():
+        with mock.patch('sqlalchemy.orm.Session.bulk_insert_mappings',
+                        side_effect=Exception('Database is down')):
+            buffer.flush()
+
+    add('A')
+    with app.app_context():
+        job = Job.query.get(job_id)
+        job.status_text = 'Changed'
+        failing_flush()
+        # Changes pending in the session of the caller are kept
+        assert job in db.session.dirty
+        db.session.commit()
+    assert len(buffer) == 1
+
+    add('B')
+    buffer.flush()
+    with app.app_context():
+        assert [x.message for x in JobStepLog.query.filter(
+            JobStepLog.step_id == step_id).order_by(JobStepLog.id)] == [
+            'A', 'B']
+        assert Job.query.get(job_id).status_text == 'Changed'
+
+    # Discarded after max_attempts consecutive failures
+    add('C')
+    failing_flush()
+    assert len(buffer) == 1
+    failing_flush()
+    assert len(buffer) == 0
@@ -0,0 +1,41 @@
+from stand.services.metrics_service import MetricsRegistry, registry
+
+
+def test_registry_renders_prometheus_text():
+    metrics = MetricsRegistry()
+    events = metrics.counter('events_total', 'Events')
+    events.inc(event='update task')
+    events.inc(2, event='update task')
+    duration = metrics.histogram('duration_seconds', 'Duration',
+                                 buckets=(0.1, 1))
+    duration.observe(0.05, event='a')
+    duration.observe(0.5, event='a')
+    assert metrics.counter('events_total') is events
+
+    assert metrics.render_text().splitlines() == [
+        '# HELP events_total Events',
+        '# TYPE events_total counter',
+        'events_total{event="update task"} 3',
+        '# HELP duration_seconds Duration',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{event="a",le="0.1"} 1',
+        'duration_seconds_bucket{event="a",le="1"} 2',
+        'duration_seconds_bucket{event="a",le="+Inf"} 2',
+        'duration_seconds_count{event="a"} 2',
+        'duration_seconds_sum{event="a"} 0.55',
+    ]
+
+
+def test_metrics_api_requires_auth_and_lists_metrics(client):
+    registry.counter('test_metric_total', 'Test').inc()
+    rv = client.get('/metrics')
+    assert rv.status_code == 401
+
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/metrics', headers=headers)
+    assert rv.status_code == 200
+    assert rv.json['test_metric_total']['samples'][0]['value'] >= 1
+
+    rv = client.get('/metrics?format=prometheus', headers=headers)
+    assert rv.status_code == 200
+    assert 'test_metric_total 1' in rv.data.decode('utf8')
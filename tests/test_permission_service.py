@@ -0,0 +1,27 @@
+from stand.models import ExecutionPermission, PermissionType, db
+from stand.services.permission_service import (
+    get_execution_permissions, invalidate_execution_permissions)
+
+
+def test_permissions_are_cached_by_user(client, app):
+    user_id = 7310
+    with app.app_context():
+        invalidate_execution_permissions()
+        assert get_execution_permissions(user_id) == frozenset()
+
+        permission = ExecutionPermission(
+            user_id=user_id, permission=PermissionType.LIST)
+        db.session.add(permission)
+        db.session.commit()
+        # Changes made through the ORM invalidate the cache
+        assert get_execution_permissions(user_id) == {PermissionType.LIST}
+        assert get_execution_permissions(user_id + 1) == frozenset()
+
+        # Bulk changes are not seen until invalidation
+        ExecutionPermission.query.filter(
+            ExecutionPermission.user_id == user_id).delete()
+        db.session.commit()
+        assert get_execution_permissions(user_id) == {PermissionType.LIST}
+
+        invalidate_execution_permissions(user_id)
+        assert get_execution_permissions(user_id) == frozenset()
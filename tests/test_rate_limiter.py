@@ -0,0 +1,34 @@
+import pytest
+
+from stand.services.rate_limiter import (CACHE, DROP, SEND, RoomRateLimiter,
+                                         get_rate_limit_config)
+
+
+def _limiter(**config):
+    config.setdefault('rate', 0.0001)
+    config.setdefault('burst', 2)
+    return RoomRateLimiter(get_rate_limit_config(
+        {'emit': {'rate_limit': config}}))
+
+
+def test_rate_limit_per_room_and_event():
+    limiter = _limiter(overflow='drop')
+    assert [limiter.check('1', 'update task') for _ in range(3)] == [
+        SEND, SEND, DROP]
+    # Other rooms, other events and exempt events are not limited
+    assert limiter.check('2', 'update task') == SEND
+    assert limiter.check('1', 'user message') == SEND
+    assert [limiter.check('1', 'update job') for _ in range(3)] == [SEND] * 3
+
+
+def test_rate_limit_overflow_modes():
+    limiter = _limiter(overflow='sample', sample=3, burst=1)
+    assert [limiter.check('1', 'update task') for _ in range(7)] == [
+        SEND, DROP, DROP, SEND, DROP, DROP, SEND]
+
+    limiter = _limiter(overflow='cache', burst=1)
+    assert [limiter.check('1', 'update task') for _ in range(2)] == [
+        SEND, CACHE]
+
+    with pytest.raises(ValueError):
+        _limiter(overflow='invalid')
@@ -0,0 +1,35 @@
+from unittest.mock import MagicMock
+
+from stand.services.metrics_service import registry
+from stand.services.redis_service import get_redis_client, redis_batch
+
+
+def test_clients_share_pools():
+    url = 'redis://redis-test-host:6390'
+    client = get_redis_client(url, 1, config={'max_connections': 3})
+    assert get_redis_client(url, 1) is client
+    assert get_redis_client(url, 2) is not client
+    assert get_redis_client(url, 1, decode_responses=False) is not client
+
+    pool = client.connection_pool
+    assert pool.max_connections == 3
+    assert pool.connection_kwargs['health_check_interval'] == 30
+
+    samples = registry.collect()['stand_redis_pool_connections']['samples']
+    assert {'name': 'stand_redis_pool_connections',
+            'labels': {'pool': 'redis-test-host:6390/1', 'state': 'in_use'},
+            'value': 0} in samples
+
+
+def test_batch_executes_commands_once():
+    redis_store = MagicMock()
+    pipe = redis_store.pipeline.return_value
+    pipe.execute.return_value = [1, True]
+    with redis_batch(redis_store) as batch:
+        batch.rpush('queue_start', 'msg')
+        batch.expire('queue_start', 10)
+
+    assert batch is pipe
+    pipe.execute.assert_called_once_with()
+    assert batch.results == [1, True]
+    redis_store.rpush.assert_not_called()
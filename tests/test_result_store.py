@@ -0,0 +1,94 @@
+import datetime
+import json
+
+from stand.models import Job, JobResult, StatusExecution, db
+from stand.services.result_store import (ZLIB, ZLIB_BASE64,
+                                         get_result_store_config,
+                                         read_result_content,
+                                         store_result_content)
+
+
+def _config(**kwargs):
+    return get_result_store_config({'result_store': kwargs})
+
+
+def test_small_content_is_kept_as_is():
+    result = JobResult()
+    store_result_content(result, 'small', _config(threshold=10))
+    assert result.content == 'small'
+    assert result.content_encoding is None
+    assert result.content_size == 5
+    assert read_result_content(result) == 'small'
+
+
+def test_large_content_is_compressed(tmp_path):
+    content = json.dumps({'rows': [[i, 'value'] for i in range(1000)]})
+
+    result = JobResult()
+    store_result_content(result, content, _config(threshold=10))
+    assert result.content_encoding == ZLIB_BASE64
+    assert len(result.content) < len(content)
+    assert read_result_content(result) == content
+
+    config = _config(threshold=10, type='filesystem', path=str(tmp_path))
+    result = JobResult()
+    store_result_content(result, content, config)
+    assert result.content is None
+    assert result.content_encoding == ZLIB
+    assert (tmp_path / result.content_ref).exists()
+    assert read_result_content(result, config) == content
+    assert result.content_size == len(content)
+
+    # File not available (e.g. path not shared by this host)
+    (tmp_path / result.content_ref).unlink()
+    assert read_result_content(result, config) is None
+
+
+def test_result_content_endpoint(client, app):
+    job_id = 7300
+    content = 'x' * 100000
+    with app.app_context():
+        result = JobResult(task_id='t1', operation_id=1, type='HTML')
+        store_result_content(result, content, get_result_store_config())
+        job = Job(id=job_id, name='Results', workflow_id=1000, cluster_id=1,
+                  workflow_name='Results', user_id=1, user_name='AA',
+                  user_login='aa', status=StatusExecution.COMPLETED,
+                  created=datetime.datetime.now(),
+                  workflow_definition=json.dumps({'id': 1}),
+                  results=[result])
+        db.session.add(job)
+        db.session.commit()
+        result_id = result.id
+
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get(f'/jobs/{job_id}', headers=headers)
+    assert rv.status_code == 200
+    assert rv.json['results'][0]['id'] == result_id
+    assert rv.json['results'][0]['content_size'] == len(content)
+    assert 'content' not in rv.json['results'][0]
+
+    rv = client.get(f'/jobs/{job_id}?results_content=true', headers=headers)
+    assert rv.json['results'][0]['content'] == content
+
+    # Job list omits contents, unless requested
+    query = {'name': 'Results', 'workflow_id': 1000}
+    rv = client.get('/jobs', headers=headers, query_string=query)
+    assert [r['task_id'] for r in rv.json['data'][0]['results']] == ['t1']
+    assert 'content' not in rv.json['data'][0]['results'][0]
+    rv = client.get('/jobs', headers=headers,
+                    query_string=dict(query, results_content='true'))
+    assert rv.json['data'][0]['results'][0]['content'] == content
+
+    rv = client.get(f'/jobs/{job_id}/results/{result_id}/content',
+                    headers=headers)
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/html'
+    assert rv.data.decode('utf8') == content
+
+    rv = client.get(f'/jobs/{job_id}/results/{result_id + 1}/content',
+                    headers=headers)
+    assert rv.status_code == 404
+
+    with app.app_context():
+        db.session.delete(Job.query.get(job_id))
+        db.session.commit()
@@ -0,0 +1,127 @@
+import json
+import zlib
+from unittest import mock
+
+from redis.exceptions import WatchError
+
+from stand.services.redis_service import MockRedisWrapper
+from stand.services.room_cache_service import (ROOM_CACHE_MAX_LENGTH,
+                                               ROOM_CACHE_ROOMS,
+                                               build_replay_payload,
+                                               cache_room_messages,
+                                               forget_room_cache,
+                                               get_room_messages)
+
+
+def _cached(total):
+    return [{'event': 'update task', 'data': {'message': f'M{i}', 'seq': i},
+             'namespace': '/stand', 'room': '1', 'seq': i}
+            for i in range(1, total + 1)]
+
+
+def test_replay_payload_has_all_messages():
+    payload = build_replay_payload('1', _cached(3))
+
+    assert payload['room'] == '1'
+    assert payload['last_seq'] == 3
+    assert payload['count'] == 3
+    assert [m['data']['message'] for m in payload['messages']] == [
+        'M1', 'M2', 'M3']
+    assert set(payload['messages'][0].keys()) == {'event', 'data'}
+
+
+def test_replay_payload_compressed():
+    payload = build_replay_payload('1', _cached(3), compress=True)
+
+    assert payload['encoding'] == 'zlib'
+    assert 'messages' not in payload
+    messages = json.loads(zlib.decompress(payload['payload']))
+    assert [m['data']['seq'] for m in messages] == [1, 2, 3]
+
+
+def test_replay_payload_empty_room():
+    payload = build_replay_payload('1', [])
+
+    assert payload['last_seq'] is None
+    assert payload['messages'] == []
+
+
+def test_replay_payload_gap():
+    assert build_replay_payload('1', _cached(1))['gap'] is False
+    assert build_replay_payload('1', _cached(1), gap=True)['gap'] is True
+
+
+def test_room_messages_resumed_after_last_seq():
+    store = MockRedisWrapper()
+    config = {'max_length': 5, 'ttl': 60}
+    room = 'resume-test'
+    for i in range(8):
+        cache_room_messages(store, config, room, [
+            {'event': 'update task', 'data': {'message': f'M{i}'},
+             'namespace': '/stand'}])
+
+    messages, gap = get_room_messages(store, room)
+    assert [m['seq'] for m in messages] == [4, 5, 6, 7, 8]
+    assert not gap
+
+    messages, gap = get_room_messages(store, room, 6)
+    assert [m['seq'] for m in messages] == [7, 8]
+    assert not gap
+
+    assert get_room_messages(store, room, 8) == ([], False)
+
+    # Messages 3 and 4 were discarded
+    messages, gap = get_room_messages(store, room, 2)
+    assert [m['seq'] for m in messages] == [4, 5, 6, 7, 8]
+    assert gap
+
+    # Cache expired and sequence restarted
+    messages, gap = get_room_messages(store, room, 20)
+    assert [m['seq'] for m in messages] == [4, 5, 6, 7, 8]
+    assert gap
+
+
+def test_room_messages_read_again_if_appended_while_reading():
+    store = MockRedisWrapper()
+    config = {'max_length': 5, 'ttl': 60}
+    room = 'concurrent-test'
+
+    def append(seq):
+        cache_room_messages(store, config, room, [
+            {'event': 'update task', 'data': {'message': f'M{seq}'},
+             'namespace': '/stand'}])
+    for i in range(3):
+        append(i)
+
+    pipeline = store.pipeline()
+    original_execute = pipeline.execute
+
+    def execute():
+        # Message appended between reading the sequence and the messages
+        pipeline.execute = original_execute
+        append(3)
+        raise WatchError()
+    pipeline.execute = execute
+    with mock.patch.object(store, 'pipeline', return_value=pipeline):
+        messages, gap = get_room_messages(store, room, 1)
+    assert [m['seq'] for m in messages] == [2, 3, 4]
+    assert not gap
+
+
+def test_room_cache_metrics_are_aggregated():
+    store = MockRedisWrapper()
+    message = {'event': 'update task', 'data': {'message': 'M'},
+               'namespace': '/stand'}
+
+    def value(gauge):
+        return gauge.samples()[0][2]
+    rooms = value(ROOM_CACHE_ROOMS)
+    cache_room_messages(store, {'max_length': 500, 'ttl': 60},
+                        'metrics-test', [dict(message)] * 400)
+    cache_room_messages(store, {'max_length': 5, 'ttl': 0},
+                        'metrics-expired', [dict(message)])
+    assert value(ROOM_CACHE_ROOMS) == rooms + 1
+    assert value(ROOM_CACHE_MAX_LENGTH) >= 400
+
+    forget_room_cache('metrics-test')
+    assert value(ROOM_CACHE_ROOMS) == rooms
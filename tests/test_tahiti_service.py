@@ -0,0 +1,98 @@
+from unittest import mock
+
+import requests
+from stand.services.tahiti_service import TahitiClient, get_tahiti_client
+
+
+def _response(status_code, text='', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode('utf8')
+    response.headers.update(headers or {})
+    return response
+
+
+def test_resources_are_cached_and_revalidated():
+    client = TahitiClient('http://tahiti/', 'token')
+    with mock.patch.object(client.session, 'get') as get:
+        get.return_value = _response(200, '{"id": 1}', {'ETag': '"v1"'})
+        assert client.get_workflow(1) == '{"id": 1}'
+        assert get.call_args[0][0] == 'http://tahiti/workflows/1'
+        assert get.call_args[1]['timeout'] == (3, 15)
+        assert get.call_args[1]['headers'] == {}
+
+        # Cached entries are always revalidated
+        get.return_value = _response(304)
+        assert client.get_workflow(1) == '{"id": 1}'
+        assert get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+        get.return_value = _response(200, '{"id": 1, "v": 2}')
+        assert client.get_workflow(1) == '{"id": 1, "v": 2}'
+        assert get.call_count == 3
+
+        get.return_value = _response(404, 'Not found')
+        try:
+            client.get_workflow(2)
+            assert False, 'HTTPError expected'
+        except requests.exceptions.HTTPError as e:
+            assert e.response.status_code == 404
+
+
+def test_clients_are_shared():
+    config = {'url': 'http://tahiti', 'auth_token': '123', 'timeout': 5}
+    client = get_tahiti_client(config)
+    assert client is get_tahiti_client(dict(config))
+    assert client.config['timeout'] == 5
+    assert client.session.headers['X-Auth-Token'] == '123'
+
+
+def test_circuit_opens_after_failures_and_probes():
+    from stand.services.tahiti_service import (CIRCUIT_STATE,
+                                               CircuitOpenError)
+    client = TahitiClient('http://tahiti', 'token', {
+        'failure_threshold': 2, 'reset_timeout': 60,
+        'endpoints': {'pipelines': {'timeout': 2}}})
+    with mock.patch.object(client.session, 'get') as get:
+        get.return_value = _response(200, '{"id": 1}')
+        assert client.get_pipeline(1) == '{"id": 1}'
+        assert get.call_args[1]['timeout'] == (3, 2)
+
+        get.side_effect = requests.exceptions.ReadTimeout('Slow')
+        # Stale content is returned when Tahiti fails
+        assert client.get_pipeline(1) == '{"id": 1}'
+        try:
+            client.get_pipeline(2)
+            assert False, 'ReadTimeout expected'
+        except requests.exceptions.ReadTimeout:
+            pass
+        breaker = client._breakers['pipelines']
+        assert breaker.state == breaker.OPEN
+        assert ('', {'endpoint': 'pipelines'}, breaker.OPEN) in \
+            CIRCUIT_STATE.samples()
+
+        # Requests fail immediately, other endpoints are not affected
+        calls = get.call_count
+        try:
+            client.get_pipeline(2)
+            assert False, 'CircuitOpenError expected'
+        except CircuitOpenError:
+            pass
+        assert get.call_count == calls
+        get.side_effect = None
+        assert client.get_workflow(1) == '{"id": 1}'
+
+        # After reset_timeout, a request is sent to probe Tahiti
+        breaker.opened -= 60
+        assert client.get_pipeline(2) == '{"id": 1}'
+        assert breaker.state == breaker.CLOSED
+
+        # Unexpected errors of a probe do not keep the circuit half open
+        breaker.state, breaker.opened = breaker.OPEN, 0
+        with mock.patch.object(client, '_request',
+                               side_effect=ValueError('Bug')):
+            try:
+                client.get_pipeline(3)
+                assert False, 'ValueError expected'
+            except ValueError:
+                pass
+        assert breaker.allow()